@@ -18,15 +18,68 @@ class Element:
         for i in range(3):
             self.xe[:, i] = [n.coordinates[i] for n in nodes]
             self.node_labels = [n.label for n in nodes]
+        # The Jacobians at the Gauss points and the quantities derived from them are computed once, when first used
+        self._jacobians = None
+        self._inverse_jacobians = None
+        self._det_j = None
+        self._gradients = None
+        self._averaged_gradients = None
+
+    def _gauss_point_index(self, xi, eta, zeta):
+        matches = np.where(np.all(self.gauss_points == (xi, eta, zeta), axis=1))[0]
+        return matches[0] if matches.shape[0] else None
+
+    def gauss_point_jacobians(self):
+        """
+        Returns the Jacobians at the Gauss points, n_gp x 3 x 3, their inverses and their determinants
+        """
+        if self._jacobians is None:
+            self._jacobians = np.matmul(self.gauss_point_derivatives(), self.xe)
+            self._inverse_jacobians = np.linalg.inv(self._jacobians)
+            self._det_j = np.linalg.det(self._jacobians)
+        return self._jacobians, self._inverse_jacobians, self._det_j
+
+    def gauss_point_gradients(self):
+        """
+        Returns the derivatives of the shape functions with respect to x, y and z at the Gauss points,
+        n_gp x 3 x n_nodes
+        """
+        if self._gradients is None:
+            self._gradients = np.matmul(self.gauss_point_jacobians()[1], self.gauss_point_derivatives())
+        return self._gradients
+
+    def gradients(self, xi, eta, zeta):
+        """
+        Returns the derivatives of the shape functions with respect to x, y and z as a 3 x n_nodes matrix
+        """
+        i = self._gauss_point_index(xi, eta, zeta)
+        if i is None:
+            return np.linalg.solve(self.J(xi, eta, zeta), self.d(xi, eta, zeta))
+        return self.gauss_point_gradients()[i]
+
+    def averaged_gradients(self):
+        """
+        Returns the derivatives of the shape functions with respect to x, y and z averaged over the volume of the
+        element as a 3 x n_nodes matrix
+        """
+        if self._averaged_gradients is None:
+            self._averaged_gradients = np.einsum('gkn,g->kn', self.gauss_point_gradients(),
+                                                 self.gauss_point_jacobians()[2])/self.volume()
+        return self._averaged_gradients
 
     def J(self, xi, eta, zeta):
-        return np.dot(self.d(xi, eta, zeta), self.xe)
+        i = self._gauss_point_index(xi, eta, zeta)
+        if i is None:
+            return np.dot(self.d(xi, eta, zeta), self.xe)
+        return self.gauss_point_jacobians()[0][i]
 
     def volume(self):
-        return np.sum([np.linalg.det(self.J(*gp)*w) for gp, w in zip(self.gauss_points, self.gauss_weights)])
+        # The determinant of J*w equals w**3*det(J)
+        return np.sum(self.gauss_point_jacobians()[2]*self.gauss_weights**3)
 
+    @classmethod
     @abc.abstractmethod
-    def d(self, xi, eta, zeta):
+    def d(cls, xi, eta, zeta):
         pass
 
     @abc.abstractmethod
@@ -34,8 +87,87 @@ class Element:
         pass
 
     def gp_volume(self, i):
-        gp = self.gauss_points[i, :]
-        return np.linalg.det(self.J(*gp))*self.gauss_weights[i]
+        return self.gauss_point_jacobians()[2][i]*self.gauss_weights[i]
+
+    @classmethod
+    def gauss_point_derivatives(cls):
+        """
+        Returns the derivatives of the shape functions at the Gauss points, tabulated once for each element class
+        :return:    n_gp x 3 x n_nodes array with the derivatives with respect to xi, eta and zeta
+        """
+        if cls.__dict__.get('_derivative_table') is None:
+            cls._derivative_table = np.array([cls.d(*gp) for gp in cls.gauss_points])
+        return cls._derivative_table
+
+    @classmethod
+    def batch_B(cls, xe):
+        """
+        Evaluates the B-matrices at the Gauss points for a batch of elements of this type at once
+        :param xe:  n_elem x n_nodes x 3 array with the nodal coordinates of the elements
+        :return:    n_elem x n_gp x 6 x dofs array with the B-matrices and n_elem x n_gp array with the Gauss point
+                    volumes
+        """
+        dx, volumes = cls.batch_gradients(xe)
+        return cls._batch_B(dx, volumes), volumes
+
+    @classmethod
+    def batch_gradients(cls, xe):
+        """
+        Evaluates the derivatives of the shape functions with respect to x, y and z at the Gauss points for a batch of
+        elements of this type at once
+        :param xe:  n_elem x n_nodes x 3 array with the nodal coordinates of the elements
+        :return:    n_elem x n_gp x 3 x n_nodes array with the derivatives and n_elem x n_gp array with the Gauss point
+                    volumes
+        """
+        d = cls.gauss_point_derivatives()
+        jacobian = np.einsum('gan,enb->egab', d, xe)
+        return np.matmul(np.linalg.inv(jacobian), d), np.linalg.det(jacobian)*cls.gauss_weights
+
+    @classmethod
+    def batch_strains(cls, dx, volumes, ue):
+        """
+        Evaluates the strains at the Gauss points for a batch of elements without forming the B-matrices
+        :param dx:      n_elem x n_gp x 3 x n_nodes array with the derivatives, see batch_gradients
+        :param volumes: n_elem x n_gp array with the Gauss point volumes
+        :param ue:      n_elem x n_nodes x 3 array with the nodal displacements
+        :return:        n_elem x n_gp x 6 array with the strains, the B-matrices times the displacements
+        """
+        # Displacement gradients, h[..., k, j] is the derivative of the displacement j with respect to the coordinate k
+        h = np.matmul(dx, ue[:, np.newaxis, :, :])
+        strains = np.zeros(h.shape[:2] + (6,))
+        for j in range(3):
+            strains[:, :, j] = h[:, :, j, j]
+        strains[:, :, 3] = h[:, :, 1, 0] + h[:, :, 0, 1]
+        strains[:, :, 4] = h[:, :, 2, 0] + h[:, :, 0, 2]
+        strains[:, :, 5] = h[:, :, 2, 1] + h[:, :, 1, 2]
+        return strains
+
+    @classmethod
+    def batch_strains_transpose(cls, dx, volumes, strains):
+        """
+        The transpose of batch_strains, evaluates the transposed B-matrices times strains, n_elem x n_gp x 6, as
+        n_elem x n_nodes x 3 nodal values without forming the B-matrices
+        """
+        t = np.zeros(strains.shape[:2] + (3, 3))
+        for j in range(3):
+            t[:, :, j, j] = strains[:, :, j]
+        t[:, :, 1, 0] = t[:, :, 0, 1] = strains[:, :, 3]
+        t[:, :, 2, 0] = t[:, :, 0, 2] = strains[:, :, 4]
+        t[:, :, 2, 1] = t[:, :, 1, 2] = strains[:, :, 5]
+        return np.einsum('egkn,egkj->enj', dx, t)
+
+    @classmethod
+    def _batch_B(cls, dx, volumes):
+        B = np.zeros(dx.shape[:2] + (6, dx.shape[3], 3))
+        for j in range(3):
+            B[:, :, j, :, j] = dx[:, :, j, :]
+        B[:, :, 3, :, 0] = dx[:, :, 1, :]
+        B[:, :, 3, :, 1] = dx[:, :, 0, :]
+        B[:, :, 4, :, 0] = dx[:, :, 2, :]
+        B[:, :, 4, :, 2] = dx[:, :, 0, :]
+        B[:, :, 5, :, 1] = dx[:, :, 2, :]
+        B[:, :, 5, :, 2] = dx[:, :, 1, :]
+        return B.reshape(dx.shape[:2] + (6, 3*dx.shape[3]))
 
 
 class C3D8(Element):
@@ -61,7 +193,8 @@ class C3D8(Element):
     def __init__(self, nodes):
         super(C3D8, self).__init__(nodes)
 
-    def d(self, xi, eta, zeta):
+    @classmethod
+    def d(cls, xi, eta, zeta):
         """
         Returns the a matrix 3x8 matrix with derivatives of the shape functions with respect to x y and z
         :param xi:     xi-coordinate
@@ -70,47 +203,72 @@ class C3D8(Element):
         :return:       3x8 matrix with derivatives
         """
 
+        x, y, z = cls.local_nodal_pos.T
         d_matrix = np.zeros((3, 8))
-        for i in range(8):
-            d_matrix[0, i] = (1. + eta*self.local_nodal_pos[i, 1]) * \
-                             (1. + zeta*self.local_nodal_pos[i, 2])*self.local_nodal_pos[i, 0]/8
-            d_matrix[1, i] = (1. + xi*self.local_nodal_pos[i, 0]) * \
-                             (1. + zeta*self.local_nodal_pos[i, 2])*self.local_nodal_pos[i, 1]/8
-            d_matrix[2, i] = (1. + xi*self.local_nodal_pos[i, 0]) * \
-                             (1. + eta*self.local_nodal_pos[i, 1])*self.local_nodal_pos[i, 2]/8
+        d_matrix[0, :] = (1. + eta*y)*(1. + zeta*z)*x/8
+        d_matrix[1, :] = (1. + xi*x)*(1. + zeta*z)*y/8
+        d_matrix[2, :] = (1. + xi*x)*(1. + eta*y)*z/8
         return d_matrix
 
     def B(self, xi, eta, zeta):
         B = np.zeros((6, 24))
-        jacobian = self.J(xi, eta, zeta)
-        d = self.d(xi, eta, zeta)
-        for i in range(8):
-            dx_avg = [np.linalg.solve(self.J(*gp), self.d(*gp)[:, i])*np.linalg.det(self.J(*gp))
-                      for gp in self.gauss_points]
-            dx_avg = sum(dx_avg)/self.volume()
-
-            for j in range(3):
-                for k in range(3):
-                    B[j, 3*i + k] += dx_avg[k]/3
-
-            dx = np.linalg.solve(jacobian, d[:, i])
-            for j in range(3):
-                for k in range(3):
-                    if j == k:
-                        B[j, 3*i + k] += 2*dx[k]/3
-                    else:
-                        B[j, 3*i + k] += -dx[k]/3
-
-            B[3, 3*i] += dx[1]
-            B[3, 3*i + 1] += dx[0]
-
-            B[4, 3*i] += dx[2]
-            B[4, 3*i + 2] += dx[0]
-
-            B[5, 3*i + 1] += dx[2]
-            B[5, 3*i + 2] += dx[1]
+        dx = self.gradients(xi, eta, zeta)
+        # The volumetric part of the strain is averaged over the element, the B-bar method
+        dx_avg = self.averaged_gradients()
+        for j in range(3):
+            for k in range(3):
+                B[j, k::3] += dx_avg[k]/3
+                if j == k:
+                    B[j, k::3] += 2*dx[k]/3
+                else:
+                    B[j, k::3] += -dx[k]/3
+
+        B[3, 0::3] += dx[1]
+        B[3, 1::3] += dx[0]
+
+        B[4, 0::3] += dx[2]
+        B[4, 2::3] += dx[0]
+
+        B[5, 1::3] += dx[2]
+        B[5, 2::3] += dx[1]
         return B
 
+    @classmethod
+    def batch_strains(cls, dx, volumes, ue):
+        # The volumetric part of the strain is replaced by its average over the element, the B-bar method, as in B
+        strains = super(C3D8, cls).batch_strains(dx, volumes, ue)
+        volumetric_strains = np.sum(strains[:, :, :3], axis=2)
+        average = np.sum(volumetric_strains*volumes, axis=1)/np.sum(volumes, axis=1)
+        strains[:, :, :3] += ((average[:, np.newaxis] - volumetric_strains)/3)[:, :, np.newaxis]
+        return strains
+
+    @classmethod
+    def batch_strains_transpose(cls, dx, volumes, strains):
+        # The transpose of the volumetric averaging in batch_strains
+        volumetric = np.sum(strains[:, :, :3], axis=2)/3
+        averaged = (np.sum(volumetric, axis=1)[:, np.newaxis]*volumes/np.sum(volumes, axis=1)[:, np.newaxis]
+                    - volumetric)
+        return super(C3D8, cls).batch_strains_transpose(dx, volumes,
+                                                        strains + (averaged[:, :, np.newaxis]*[1, 1, 1, 0, 0, 0]))
+
+    @classmethod
+    def _batch_B(cls, dx, volumes):
+        # The volumetric part of the strain is averaged over the element, the B-bar method, as in B
+        volume = np.sum(volumes, axis=1)
+        dx_avg = np.einsum('egkn,eg->ekn', dx, volumes)/volume[:, np.newaxis, np.newaxis]
+        B = np.zeros(dx.shape[:2] + (6, dx.shape[3], 3))
+        for j in range(3):
+            for k in range(3):
+                B[:, :, j, :, k] = dx_avg[:, np.newaxis, k, :]/3 - dx[:, :, k, :]/3
+            B[:, :, j, :, j] += dx[:, :, j, :]
+        B[:, :, 3, :, 0] = dx[:, :, 1, :]
+        B[:, :, 3, :, 1] = dx[:, :, 0, :]
+        B[:, :, 4, :, 0] = dx[:, :, 2, :]
+        B[:, :, 4, :, 2] = dx[:, :, 0, :]
+        B[:, :, 5, :, 1] = dx[:, :, 2, :]
+        B[:, :, 5, :, 2] = dx[:, :, 1, :]
+        return B.reshape(dx.shape[:2] + (6, 3*dx.shape[3]))
+
 
 class C3D20(Element):
     dofs = 60
@@ -150,54 +308,51 @@ class C3D20(Element):
     def __init__(self, nodes):
         super(C3D20, self).__init__(nodes)
 
-    def d(self, xi, eta, zeta):
+    @classmethod
+    def d(cls, xi, eta, zeta):
+        x, y, z = cls.local_nodal_pos.T
         d_matrix = np.zeros((3, 20))
-        for i in range(20):
-            x = self.local_nodal_pos[i, 0]
-            y = self.local_nodal_pos[i, 1]
-            z = self.local_nodal_pos[i, 2]
-            if i < 8:
-                d_matrix[0, i] = ((1 + eta*y)*(1 + zeta*z)*(xi*x + eta*y + zeta*z - 2)*x +
-                                  x*(1 + x*xi)*(1 + y*eta)*(1 + z*zeta))/8
-                d_matrix[1, i] = ((1 + xi*x)*(1 + zeta*z)*(xi*x + eta*y + zeta*z - 2)*y +
-                                  y*(1 + x*xi)*(1 + y*eta)*(1 + z*zeta))/8
-                d_matrix[2, i] = ((1. + xi*x)*(1 + eta*y)*(xi*x + eta*y + zeta*z - 2)*z +
-                                  z*(1 + x*xi)*(1 + y*eta)*(1 + z*zeta))/8
-
-            elif i in [8, 10, 12, 14]:
-                d_matrix[0, i] = -xi*(1 + y*eta)*(1 + z*zeta)/2
-                d_matrix[1, i] = y*(1 - xi**2)*(1 + z*zeta)/4
-                d_matrix[2, i] = z*(1 - xi**2)*(1 + y*eta)/4
-
-            elif i in [9, 11, 13, 15]:
-                d_matrix[0, i] = x*(1 - eta**2)*(1 + z*zeta)/4
-                d_matrix[1, i] = -eta*(1 + x*xi)*(1 + z*zeta)/2
-                d_matrix[2, i] = z*(1 - eta**2)*(1 + x*xi)/4
-
-            elif i > 15:
-                d_matrix[0, i] = x*(1 - zeta**2)*(1 + y*eta)/4
-                d_matrix[1, i] = y*(1 - zeta**2)*(1 + x*xi)/4
-                d_matrix[2, i] = -zeta*(1 + x*xi)*(1 + y*eta)/2
+        c = slice(0, 8)
+        s = xi*x[c] + eta*y[c] + zeta*z[c] - 2
+        d_matrix[0, c] = ((1 + eta*y[c])*(1 + zeta*z[c])*s*x[c] +
+                          x[c]*(1 + x[c]*xi)*(1 + y[c]*eta)*(1 + z[c]*zeta))/8
+        d_matrix[1, c] = ((1 + xi*x[c])*(1 + zeta*z[c])*s*y[c] +
+                          y[c]*(1 + x[c]*xi)*(1 + y[c]*eta)*(1 + z[c]*zeta))/8
+        d_matrix[2, c] = ((1. + xi*x[c])*(1 + eta*y[c])*s*z[c] +
+                          z[c]*(1 + x[c]*xi)*(1 + y[c]*eta)*(1 + z[c]*zeta))/8
+
+        # Mid-side nodes on the edges parallel to xi, eta and zeta
+        c = [8, 10, 12, 14]
+        d_matrix[0, c] = -xi*(1 + y[c]*eta)*(1 + z[c]*zeta)/2
+        d_matrix[1, c] = y[c]*(1 - xi**2)*(1 + z[c]*zeta)/4
+        d_matrix[2, c] = z[c]*(1 - xi**2)*(1 + y[c]*eta)/4
+
+        c = [9, 11, 13, 15]
+        d_matrix[0, c] = x[c]*(1 - eta**2)*(1 + z[c]*zeta)/4
+        d_matrix[1, c] = -eta*(1 + x[c]*xi)*(1 + z[c]*zeta)/2
+        d_matrix[2, c] = z[c]*(1 - eta**2)*(1 + x[c]*xi)/4
+
+        c = slice(16, 20)
+        d_matrix[0, c] = x[c]*(1 - zeta**2)*(1 + y[c]*eta)/4
+        d_matrix[1, c] = y[c]*(1 - zeta**2)*(1 + x[c]*xi)/4
+        d_matrix[2, c] = -zeta*(1 + x[c]*xi)*(1 + y[c]*eta)/2
         return d_matrix
 
     def B(self, xi, eta, zeta):
         B = np.zeros((6, 60))
-        jacobian = self.J(xi, eta, zeta)
-        d = self.d(xi, eta, zeta)
-        for i in range(20):
-            dx = np.linalg.solve(jacobian, d[:, i])
-            B[0, 3*i] = dx[0]
-            B[1, 3*i + 1] = dx[1]
-            B[2, 3*i + 2] = dx[2]
-
-            B[3, 3*i] = dx[1]
-            B[3, 3*i + 1] = dx[0]
-
-            B[4, 3*i] = dx[2]
-            B[4, 3*i + 2] = dx[0]
-
-            B[5, 3*i + 1] = dx[2]
-            B[5, 3*i + 2] = dx[1]
+        dx = self.gradients(xi, eta, zeta)
+        B[0, 0::3] = dx[0]
+        B[1, 1::3] = dx[1]
+        B[2, 2::3] = dx[2]
+
+        B[3, 0::3] = dx[1]
+        B[3, 1::3] = dx[0]
+
+        B[4, 0::3] = dx[2]
+        B[4, 2::3] = dx[0]
+
+        B[5, 1::3] = dx[2]
+        B[5, 2::3] = dx[1]
         return B
 
 
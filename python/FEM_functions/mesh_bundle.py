@@ -0,0 +1,90 @@
+from __future__ import print_function, division
+
+import os
+import shutil
+
+import numpy as np
+
+from FEM_functions.elements import C3D8, C3D20
+
+# The type of each element is stored as an index in this list
+element_classes = [C3D8, C3D20]
+
+array_names = ['node_labels', 'coordinates', 'element_labels', 'element_types', 'bc_dofs', 'bc_value_dofs',
+               'bc_values']
+
+
+def element_class_index(number_of_nodes):
+    for i, element_class in enumerate(element_classes):
+        if element_class.local_nodal_pos.shape[0] == number_of_nodes:
+            return i
+    raise ValueError("No element type with " + str(number_of_nodes) + " nodes")
+
+
+def write_mesh_bundle(directory, node_labels, coordinates, element_labels, element_types, connectivity, bc_dofs,
+                      bc_value_dofs, bc_values):
+    """
+    Writes the mesh for a deformation calculation as a directory of .npy files that can be memory mapped, see
+    read_mesh_bundle. Runs in the Python of Abaqus as well
+    :param node_labels:     labels of the nodes, the position of a label is the node number
+    :param coordinates:     n_nodes x 3 array with the coordinates of the nodes
+    :param element_labels:  labels of the elements in the order of their strain rows
+    :param element_types:   index of the type of each element in element_classes
+    :param connectivity:    dict with the n_elem x n_nodes array of node numbers of the elements of each type, keyed by
+                            the index of the type, with the elements in the order of element_labels
+    :param bc_dofs:         the degrees of freedom, 3*node number + component, with a boundary condition
+    :param bc_value_dofs:   the degrees of freedom with a prescribed value
+    :param bc_values:       the prescribed values
+    """
+    arrays = {'node_labels': np.asarray(node_labels, dtype=np.int32),
+              'coordinates': np.asarray(coordinates, dtype=np.float64).reshape(-1, 3),
+              'element_labels': np.asarray(element_labels, dtype=np.int32),
+              'element_types': np.asarray(element_types, dtype=np.int8),
+              'bc_dofs': np.asarray(bc_dofs, dtype=np.int32),
+              'bc_value_dofs': np.asarray(bc_value_dofs, dtype=np.int32),
+              'bc_values': np.asarray(bc_values, dtype=np.float64)}
+    for i, element_class in enumerate(element_classes):
+        if i in connectivity:
+            arrays[element_class.__name__ + '_connectivity'] = np.asarray(connectivity[i], dtype=np.int32).reshape(
+                -1, element_class.local_nodal_pos.shape[0])
+    # Written to a temporary directory first and renamed so that a bundle is never read before it is complete
+    temp_directory = directory + '.tmp'
+    if os.path.isdir(temp_directory):
+        shutil.rmtree(temp_directory)
+    os.makedirs(temp_directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_directory, name + '.npy'), array)
+    os.rename(temp_directory, directory)
+
+
+def read_mesh_bundle(directory, mmap_mode='r'):
+    """
+    Reads a mesh written by write_mesh_bundle, the arrays are memory mapped unless mmap_mode is None
+    :return:    dict with the arrays of write_mesh_bundle where connectivity is keyed by the element class
+    """
+    mesh = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in array_names}
+    mesh['connectivity'] = {}
+    for element_class in element_classes:
+        file_name = os.path.join(directory, element_class.__name__ + '_connectivity.npy')
+        if os.path.isfile(file_name):
+            mesh['connectivity'][element_class] = np.load(file_name, mmap_mode=mmap_mode)
+    return mesh
+
+
+def element_groups(mesh):
+    """
+    Returns the element class, the positions of the elements in the element order and the connectivity for each
+    element type in the mesh
+    """
+    return [(element_class, np.where(mesh['element_types'] == element_classes.index(element_class))[0], connectivity)
+            for element_class, connectivity in sorted(mesh['connectivity'].items(), key=lambda item: item[0].__name__)]
+
+
+def strain_rows(mesh):
+    """
+    Returns the first strain row of each element, the strain rows of an element are consecutive and the elements are
+    ordered as element_labels, and the total number of strain rows
+    """
+    element_rows = np.array([element_class.strains_components for element_class in element_classes],
+                            dtype=np.int64)[mesh['element_types']]
+    return np.cumsum(element_rows) - element_rows, int(np.sum(element_rows))
@@ -0,0 +1,131 @@
+from __future__ import print_function, division
+
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+from FEM_functions import elements as element_types
+from FEM_functions.mesh_bundle import element_groups, strain_rows
+
+
+class StrainDisplacementOperator(LinearOperator):
+    """
+    The global strain-displacement matrix B applied element by element without being assembled. For each element
+    only the node numbers, the derivatives of the shape functions at the Gauss points and the Gauss point volumes are
+    stored, see Element.batch_gradients, which for C3D20 elements takes about a twentieth of the memory of the
+    assembled matrix. The strain rows of each element are stored consecutively as in the assembled matrix and the
+    columns are the three displacement components of each node
+    """
+    def __init__(self, strain_components, displacement_components, batch_size=1000):
+        super(StrainDisplacementOperator, self).__init__(dtype=np.float64,
+                                                         shape=(strain_components, displacement_components))
+        self.batch_size = batch_size
+        self.groups = []
+
+    @classmethod
+    def from_mesh(cls, mesh, batch_size=1000):
+        """
+        Creates the operator for a mesh read with read_mesh_bundle, see FEM_functions.mesh_bundle
+        """
+        first_rows, strain_components = strain_rows(mesh)
+        operator = cls(strain_components, 3*mesh['node_labels'].shape[0], batch_size)
+        for element_class, positions, connectivity in element_groups(mesh):
+            operator.add_elements(element_class, first_rows[positions], connectivity, mesh['coordinates'])
+        return operator
+
+    def add_elements(self, element_class, first_rows, connectivity, coordinates):
+        """
+        Adds elements of the same type
+        :param element_class:   the element type, for instance C3D8
+        :param first_rows:      array with the first strain row of each element
+        :param connectivity:    n_elem x n_nodes array with the node numbers of the elements
+        :param coordinates:     n_nodes x 3 array with the coordinates of the nodes
+        """
+        connectivity = np.array(connectivity, dtype=np.int32)
+        gradients = np.zeros((connectivity.shape[0], element_class.gauss_points.shape[0], 3, connectivity.shape[1]))
+        volumes = np.zeros((connectivity.shape[0], element_class.gauss_points.shape[0]))
+        for i in range(0, connectivity.shape[0], self.batch_size):
+            gradients[i:i + self.batch_size], volumes[i:i + self.batch_size] = \
+                element_class.batch_gradients(coordinates[connectivity[i:i + self.batch_size]])
+        self.groups.append({'element_class': element_class, 'first_rows': np.asarray(first_rows, dtype=np.int64),
+                            'connectivity': connectivity, 'gradients': gradients, 'volumes': volumes})
+
+    def _batches(self):
+        for group in self.groups:
+            for i in range(0, group['first_rows'].shape[0], self.batch_size):
+                batch = slice(i, i + self.batch_size)
+                gps = group['volumes'].shape[1]
+                rows = group['first_rows'][batch, np.newaxis] + np.arange(6*gps)
+                yield (group['element_class'], rows, group['connectivity'][batch], group['gradients'][batch],
+                       group['volumes'][batch])
+
+    def _matvec(self, x):
+        nodal_values = np.ravel(x).reshape(-1, 3)
+        y = np.zeros(self.shape[0])
+        for element_class, rows, connectivity, gradients, volumes in self._batches():
+            strains = element_class.batch_strains(gradients, volumes, nodal_values[connectivity])
+            y[rows] = strains.reshape(rows.shape)
+        return y
+
+    def _rmatvec(self, y):
+        y = np.ravel(y)
+        x = np.zeros(self.shape[1])
+        for element_class, rows, connectivity, gradients, volumes in self._batches():
+            nodal_values = element_class.batch_strains_transpose(gradients, volumes,
+                                                                 y[rows].reshape(volumes.shape + (6,)))
+            dofs = 3*connectivity[:, :, np.newaxis] + np.arange(3)
+            x += np.bincount(dofs.ravel(), weights=nodal_values.ravel(), minlength=self.shape[1])
+        return x
+
+    def gauss_point_volumes(self):
+        # The volume of the Gauss point of each strain row
+        gauss_point_volumes = np.zeros(self.shape[0])
+        for _, rows, _, _, volumes in self._batches():
+            gauss_point_volumes[rows] = np.repeat(volumes, 6, axis=1)
+        return gauss_point_volumes
+
+    def normal_blocks(self, row_weights):
+        """
+        Computes the 3 x 3 diagonal blocks of the normal matrix (W B)^T W B for the displacement components of each
+        node where W is a diagonal matrix with the row weights. The diagonals of the blocks are the squared norms of
+        the columns of W B
+        :return:    n_nodes x 3 x 3 array with the blocks
+        """
+        blocks = np.zeros((self.shape[1]//3, 3, 3))
+        for element_class, rows, connectivity, gradients, volumes in self._batches():
+            weighted_b = element_class._batch_B(gradients, volumes).reshape(rows.shape + (-1, 3))
+            weighted_b *= row_weights[rows][:, :, np.newaxis, np.newaxis]
+            element_blocks = np.einsum('erna,ernb->enab', weighted_b, weighted_b)
+            for a in range(3):
+                for b in range(3):
+                    blocks[:, a, b] += np.bincount(connectivity.ravel(), weights=element_blocks[:, :, a, b].ravel(),
+                                                   minlength=blocks.shape[0])
+        return blocks
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for group in self.groups for name, array in group.items() if name != 'element_class')
+
+    @property
+    def number_of_elements(self):
+        return sum(group['first_rows'].shape[0] for group in self.groups)
+
+    def to_arrays(self):
+        # The stored data as a dict of arrays, see save_arrays in checkpoints
+        arrays = {'shape': np.array(self.shape)}
+        for group in self.groups:
+            for name, array in group.items():
+                if name != 'element_class':
+                    arrays[group['element_class'].__name__ + '_' + name] = array
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, batch_size=1000):
+        operator = cls(int(arrays['shape'][0]), int(arrays['shape'][1]), batch_size=batch_size)
+        for name in sorted(arrays):
+            if name.endswith('_first_rows'):
+                class_name = name[:-len('_first_rows')]
+                group = {key: arrays[class_name + '_' + key]
+                         for key in ['first_rows', 'connectivity', 'gradients', 'volumes']}
+                group['element_class'] = getattr(element_types, class_name)
+                operator.groups.append(group)
+        return operator
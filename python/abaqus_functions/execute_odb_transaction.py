@@ -0,0 +1,107 @@
+from __future__ import print_function, division
+import odbAccess
+
+from abaqusConstants import CENTROID, ELEMENT_NODAL, INTEGRATION_POINT, NODAL
+from abaqusConstants import SCALAR, TENSOR_3D_FULL, TIME, VECTOR
+
+import pickle
+import sys
+
+import numpy as np
+
+positions = {'INTEGRATION_POINT': INTEGRATION_POINT, 'NODAL': NODAL, 'ELEMENT_NODAL': ELEMENT_NODAL,
+             'CENTROID': CENTROID}
+field_types = {1: SCALAR, 3: VECTOR, 6: TENSOR_3D_FULL}
+
+
+def get_instance(odb, instance_name):
+    if not instance_name:
+        return odb.rootAssembly.instances[odb.rootAssembly.instances.keys()[0]]
+    return odb.rootAssembly.instances[instance_name]
+
+
+def get_set(odb, instance, set_name, position):
+    # Looking for the set in the instance first and then in the assembly
+    sets = instance.nodeSets if position == 'NODAL' else instance.elementSets
+    if set_name in sets.keys():
+        return sets[set_name]
+    if position == 'NODAL':
+        return odb.rootAssembly.nodeSets[set_name]
+    return odb.rootAssembly.elementSets[set_name]
+
+
+def get_labels(region, instance, position):
+    members = region.nodes if position == 'NODAL' else region.elements
+    if len(members) == 0 or hasattr(members[0], 'label'):
+        return [member.label for member in members]
+    # Assembly sets hold one sequence of members for each instance
+    return [member.label for instance_members in members for member in instance_members
+            if member.instanceName == instance.name]
+
+
+def read_field(odb, operation):
+    instance = get_instance(odb, operation['instance_name'])
+    field = odb.steps[operation['step_name']].frames[operation['frame_number']].fieldOutputs[operation['field_id']]
+    if operation['set_name']:
+        field = field.getSubset(region=get_set(odb, instance, operation['set_name'], operation['position']))
+    field = field.getSubset(position=positions[operation['position']])
+    return np.concatenate([np.array(block.data) for block in field.bulkDataBlocks])
+
+
+def load_data(operation):
+    # Data written from a memory mapped array is read from its region of the original file
+    if 'offset' in operation:
+        return np.memmap(operation['data_file'], dtype=np.dtype(operation['dtype']), mode='r',
+                         offset=operation['offset'], shape=tuple(operation['shape']))
+    return np.load(operation['data_file'])
+
+
+def get_frame(odb, step_name, frame_number):
+    if step_name not in odb.steps.keys():
+        odb.Step(name=step_name, description='', domain=TIME, timePeriod=1.)
+    step = odb.steps[step_name]
+    if frame_number < 0:
+        frame_number = max(len(step.frames) + frame_number, 0)
+    while len(step.frames) <= frame_number:
+        step.Frame(incrementNumber=len(step.frames), frameValue=float(len(step.frames)), description='')
+    return step.frames[frame_number]
+
+
+def write_field(odb, operation, data):
+    instance = get_instance(odb, operation['instance_name'])
+    frame = get_frame(odb, operation['step_name'], operation['frame_number'])
+    if len(data.shape) == 1:
+        data = data.reshape((data.shape[0], 1))
+    field_id = operation['field_id']
+    if field_id in frame.fieldOutputs.keys():
+        field = frame.fieldOutputs[field_id]
+    else:
+        field = frame.FieldOutput(name=field_id, description=field_id, type=field_types[data.shape[1]])
+
+    region = instance if not operation['set_name'] else get_set(odb, instance, operation['set_name'],
+                                                               operation['position'])
+    # Element based data holds one row per integration point, or element node, for each element in the region
+    labels = get_labels(region, instance, operation['position'])
+    field.addData(position=positions[operation['position']], instance=instance, labels=labels,
+                  data=tuple(tuple(row) for row in data))
+
+
+if __name__ == '__main__':
+    operation_pickle_file = sys.argv[-1]
+    with open(operation_pickle_file, 'rb') as operation_pickle:
+        transaction = pickle.load(operation_pickle)
+    operations = transaction['operations']
+    for operation in operations:
+        for key, value in operation.items():
+            if isinstance(value, basestring):
+                operation[key] = str(value)
+    writes = [operation for operation in operations if operation['type'] == 'write']
+    odb = odbAccess.openOdb(str(transaction['odb_file_name']), readOnly=not writes)
+    for operation in operations:
+        if operation['type'] == 'read':
+            np.save(operation['data_file'], read_field(odb, operation))
+        else:
+            write_field(odb, operation, load_data(operation))
+    if writes:
+        odb.save()
+    odb.close()
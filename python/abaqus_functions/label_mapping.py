@@ -0,0 +1,59 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+
+def label_indices(labels, query_labels, missing=-1):
+    """
+    Returns the position in labels of each of the query labels, the first position if a label occurs several times,
+    as np.where(labels == label)[0][0] for each label but for all labels at once using a sorted index, which takes
+    O((n + m) log n) time instead of O(n m). Runs in the Python of Abaqus as well
+    :param labels:          array with n labels, for instance the node labels of the strain set
+    :param query_labels:    array with m labels to look up
+    :param missing:         value returned for the labels not found in labels, a KeyError is raised for them if None
+    :return:                integer array with the positions, with the shape of query_labels
+    """
+    labels = np.asarray(labels).ravel()
+    query_labels = np.asarray(query_labels)
+    # A stable sort keeps the first occurrence of a repeated label first
+    order = np.argsort(labels, kind='mergesort')
+    sorted_labels = labels[order]
+    positions = np.searchsorted(sorted_labels, query_labels.ravel())
+    positions = np.minimum(positions, max(labels.shape[0] - 1, 0))
+    if labels.shape[0]:
+        found = sorted_labels[positions] == query_labels.ravel()
+        indices = order[positions]
+    else:
+        found = np.zeros(query_labels.size, dtype=bool)
+        indices = np.zeros(query_labels.size, dtype=int)
+    if missing is None:
+        if not np.all(found):
+            raise KeyError("Labels not found: " + str(query_labels.ravel()[np.logical_not(found)][:10].tolist()))
+    else:
+        indices = np.where(found, indices, missing)
+    return indices.reshape(query_labels.shape)
+
+
+def main():
+    # Checks label_indices against np.where for sorted and unsorted labels with repeated and missing labels
+    random = np.random.RandomState(0)
+    for labels in [np.arange(1, 101), random.permutation(np.arange(1000, 2000, 3)),
+                   random.randint(1, 50, size=80), np.array([], dtype=int)]:
+        query_labels = np.concatenate([labels[:20], random.randint(-10, 2100, size=50), [0, -1]])
+        expected = np.array([np.where(labels == label)[0][0] if np.any(labels == label) else -1
+                             for label in query_labels])
+        assert np.array_equal(label_indices(labels, query_labels), expected)
+        assert np.array_equal(label_indices(labels, query_labels.reshape(-1, 2)), expected.reshape(-1, 2))
+        if labels.shape[0]:
+            assert np.array_equal(label_indices(labels, labels[:20], missing=None), expected[:20])
+        if np.any(expected == -1):
+            try:
+                label_indices(labels, query_labels, missing=None)
+                raise AssertionError("A KeyError should be raised for missing labels")
+            except KeyError:
+                pass
+    print("label_indices agrees with np.where")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,21 +3,21 @@ import odbAccess
 
 from abaqusConstants import ELEMENT_NODAL
 
-from collections import namedtuple
 import pickle
 import sys
 
 import numpy as np
 
+from label_mapping import label_indices
 from odb_io_functions import read_field_from_odb
 from utilities import BoundaryCondition
 sys.path.append('..')
-from FEM_functions.elements import C3D8, C3D20
+from FEM_functions.mesh_bundle import element_class_index, write_mesh_bundle
 
 
 if __name__ == '__main__':
     settings_pickle_file = sys.argv[-2]
-    results_pickle_file = sys.argv[-1]
+    mesh_directory = sys.argv[-1]
     with open(settings_pickle_file, 'rb') as settings_pickle:
         data = pickle.load(settings_pickle)
     par = data['parameter_dict']
@@ -46,7 +46,6 @@ if __name__ == '__main__':
         instance = results_odb.rootAssembly.instances[results_odb.rootAssembly.instances.keys()[0]]
     else:
         instance = results_odb.rootAssembly.instances[instance_name]
-    nodal_displacements = np.zeros(len(node_labels)*3)
     bc_dofs = []
     bc_vals_dict = {}
 
@@ -58,52 +57,35 @@ if __name__ == '__main__':
         else:
             raise ValueError("type attribute of BoundaryCondition must either be \"surface\" or \"node_set\"")
         nodes = base.nodes
-        for n in nodes:
-            idx = np.where(node_labels == n.label)[0]
-            if len(idx):
-                bc_dofs.append(3*idx[0] + bc.component - 1)
+        # Nodes outside the strain set are skipped
+        idx = label_indices(node_labels, [n.label for n in nodes])
+        bc_dofs.extend(3*idx[idx >= 0] + bc.component - 1)
         if bc.values is not None:
-            for node_label, value in bc.values.items():
-                idx = np.where(node_labels == node_label)[0]
-                if idx:
-                    dof = 3*idx[0] + bc.component - 1
-                    bc_vals_dict[dof] = value
+            value_labels = list(bc.values.keys())
+            for node_label, i in zip(value_labels, label_indices(node_labels, value_labels)):
+                if i >= 0:
+                    bc_vals_dict[3*i + bc.component - 1] = bc.values[node_label]
 
     bc_dofs = np.unique(np.array(bc_dofs))
-    elements = []
     instance_elements = {}
-    instance_nodes = {}
     for e in instance.elements:
         instance_elements[e.label] = e
-    for n in instance.nodes:
-        instance_nodes[n.label] = n
+    instance_nodes = instance.nodes
+    coordinates = np.array([n.coordinates for n in instance_nodes], dtype=float)[
+        label_indices([n.label for n in instance_nodes], node_labels, missing=None)]
 
-    Node = namedtuple('Node', ['label', 'coordinates'])
-    strain_components = 0
-    displacement_components = nodal_displacements.shape[0]
-    b_components = 0
-    for e_label in np.unique(element_labels):
+    # The node numbers of the elements of each type, with the elements in the order of their labels
+    element_labels = np.unique(element_labels)
+    element_types = np.zeros(len(element_labels), dtype=int)
+    connectivity = {}
+    for i, e_label in enumerate(element_labels):
         element = instance_elements[e_label]
+        element_types[i] = element_class_index(len(element.connectivity))
+        connectivity.setdefault(int(element_types[i]), []).append(element.connectivity)
+    # All element nodes are in the strain set as the node labels are taken from the element nodal strains
+    for element_type, element_connectivity in connectivity.items():
+        connectivity[element_type] = label_indices(node_labels, np.array(element_connectivity), missing=None)
 
-        abaqus_element_nodes = [instance_nodes[n] for n in element.connectivity]
-        element_nodes = []
-        for abaqus_node in abaqus_element_nodes:
-            idx = np.where(node_labels == abaqus_node.label)[0][0]
-            element_nodes.append(Node(label=idx, coordinates=abaqus_node.coordinates))
-        element_class = None
-        if len(element_nodes) == 8:
-            element_class = C3D8
-            b_components += 8*6*24
-            strain_components += 8*6
-        elif len(element_nodes) == 20:
-            element_class = C3D20
-            b_components += 27*6*60
-            strain_components += 27*6
-        elements.append(element_class(element_nodes))
-
-    with open(results_pickle_file, 'wb') as results_pickle:
-        pickle.dump({'elements': elements, 'bc_dofs': bc_dofs, 'bc_vals_dict': bc_vals_dict,
-                     'nodal_displacements': nodal_displacements, 'node_labels': node_labels,
-                     'strain_components': strain_components, 'displacement_components': displacement_components,
-                     'b_components': b_components},
-                    results_pickle)
+    bc_value_dofs = sorted(bc_vals_dict.keys())
+    write_mesh_bundle(mesh_directory, node_labels, coordinates, element_labels, element_types, connectivity, bc_dofs,
+                      bc_value_dofs, [bc_vals_dict[dof] for dof in bc_value_dofs])
@@ -1,16 +1,29 @@
 from __future__ import print_function, division
 
+from collections import OrderedDict, namedtuple
+import hashlib
+import itertools
+import multiprocessing
 import os
+import time
+
 import numpy as np
 
 from abaqus_python_interface import ABQInterface
-from multiprocesser import multiprocesser
-
+from checkpoints import RunDirectory, load_array, save_array
 from deformation_calculator import DeformationCalculator
+from gauss_point_scheduler import evaluate_gauss_points
+import instrumentation
 from material_model.model_parameters import get_parameters
-from material_model.material_model import MaterialModel
+from material_model.material_model import MaterialModel, get_friction_table, stress_invariants
+from material_model.response_surface import get_response_surface
+from odb_cache import CachedABQInterface, CachedOdbBackend, OdbFieldCache
+from odb_transaction import AbaqusOdbBackend, OdbTransaction
 
-abq = ABQInterface("abq2018", output=True)
+# The fields read from the odbs are cached on disk, see odb_cache
+odb_cache = OdbFieldCache()
+abq = CachedABQInterface(ABQInterface("abq2018", output=True), odb_cache)
+odb_backend = CachedOdbBackend(AbaqusOdbBackend(abq), odb_cache)
 
 
 class BoundaryCondition(object):
@@ -21,29 +34,151 @@ class BoundaryCondition(object):
         self.values = values
 
 
-def evaluate_permanent_strain_for_gp(material_parameters, cycles, static_stress_state, cyclic_stress_state):
+class StressState(object):
+    def __init__(self, instance_name, element_set_name, static_stresses, cyclic_stresses, shares=None):
+        self.instance_name = instance_name
+        self.element_set_name = element_set_name
+        self.static_stresses = static_stresses
+        self.cyclic_stresses = cyclic_stresses
+        self.shares = shares
+
+
+boundary_conditions = [BoundaryCondition('X1_NODES', 'node_set', 1),
+                       BoundaryCondition('ballast_bottom_nodes', 'node_set', 2),
+                       BoundaryCondition('X_SYM_NODES', 'node_set', 1),
+                       BoundaryCondition('Z_SYM_NODES', 'node_set', 3),
+                       BoundaryCondition('Z1_NODES', 'node_set', 3)]
+
+
+def create_material_model(material_parameters, use_friction_table=False, response_surface=None):
+    friction_table = None
+    if use_friction_table:
+        friction_table = get_friction_table(abs(material_parameters[0]))
+    return MaterialModel(material_parameters, friction_table=friction_table, response_surface=response_surface)
+
+
+def evaluate_permanent_strain_for_gp(material_parameters, cycles, static_stress_state, cyclic_stress_state,
+                                     batch_size=1000, use_friction_table=False, response_surface=None,
+                                     resolution=None, initial_state=None, shares=None, frictional_strains=None):
+    # With a load spectrum, shares is given and cyclic_stress_state is a k x n x 6 array with one cyclic stress field
+    # per load. The effective frictional strains of the points, len(cycles) x n, taken from the representative states
+    # of a quantization of all points, see quantize_frictional_strains, are given by frictional_strains
     n = static_stress_state.shape[0]
     permanent_strain = np.zeros((len(cycles), n, static_stress_state.shape[1]))
-    for i in range(n):
-        model = MaterialModel(material_parameters)
-        permanent_strain[:, i, :] = model.update(cycles, cyclic_stress_state[i, :], static_stress_state[i, :])
-        if i % 1000 == 0:
-            print("Evaluated {i} out of {n} points".format(i=i, n=n))
+    state = np.zeros((2 if shares is None else 7, n))
+    model = create_material_model(material_parameters, use_friction_table, response_surface)
+    if frictional_strains is not None:
+        permanent_strain[:, :, :] = model.update_batch(cycles, cyclic_stress_state, static_stress_state,
+                                                       effective_frictional_strain=frictional_strains)
+        state[:, :] = model.state
+    elif resolution is not None and initial_state is None and shares is None:
+        # Only the unique states are integrated, making batching unnecessary
+        permanent_strain[:, :, :] = model.update_batch(cycles, cyclic_stress_state, static_stress_state,
+                                                       resolution=resolution)
+        state[:, :] = model.state
+        print("Evaluated {n} points using {u} unique states, maximum error in effective frictional strain {e}".format(
+            n=n, u=model.unique_states, e=model.quantization_error))
+    else:
+        # The points are integrated in batches to keep the step size control of the stacked system local
+        for i in range(0, n, batch_size):
+            batch_state = None if initial_state is None else initial_state[:, i:i + batch_size]
+            if shares is None:
+                permanent_strain[:, i:i + batch_size, :] = model.update_batch(cycles,
+                                                                              cyclic_stress_state[i:i + batch_size, :],
+                                                                              static_stress_state[i:i + batch_size, :],
+                                                                              initial_state=batch_state)
+            else:
+                permanent_strain[:, i:i + batch_size, :] = model.update_spectrum(
+                    cycles, cyclic_stress_state[:, i:i + batch_size, :], static_stress_state[i:i + batch_size, :],
+                    shares, initial_state=batch_state)
+            state[:, i:i + batch_size] = model.state
+            print("Evaluated {i} out of {n} points".format(i=min(i + batch_size, n), n=n))
     permanent_strain[:, :, 3:] *= 2
-    return permanent_strain
+    return permanent_strain, state
 
 
-def calculate_permanent_deformations(stress_odb_file_name, strain_odb_file_name, cycles, material_parameters):
-    try:
-        len(cycles)
-    except TypeError:
-        cycles = np.array(cycles)
-    cycles = np.array(cycles)
+def frictional_loads(model, static_stresses, cyclic_stresses, chunk_size=None):
+    # The loads q/g of the points, computed chunk_size points at a time, all at once if not given, so that memory
+    # mapped stresses are not brought into memory at once
+    n = static_stresses.shape[0]
+    load = np.zeros(n)
+    for start in range(0, n, chunk_size or max(n, 1)):
+        stop = min(start + (chunk_size or n), n)
+        p0, _, q, _ = stress_invariants(np.asarray(cyclic_stresses[start:stop]),
+                                        np.asarray(static_stresses[start:stop]))
+        load[start:stop] = model.frictional_load(p0, q)
+    return load
 
-    if not os.path.isfile(strain_odb_file_name):
-        print("Creating odb", strain_odb_file_name)
-        abq.create_empty_odb_from_odb(strain_odb_file_name, stress_odb_file_name)
 
+def quantize_frictional_strains(material_parameters, cycles, static_stresses, cyclic_stresses, resolution,
+                                use_friction_table=False, response_surface=None, chunk_size=None):
+    """
+    Evaluates the effective frictional strain for the representative loads q/g of all points after rounding the loads
+    to the resolution, see MaterialModel.quantized_frictional_states, so that points sharing a load are evaluated once
+    even when they are dispatched in different chunks. The loads are computed chunk_size points at a time, all at once
+    if not given
+    :return:    len(cycles) x m array with the effective frictional strain of the m representatives and an array with
+                the index of the representative of each point
+    """
+    model = create_material_model(material_parameters, use_friction_table, response_surface)
+    load = frictional_loads(model, static_stresses, cyclic_stresses, chunk_size)
+    frictional_strains, index = model.quantized_frictional_states(cycles, load, resolution)
+    print("Evaluating {n} points using {u} unique states, maximum error in effective frictional strain {e}".format(
+        n=load.shape[0], u=model.unique_states, e=model.quantization_error))
+    instrumentation.observe('quantization_unique_states', model.unique_states)
+    instrumentation.observe('quantization_error', model.quantization_error)
+    return frictional_strains, index
+
+
+def frictional_strain_kwargs(frictional_strains, index):
+    # point_kwargs for evaluate_gauss_points giving each chunk the effective frictional strains of its points, taken
+    # from the representatives in the calling process so that only the columns of the chunk are sent to the workers
+    if frictional_strains is None:
+        return None
+    return {'frictional_strains': lambda indices: frictional_strains[:, index[indices]]}
+
+
+def evaluate_permanent_strains(material_parameters, cycles, static_stresses, cyclic_stresses, permanent_strains, state,
+                               initial_state=None, num_cpus=None, **kwargs):
+    """
+    Evaluates the permanent strains for the points in static_stresses using num_cpus worker processes, all cores if
+    not given, and stores the result in permanent_strains, len(cycles) x n x 6, and the material state in state, which
+    can be views into larger, possibly memory mapped, arrays. The points are dispatched dynamically in small chunks
+    ordered by their estimated cost, see gauss_point_scheduler. The keyword arguments are passed to
+    evaluate_gauss_points, for instance the backend and the checkpoint_directory, and to
+    evaluate_permanent_strain_for_gp
+    """
+    evaluate_gauss_points(evaluate_permanent_strain_for_gp, material_parameters, cycles, static_stresses,
+                          cyclic_stresses, permanent_strains, state, initial_state, cpus=num_cpus, **kwargs)
+
+
+def store_array(array, file_name):
+    # Moves an array to disk and returns it memory mapped, read only
+    np.save(file_name, array)
+    return np.load(file_name, mmap_mode='r')
+
+
+def read_stresses(stress_odb_file_name, element_set_name, instance_name):
+    # Reading the static and loading stresses, in Pa, in one odb session. The fields are memory mapped from the odb
+    # cache, see odb_cache
+    with OdbTransaction(stress_odb_file_name, odb_backend) as transaction:
+        static_stresses = transaction.read('S', step_name='gravity', set_name=element_set_name,
+                                           instance_name=instance_name)
+        loading_stresses = transaction.read('S', step_name='loading', set_name=element_set_name,
+                                            instance_name=instance_name)
+    return static_stresses.data, loading_stresses.data
+
+
+def read_stress_state(stress_odb_file_name, load_spectrum=None, store_directory=None, chunk_size=None):
+    """
+    Reads the static and cyclic stresses, in kPa, of the ballast elements from a stress odb, see
+    calculate_permanent_deformations for the load spectrum
+    :param store_directory: if given, the stresses are converted chunk_size points at a time into
+                            static_stresses.npy and cyclic_stresses.npy in this directory and returned memory mapped,
+                            so that the stresses are never held in memory
+    :param chunk_size:      number of points converted at a time, all points at once if not given
+    :return:                StressState with the stresses
+    """
     # finding the ballast element set name assuming that the model only contains one instance
     odb_dict = abq.get_odb_as_dict(stress_odb_file_name)
     instance_name, instance_data = next(iter(odb_dict['rootAssembly']['instances'].items()))
@@ -54,66 +189,391 @@ def calculate_permanent_deformations(stress_odb_file_name, strain_odb_file_name,
             break
     print("Performing calculations on the element set", element_set_name)
     print("Reading stress states from", stress_odb_file_name)
-    static_stresses = abq.read_data_from_odb('S', stress_odb_file_name, step_name='gravity', set_name=element_set_name,
-                                             instance_name=instance_name)/1e3
-    loading_stresses = abq.read_data_from_odb('S', stress_odb_file_name, step_name='loading', set_name=element_set_name,
-                                              instance_name=instance_name)/1e3
-    cyclic_stresses = loading_stresses - static_stresses
-    print(np.min(static_stresses[:, 1]))
-    print(np.min(loading_stresses[:, 1]))
+    static_stresses, loading_stresses = read_stresses(stress_odb_file_name, element_set_name, instance_name)
+    print(np.min(static_stresses[:, 1])/1e3)
+    print(np.min(loading_stresses[:, 1])/1e3)
+    loads = [(static_stresses, loading_stresses)]
+    shares = None
+    if load_spectrum is not None:
+        loads = []
+        for spectrum_odb_file_name, _ in load_spectrum:
+            print("Reading cyclic stresses from", spectrum_odb_file_name)
+            loads.append(read_stresses(spectrum_odb_file_name, element_set_name, instance_name))
+        shares = np.array([share for _, share in load_spectrum], dtype=float)
+
+    n = static_stresses.shape[0]
+    dtype = (static_stresses[:0]/1e3).dtype
+    cyclic_shape = (len(loads),) + static_stresses.shape
+    if store_directory is None:
+        stored_static_stresses = np.zeros(static_stresses.shape, dtype=dtype)
+        stored_cyclic_stresses = np.zeros(cyclic_shape, dtype=dtype)
+    else:
+        if not os.path.isdir(store_directory):
+            os.makedirs(store_directory)
+        print("Storing the stresses in", store_directory)
+        stored_static_stresses = np.lib.format.open_memmap(os.path.join(store_directory, 'static_stresses.npy'),
+                                                           mode='w+', dtype=dtype, shape=static_stresses.shape)
+        stored_cyclic_stresses = np.lib.format.open_memmap(os.path.join(store_directory, 'cyclic_stresses.npy'),
+                                                           mode='w+', dtype=dtype, shape=cyclic_shape)
+    for start in range(0, n, chunk_size or max(n, 1)):
+        stop = min(start + (chunk_size or n), n)
+        stored_static_stresses[start:stop] = static_stresses[start:stop]/1e3
+        for i, (load_static_stresses, load_loading_stresses) in enumerate(loads):
+            stored_cyclic_stresses[i, start:stop] = (load_loading_stresses[start:stop]/1e3
+                                                     - load_static_stresses[start:stop]/1e3)
+    if store_directory is not None:
+        stored_static_stresses.flush()
+        stored_cyclic_stresses.flush()
+        stored_static_stresses = np.load(os.path.join(store_directory, 'static_stresses.npy'), mmap_mode='r')
+        stored_cyclic_stresses = np.load(os.path.join(store_directory, 'cyclic_stresses.npy'), mmap_mode='r')
+    if load_spectrum is None:
+        stored_cyclic_stresses = stored_cyclic_stresses[0]
+    return StressState(instance_name, element_set_name, stored_static_stresses, stored_cyclic_stresses, shares)
+
+
+def gauss_point_state_file_name(stress_odb_file_name, strain_odb_file_name, material_parameters, element_set_name,
+                                load_spectrum=None):
+    key = (os.path.abspath(stress_odb_file_name) + element_set_name).encode()
+    key += np.asarray(material_parameters, dtype=float).tobytes()
+    if load_spectrum is not None:
+        for spectrum_odb_file_name, share in load_spectrum:
+            key += os.path.abspath(spectrum_odb_file_name).encode() + np.asarray(share, dtype=float).tobytes()
+    return (os.path.splitext(strain_odb_file_name)[0] + '_gp_state_' + hashlib.sha1(key).hexdigest()[:16]
+            + '.npz')
+
+
+def calculate_permanent_deformations(stress_odb_file_name, strain_odb_file_name, cycles, material_parameters,
+                                     use_friction_table=False, response_surface_tolerance=None,
+                                     quantization_resolution=None, load_spectrum=None, chunk_size=None,
+                                     num_cpus=None, stress_state=None, calculator=None, backend=None,
+                                     report_file_name=None, prometheus_file_name=None, run_directory=None,
+                                     solver='lsqr', matrix_free=False, solver_cache=True):
+    """
+    Evaluates the permanent strains at the given cycle numbers and the resulting permanent deformations and writes
+    them to the strain odb
+    :param load_spectrum:   list of (stress_odb_file_name, share) for mixed traffic where each odb gives the cyclic
+                            stresses of one load and the share is its fraction of the cycles. The static stresses are
+                            read from stress_odb_file_name. The friction table, the response surface and the
+                            quantization only apply to a single load and are not used with a load spectrum
+    :param chunk_size:      if given, the stresses are kept memory mapped on disk and the points are evaluated chunk
+                            by chunk, with chunk_size points at a time, and the permanent strains are written to an
+                            on-disk store, <strain odb>_store/permanent_strains.npy, as each chunk completes. The
+                            displacements are then solved and checkpointed one step at a time and all steps are
+                            written to the odb from the files on disk. The memory use of the evaluation is then
+                            bounded by the chunk size, and the one of the deformations by a single step, instead of
+                            the mesh size times the number of cycles
+    :param num_cpus:        number of processes evaluating the permanent strains, all cores if not given
+    :param stress_state:    StressState from read_stress_state, read from the stress odb if not given
+    :param calculator:      DeformationCalculator for the mesh, created from the strain odb if not given
+    :param backend:         execution backend for the Gauss point chunks and the element batches of the B-matrix,
+                            see execution_backends, the Gauss points are evaluated using num_cpus local processes and
+                            the elements using multiprocesser if not given
+    :param report_file_name:    JSON file where the timings, throughput and memory use of the stages of the run are
+                                written, see instrumentation, <strain odb>_run_report.json if not given
+    :param prometheus_file_name:    if given, the run report is also written to this file in the Prometheus text
+                                    format, for instance in the directory of a node exporter textfile collector
+    :param run_directory:   directory where the completed units of work, the evaluated chunks of Gauss points, the
+                            B-matrix, unless it is saved in the solver cache, and the displacements of each step, are
+                            saved as they complete, <strain odb>_run
+                            if not given. Calling the function again with the same arguments after an interruption
+                            resumes the run from the last completed unit. The directory is removed when the run
+                            completes
+    :param solver:          solver for the displacements, 'lsqr', 'direct' or 'pcg', see DeformationCalculator, only
+                            used when the calculator is created
+    :param matrix_free:     if True, the B-matrix is applied element by element instead of being assembled, see
+                            DeformationCalculator, only used when the calculator is created
+    :param solver_cache:    SolverCache where the deformation calculator is stored and looked up by the fingerprint
+                            of the mesh, see DeformationCalculator, the default cache if True and no cache if False.
+                            The calculator is looked up by the stress odb, which the strain odb is created from
+    :return:                the deformation calculator, which can be reused for other runs on the same mesh
+    """
+    if load_spectrum is not None and (use_friction_table or response_surface_tolerance is not None
+                                      or quantization_resolution is not None):
+        raise ValueError("The friction table, the response surface and the quantization cannot be used with a load "
+                         "spectrum")
+    try:
+        len(cycles)
+    except TypeError:
+        cycles = np.array(cycles)
+    cycles = np.array(cycles)
+    report = instrumentation.start_report(os.path.splitext(os.path.basename(strain_odb_file_name))[0])
+
+    new_strain_odb = not os.path.isfile(strain_odb_file_name)
+    if new_strain_odb:
+        print("Creating odb", strain_odb_file_name)
+        abq.create_empty_odb_from_odb(strain_odb_file_name, stress_odb_file_name)
+
+    store_directory = os.path.splitext(strain_odb_file_name)[0] + '_store'
+    if stress_state is None:
+        with instrumentation.stage('read_stresses'):
+            stress_state = read_stress_state(stress_odb_file_name, load_spectrum,
+                                             store_directory if chunk_size is not None else None, chunk_size)
+    instance_name = stress_state.instance_name
+    element_set_name = stress_state.element_set_name
+    static_stresses = stress_state.static_stresses
+    cyclic_stresses = stress_state.cyclic_stresses
+    shares = stress_state.shares
+
+    # The internal state of the material model at the last evaluated cycle number is stored next to the strain odb
+    # together with the evaluated cycle numbers, and a run with more cycles only integrates the new cycle range and
+    # writes the new steps
+    state_file_name = gauss_point_state_file_name(stress_odb_file_name, strain_odb_file_name, material_parameters,
+                                                  element_set_name, load_spectrum)
+    initial_state = None
+    evaluated_cycles = np.zeros(0, dtype=cycles.dtype)
+    evaluation_cycles = cycles
+    if os.path.isfile(state_file_name) and not new_strain_odb:
+        with np.load(state_file_name) as state_data:
+            state_shape = (2 if shares is None else 7, static_stresses.shape[0])
+            if state_data['state'].shape == state_shape:
+                initial_state = state_data['state']
+                # State files of earlier versions only hold the last evaluated cycle number
+                evaluated_cycles = (state_data['cycles'] if 'cycles' in state_data.files
+                                    else state_data['cycle'].reshape(1))
+    if initial_state is not None:
+        last_cycle = evaluated_cycles[-1]
+        # The steps of the odb are ordered by the cycle number and steps below the last one cannot be added
+        skipped_cycles = cycles[np.logical_and(cycles < last_cycle, np.logical_not(np.isin(cycles, evaluated_cycles)))]
+        if skipped_cycles.shape[0]:
+            raise ValueError("The cycle numbers " + str(skipped_cycles.tolist()) + " are below the last cycle number "
+                             + str(last_cycle) + " evaluated in " + strain_odb_file_name + " but were not evaluated, "
+                             "the evaluated cycle numbers are " + str(evaluated_cycles.tolist()) + ". Use a new "
+                             "strain odb to evaluate them")
+        cycles = cycles[cycles > last_cycle]
+        if len(cycles):
+            print("Continuing from the Gauss point state at", last_cycle, "cycles stored in", state_file_name)
+        evaluation_cycles = np.concatenate([[last_cycle], cycles])
+    if len(cycles) == 0:
+        print("All cycles are already evaluated in", strain_odb_file_name)
+        return calculator
+    response_surface = None
+    if response_surface_tolerance is not None:
+        max_load = np.max(frictional_loads(MaterialModel(material_parameters), static_stresses, cyclic_stresses,
+                                           chunk_size))
+        response_surface = get_response_surface(material_parameters, evaluation_cycles, max_load,
+                                                response_surface_tolerance,
+                                                os.path.join(os.path.dirname(os.path.abspath(strain_odb_file_name)),
+                                                             'response_surfaces'))
+
+    if run_directory is None:
+        run_directory = os.path.splitext(strain_odb_file_name)[0] + '_run'
+    run_key = os.path.basename(state_file_name).encode() + np.asarray(evaluation_cycles, dtype=float).tobytes()
+    if initial_state is not None:
+        run_key += np.asarray(initial_state, dtype=float).tobytes()
+    run_key += repr((use_friction_table, response_surface_tolerance, quantization_resolution, chunk_size)).encode()
+    run = RunDirectory(run_directory, run_key, clear=new_strain_odb)
+
     print("Evaluating permanent strains")
     n = static_stresses.shape[0]
-    permanent_strains = np.zeros((len(cycles), n, static_stresses.shape[1]))
-    num_cpus = 12
-    chunksize = n//num_cpus
-    indices = [i*chunksize for i in range(num_cpus)]
-    indices.append(n)
-    job_list = []
-    for i in range(num_cpus):
-        args_list = [material_parameters, cycles, static_stresses[indices[i]:indices[i+1]],
-                     cyclic_stresses[indices[i]:indices[i+1]]]
-        job_list.append((evaluate_permanent_strain_for_gp, args_list, {}))
-    result = multiprocesser.multi_processer(job_list, timeout=7200, cpus=num_cpus)
-    for i in range(num_cpus):
-        permanent_strains[:, indices[i]:indices[i+1], :] = result[i]
-
-    print("Writing permanent strains to", strain_odb_file_name)
-    for i, n in enumerate(cycles):
-        abq.write_data_to_odb(field_data=permanent_strains[i, :, :], field_id='EP', odb_file_name=strain_odb_file_name,
-                              step_name='cycles_' + str(n), instance_name=instance_name, set_name=element_set_name)
-
-    boundary_conditions = [BoundaryCondition('X1_NODES', 'node_set', 1),
-                           BoundaryCondition('ballast_bottom_nodes', 'node_set', 2),
-                           BoundaryCondition('X_SYM_NODES', 'node_set', 1),
-                           BoundaryCondition('Z_SYM_NODES', 'node_set', 3),
-                           BoundaryCondition('Z1_NODES', 'node_set', 3)]
+    if chunk_size is None:
+        state = np.zeros((2 if shares is None else 7, n))
+    else:
+        if not os.path.isdir(store_directory):
+            os.makedirs(store_directory)
+        state = np.lib.format.open_memmap(os.path.join(store_directory, 'state.npy'), mode='w+', dtype=float,
+                                          shape=(2 if shares is None else 7, n))
+    gp_kwargs = {'use_friction_table': use_friction_table, 'response_surface': response_surface, 'shares': shares,
+                 'backend': backend}
+    frictional_strains = None
+    frictional_strain_index = None
+    if quantization_resolution is not None and initial_state is None:
+        # Quantizing all points at once so that points sharing a load are integrated once whatever their chunk
+        with instrumentation.stage('quantize_stress_states', items=n):
+            frictional_strains, frictional_strain_index = quantize_frictional_strains(
+                material_parameters, evaluation_cycles, static_stresses, cyclic_stresses, quantization_resolution,
+                use_friction_table, response_surface, chunk_size)
+    with instrumentation.stage('evaluate_permanent_strains', items=n):
+        if chunk_size is None:
+            permanent_strains = np.zeros((len(evaluation_cycles), n, static_stresses.shape[1]))
+            point_kwargs = frictional_strain_kwargs(frictional_strains, frictional_strain_index)
+            evaluate_permanent_strains(material_parameters, evaluation_cycles, static_stresses, cyclic_stresses,
+                                       permanent_strains, state, initial_state, num_cpus,
+                                       checkpoint_directory=run.file_name('gauss_points'), point_kwargs=point_kwargs,
+                                       **gp_kwargs)
+        else:
+            print("Streaming permanent strains to", store_directory)
+            # Stresses given in memory, for instance by a campaign, are moved to the store
+            if not isinstance(static_stresses, np.memmap):
+                static_stresses = store_array(static_stresses, os.path.join(store_directory, 'static_stresses.npy'))
+            if not isinstance(cyclic_stresses, np.memmap):
+                cyclic_stresses = store_array(cyclic_stresses, os.path.join(store_directory, 'cyclic_stresses.npy'))
+            permanent_strains = np.lib.format.open_memmap(os.path.join(store_directory, 'permanent_strains.npy'),
+                                                          mode='w+', dtype=float,
+                                                          shape=(len(evaluation_cycles), n, static_stresses.shape[1]))
+            for start in range(0, n, chunk_size):
+                stop = min(start + chunk_size, n)
+                chunk_state = None if initial_state is None else initial_state[:, start:stop]
+                point_kwargs = frictional_strain_kwargs(frictional_strains, None if frictional_strain_index is None
+                                                        else frictional_strain_index[start:stop])
+                evaluate_permanent_strains(material_parameters, evaluation_cycles, static_stresses[start:stop],
+                                           cyclic_stresses[..., start:stop, :], permanent_strains[:, start:stop, :],
+                                           state[:, start:stop], chunk_state, num_cpus,
+                                           checkpoint_directory=run.file_name('gauss_points_' + str(start)),
+                                           point_kwargs=point_kwargs, **gp_kwargs)
+                permanent_strains.flush()
+                print("Stored permanent strains for {i} out of {n} points".format(i=stop, n=n))
+    # The first evaluated cycle number is the already written checkpoint when continuing a previous run
+    permanent_strains = permanent_strains[len(evaluation_cycles) - len(cycles):]
+
+    if not run.is_done('permanent_strains'):
+        print("Writing permanent strains to", strain_odb_file_name)
+        with instrumentation.stage('write_permanent_strains'):
+            with OdbTransaction(strain_odb_file_name, odb_backend) as transaction:
+                for i, n in enumerate(cycles):
+                    transaction.write(permanent_strains[i, :, :], 'EP', step_name='cycles_' + str(n),
+                                      instance_name=instance_name, set_name=element_set_name)
+        run.mark_done('permanent_strains')
+
     print("Evaluating permanent deformations")
-    calculator = DeformationCalculator(strain_odb_file_name, boundary_conditions, abq=abq,
-                                       step_name='cycles_' + str(cycles[0]), instance_name=instance_name,
-                                       set_name=element_set_name, strain_field_id='EP')
+    with instrumentation.stage('calculate_deformations', items=len(cycles)):
+        # The displacements and errors of each step are checkpointed in .npy files and written to the odb from there,
+        # memory mapped, so that only the steps being solved are held in memory
+        deformation_file_names = [(run.file_name('up_cycles_' + str(n) + '.npy'),
+                                   run.file_name('err_cycles_' + str(n) + '.npy')) for n in cycles]
+        missing = [i for i, file_names in enumerate(deformation_file_names)
+                   if not all(os.path.isfile(file_name) for file_name in file_names)]
+        if missing and calculator is None:
+            with instrumentation.stage('create_deformation_calculator'):
+                calculator = DeformationCalculator(strain_odb_file_name, boundary_conditions, abq=abq,
+                                                   step_name='cycles_' + str(cycles[0]), instance_name=instance_name,
+                                                   set_name=element_set_name, strain_field_id='EP', backend=backend,
+                                                   checkpoint_directory=run.file_name('b_matrix'), solver=solver,
+                                                   matrix_free=matrix_free, solver_cache=solver_cache,
+                                                   mesh_odb_file_name=stress_odb_file_name)
+        # The direct solver solves all steps as one block, unless the memory is bounded by chunk_size, while lsqr and
+        # pcg solve and checkpoint one step at a time
+        blocks = [[i] for i in missing]
+        if calculator is not None and calculator.solver == 'direct' and chunk_size is None:
+            blocks = [missing]
+        for block in blocks:
+            if not block:
+                continue
+            # The strains are the ones just written to the odb and need not be read back
+            up, err = calculator.calculate_deformations(strain=np.array(permanent_strains[block, :, :]))
+            for i, step_up, step_err in zip(block, up, err):
+                save_array(deformation_file_names[i][1], step_err)
+                save_array(deformation_file_names[i][0], step_up)
+            del up, err
+
+    if not run.is_done('permanent_deformations'):
+        print("Writing permanent deformations to", strain_odb_file_name)
+        with OdbTransaction(strain_odb_file_name, odb_backend) as transaction:
+            for n, (up_file_name, err_file_name) in zip(cycles, deformation_file_names):
+                transaction.write(load_array(up_file_name, mmap_mode='r'), 'UP', step_name='cycles_' + str(n),
+                                  position='NODAL', frame_number=0, set_name='EMBANKMENT_INSTANCE_BALLAST_NODES')
+                transaction.write(load_array(err_file_name, mmap_mode='r'), 'ERR', step_name='cycles_' + str(n),
+                                  frame_number=0, set_name=element_set_name)
+        run.mark_done('permanent_deformations')
+    # The Gauss point state is only stored when the run is complete as it marks the cycles as evaluated
+    np.savez(state_file_name, cycles=np.concatenate([evaluated_cycles, cycles]), state=state)
+    run.remove()
+
+    if report_file_name is None:
+        report_file_name = os.path.splitext(strain_odb_file_name)[0] + '_run_report.json'
+    print("Writing run report to", report_file_name)
+    report.write_json(report_file_name)
+    if prometheus_file_name is not None:
+        report.write_prometheus(prometheus_file_name)
+    return calculator
+
+
+Run = namedtuple('Run', ['geometry', 'fixture', 'axle_load', 'frequency'])
+
+
+class Campaign:
+    """
+    Matrix of runs over geometries, rail fixtures, axle loads and frequencies. Runs sharing a mesh, having the same
+    geometry and fixture, form a group where the stresses of each axle load are read once and the deformation
+    calculator, with the mesh export and the assembly and scaling of the B-matrix, is created once. The groups are
+    executed in parallel processes.
+    """
+    def __init__(self, geometries, fixtures, axle_loads, frequencies, cycles, stress_odb_directory, result_directory,
+                 parameter_function=get_parameters, **kwargs):
+        """
+        :param parameter_function:  function returning the material parameters for a frequency
+        :param kwargs:              passed to calculate_permanent_deformations
+        """
+        self.runs = [Run(*run) for run in itertools.product(geometries, fixtures, axle_loads, frequencies)]
+        self.cycles = cycles
+        self.stress_odb_directory = stress_odb_directory
+        self.result_directory = result_directory
+        self.parameter_function = parameter_function
+        self.kwargs = kwargs
+
+    @staticmethod
+    def simulation_name(run):
+        return run.fixture + '_' + run.geometry + '_' + str(run.axle_load).replace('.', '_') + 't'
+
+    def stress_odb_file_name(self, run):
+        return os.path.join(self.stress_odb_directory, 'stresses_' + self.simulation_name(run) + '.odb')
+
+    def strain_odb_file_name(self, run):
+        return os.path.join(self.result_directory, 'results_' + self.simulation_name(run) + '_'
+                            + str(int(run.frequency)) + 'Hz.odb')
+
+    def groups(self):
+        groups = OrderedDict()
+        for run in self.runs:
+            groups.setdefault((run.geometry, run.fixture), []).append(run)
+        return list(groups.values())
 
-    print("Writing permanent deformations to", strain_odb_file_name)
-    for i, n in enumerate(cycles):
-        up, err = calculator.calculate_deformations(step_name='cycles_' + str(n))
+    def run_group(self, runs, num_cpus=None):
+        calculator = None
+        stress_states = {}
+        for run in runs:
+            stress_odb_file_name = self.stress_odb_file_name(run)
+            if stress_odb_file_name not in stress_states:
+                # With a chunk size, the stresses of the group are kept memory mapped in a store of their own
+                store_directory = None
+                if self.kwargs.get('chunk_size') is not None:
+                    store_directory = os.path.join(self.result_directory,
+                                                   'stresses_' + self.simulation_name(run) + '_store')
+                stress_states[stress_odb_file_name] = read_stress_state(stress_odb_file_name,
+                                                                        store_directory=store_directory,
+                                                                        chunk_size=self.kwargs.get('chunk_size'))
+            print("Running", self.strain_odb_file_name(run))
+            calculator = calculate_permanent_deformations(stress_odb_file_name, self.strain_odb_file_name(run),
+                                                          self.cycles, self.parameter_function(frequency=run.frequency),
+                                                          stress_state=stress_states[stress_odb_file_name],
+                                                          calculator=calculator, num_cpus=num_cpus, **self.kwargs)
 
-        abq.write_data_to_odb(up, 'UP', strain_odb_file_name, step_name='cycles_' + str(n), position='NODAL',
-                              frame_number=0, set_name='EMBANKMENT_INSTANCE_BALLAST_NODES')
-        abq.write_data_to_odb(err, 'ERR', strain_odb_file_name, step_name='cycles_' + str(n), frame_number=0,
-                              set_name=element_set_name)
+    def run(self, processes=None):
+        """
+        Executes the groups in parallel, in at most processes processes, all groups at once if not given, sharing the
+        cores equally for the Gauss point evaluation
+        """
+        groups = self.groups()
+        processes = len(groups) if processes is None else min(processes, len(groups))
+        if processes <= 1:
+            for runs in groups:
+                self.run_group(runs)
+            return
+        num_cpus = max(multiprocessing.cpu_count()//processes, 1)
+        # Using plain processes, as opposed to a pool, as the groups start pools of their own
+        pending = list(groups)
+        running = []
+        failed = []
+        while pending or running:
+            while pending and len(running) < processes:
+                process = multiprocessing.Process(target=self.run_group, args=(pending.pop(0), num_cpus))
+                process.start()
+                running.append(process)
+            time.sleep(1.)
+            for process in [process for process in running if not process.is_alive()]:
+                process.join()
+                running.remove(process)
+                if process.exitcode != 0:
+                    failed.append(process.exitcode)
+        if failed:
+            raise RuntimeError(str(len(failed)) + " of " + str(len(groups)) + " groups failed")
 
 
 def main():
-    frequencies = [10., 5., 20., 40]
-    load = 17.5
-    for f in frequencies:
-        sim_name = 'sleepers_low_' + str(load).replace('.', '_') + 't'
-        cycles = [1, 10, 100, 1000, 10000, 100000, 1000000]
-        stress_odb_filename = os.path.expanduser('~/railway_ballast/old_stress_odbs/stresses_' + sim_name + '.odb')
-
-        strain_odb_filename = os.path.expanduser('~/railway_ballast/results_' + sim_name
-                                                 + '_' + str(int(f)) + 'Hz.odb')
-        par = get_parameters(frequency=f)
-        calculate_permanent_deformations(stress_odb_filename, strain_odb_filename, cycles, par)
+    campaign = Campaign(geometries=['low'], fixtures=['sleepers'], axle_loads=[17.5], frequencies=[10., 5., 20., 40],
+                        cycles=[1, 10, 100, 1000, 10000, 100000, 1000000],
+                        stress_odb_directory=os.path.expanduser('~/railway_ballast/old_stress_odbs/'),
+                        result_directory=os.path.expanduser('~/railway_ballast/'))
+    campaign.run()
 
 
 if __name__ == '__main__':
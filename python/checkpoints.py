@@ -0,0 +1,88 @@
+from __future__ import print_function, division
+
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def save_arrays(file_name, **arrays):
+    # Written to a temporary file first and renamed, which is atomic, so an interrupted run never leaves a partially
+    # written checkpoint behind
+    temp_file_name = file_name + '.tmp.npz'
+    np.savez(temp_file_name, **arrays)
+    os.rename(temp_file_name, file_name)
+
+
+def load_arrays(file_name):
+    # Returns a dict with the arrays stored by save_arrays or None if the checkpoint does not exist
+    if not os.path.isfile(file_name):
+        return None
+    with np.load(file_name) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save_array(file_name, array):
+    # A single array in a .npy file, written atomically as in save_arrays, which can be loaded memory mapped
+    temp_file_name = file_name + '.tmp.npy'
+    np.save(temp_file_name, array)
+    os.rename(temp_file_name, file_name)
+
+
+def load_array(file_name, mmap_mode=None):
+    # Returns the array stored by save_array or None if the checkpoint does not exist
+    if not os.path.isfile(file_name):
+        return None
+    return np.load(file_name, mmap_mode=mmap_mode)
+
+
+def save_sparse_matrix(file_name, matrix):
+    # Not compressed as the matrices are large and loading them should be fast
+    temp_file_name = file_name + '.tmp.npz'
+    sp.save_npz(temp_file_name, matrix, compressed=False)
+    os.rename(temp_file_name, file_name)
+
+
+def load_sparse_matrix(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    return sp.load_npz(file_name)
+
+
+class RunDirectory:
+    """
+    Directory where the completed units of work of a run are persisted so that an interrupted run can resume from the
+    last completed unit. The directory is identified by a key describing the inputs of the run and a directory
+    holding checkpoints for other inputs is cleared.
+    """
+    def __init__(self, directory, key, clear=False):
+        self.directory = directory
+        self.key = hashlib.sha1(key).hexdigest()
+        key_file_name = os.path.join(directory, 'run_key')
+        if os.path.isdir(directory):
+            existing_key = None
+            if os.path.isfile(key_file_name):
+                with open(key_file_name) as key_file:
+                    existing_key = key_file.read().strip()
+            if clear or existing_key != self.key:
+                shutil.rmtree(directory)
+            else:
+                print("Resuming the run checkpointed in", directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            with open(key_file_name, 'w') as key_file:
+                key_file.write(self.key)
+
+    def file_name(self, name):
+        return os.path.join(self.directory, name)
+
+    def is_done(self, name):
+        return os.path.isfile(self.file_name(name + '.done'))
+
+    def mark_done(self, name):
+        open(self.file_name(name + '.done'), 'w').close()
+
+    def remove(self):
+        shutil.rmtree(self.directory)
@@ -2,13 +2,18 @@ import os
 import subprocess
 
 from common import abq
-from read_data_from_odb import read_data_from_odb
+from odb_cache import CachedABQInterface
+import read_data_from_odb as odb_reader
 from write_data_to_odb import write_data_to_odb
 
 
 odb_directory = os.path.expanduser('~/railway_ballast/odbs/')
 ballast_element_set = 'EMBANKMENT_INSTANCE_BALLAST_ELEMENTS'
 
+# The stresses of the simulation odbs are read through the odb cache, see odb_cache, as the same odbs are read again
+# when the stress state odbs are recreated. The reader module provides read_data_from_odb as an ABQInterface does
+odb_reader = CachedABQInterface(odb_reader)
+
 
 def main():
     loads = [17.5, 22.5, 30.]
@@ -19,8 +24,8 @@ def main():
                                              + str(load).replace('.', '_') + 't.odb')
                 sim_odb_filename = (odb_directory + '/embankment_' + rail_fixture + '_' + geometry + '_'
                                     + str(load).replace('.', '_') + 't.odb')
-                static_stresses = read_data_from_odb('S', sim_odb_filename, step_name='gravity',
-                                                     set_name=ballast_element_set)
+                static_stresses = odb_reader.read_data_from_odb('S', sim_odb_filename, step_name='gravity',
+                                                                set_name=ballast_element_set)
                 if os.path.isfile(stress_state_odb_filename):
                     os.remove(stress_state_odb_filename)
                 os.chdir('abaqus_functions')
@@ -31,8 +36,8 @@ def main():
 
                 write_data_to_odb(static_stresses, 'S', stress_state_odb_filename, set_name=ballast_element_set,
                                   step_name='gravity')
-                max_stresses = read_data_from_odb('S', sim_odb_filename, step_name='loading',
-                                                  set_name=ballast_element_set)
+                max_stresses = odb_reader.read_data_from_odb('S', sim_odb_filename, step_name='loading',
+                                                             set_name=ballast_element_set)
                 cyclic_stresses = max_stresses - static_stresses
                 write_data_to_odb(cyclic_stresses, 'S', stress_state_odb_filename, set_name=ballast_element_set,
                                   step_name='cyclic_stresses')
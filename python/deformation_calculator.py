@@ -1,134 +1,600 @@
 from __future__ import print_function, division
+import json
 import pickle
 import os
+import shutil
 import subprocess
 
 import numpy as np
 from scipy.sparse import coo_matrix
 import scipy.sparse as sp
-from scipy.sparse.linalg import lsqr, norm
+from scipy.sparse.linalg import aslinearoperator, lsqr, norm, splu, spsolve_triangular
 
+try:
+    from sksparse.cholmod import cholesky
+except ImportError:
+    # The direct solver uses an LU factorization from scipy when scikit-sparse is not installed
+    cholesky = None
+
+from checkpoints import load_arrays, load_sparse_matrix, save_arrays, save_sparse_matrix
 from common import create_temp_dir_name
-from multiprocesser.multiprocesser import multi_processer
+from FEM_functions.mesh_bundle import element_groups, read_mesh_bundle, strain_rows
+from FEM_functions.strain_displacement_operator import StrainDisplacementOperator
+import instrumentation
+from solver_cache import SolverCache, mesh_fingerprint
 
 
 class DeformationCalculator:
     def __init__(self, strain_odb_file_name, boundary_conditions, step_name, abq, instance_name='', set_name='',
-                 strain_field_id='E'):
+                 strain_field_id='E', backend=None, element_batch_size=1000, checkpoint_directory=None,
+                 solver='lsqr', verify_solver=False, tolerance=1e-8, max_iterations=None, matrix_free=False,
+                 solver_cache=True, mesh_odb_file_name=None):
+        """
+        :param backend:                 execution backend, see execution_backends, for the batches of elements, the
+                                        batches are evaluated in this process if not given
+        :param element_batch_size:      number of elements in each batch where the B-matrices of all elements of the
+                                        same type are evaluated at once
+        :param checkpoint_directory:    if given and no solver cache is used, the assembled and scaled B-matrix is
+                                        saved in this directory and loaded from it instead of exporting the mesh and
+                                        assembling it again. With a solver cache, the B-matrix is only saved in the
+                                        cache, which serves as the checkpoint
+        :param solver:                  'lsqr' solves each step iteratively with lsqr and 'direct' factorizes the
+                                        normal equations of the scaled B-matrix once, with a Cholesky factorization
+                                        from scikit-sparse if installed and a sparse LU factorization otherwise, so
+                                        each step only needs a pair of triangular solves. 'pcg' solves the normal
+                                        equations with conjugate gradients without forming them, preconditioned by
+                                        the inverses of the nodal 3 x 3 diagonal blocks and starting each step from
+                                        the solution of the previous step, for meshes where the factorization does
+                                        not fit in memory
+        :param verify_solver:           if True, the first step of each call to calculate_deformations is also solved
+                                        with lsqr when using the direct or the pcg solver and the difference is
+                                        reported
+        :param tolerance:               the pcg solver stops when the residual of the normal equations is reduced to
+                                        tolerance times the norm of their right hand side
+        :param max_iterations:          maximum number of pcg iterations for each step, the number of unknowns if not
+                                        given
+        :param matrix_free:             if True, the B-matrix is not assembled and is instead applied element by
+                                        element from the derivatives of the shape functions at the Gauss points, see
+                                        StrainDisplacementOperator, which needs a fraction of the memory. Only the
+                                        lsqr and the pcg solvers can be used
+        :param solver_cache:            SolverCache where the calculator is stored, see save, and looked up by the
+                                        fingerprint of the mesh, a SolverCache in the default directory if True and
+                                        no cache if False. A calculator for an unchanged odb is loaded from the cache
+                                        without exporting the mesh and a calculator for the same mesh in another odb
+                                        is loaded without assembling the B-matrix and preparing the solver again
+        :param mesh_odb_file_name:      odb the strain odb was created from, having the same mesh, for instance the
+                                        stress odb. If given, the cache looks up the calculator by this odb instead of
+                                        the strain odb, which changes whenever strains are written to it
+        """
         print("Init calculator")
-        self.abq = abq
-        self.odb_file_name = strain_odb_file_name
+        self._set_options(abq, strain_odb_file_name, instance_name, set_name, strain_field_id, solver, verify_solver,
+                          tolerance, max_iterations, matrix_free)
+        if checkpoint_directory is not None and self._load(checkpoint_directory):
+            print("Loaded the B-matrix from", checkpoint_directory)
+            if self._prepare_solver():
+                self._save_solver(checkpoint_directory)
+            return
+        if solver_cache is True:
+            solver_cache = SolverCache()
+        source_key = None
+        if solver_cache and mesh_odb_file_name is not None:
+            # The step only selects the strains in the strain odb and does not change the mesh
+            source_key = solver_cache.source_key(mesh_odb_file_name, boundary_conditions, instance_name=instance_name,
+                                                 set_name=set_name, strain_field_id=strain_field_id)
+        elif solver_cache:
+            source_key = solver_cache.source_key(strain_odb_file_name, boundary_conditions, step_name=step_name,
+                                                 instance_name=instance_name, set_name=set_name,
+                                                 strain_field_id=strain_field_id)
+        if solver_cache:
+            if self._load_from_cache(solver_cache, solver_cache.fingerprint(source_key)):
+                return
         self.work_directory = create_temp_dir_name(strain_odb_file_name)
         os.makedirs(self.work_directory)
-        self.stain_field_id = strain_field_id
-        self.instance_name = instance_name
-        self.set_name = set_name
         parameter_pickle_file = self.work_directory + '/parameter_strain_pickle.pkl'
-        data_pickle_file = self.work_directory + '/strain_pickle.pkl'
+        mesh_directory = self.work_directory + '/mesh'
         parameter_dict = {'instance_name': self.instance_name, 'strain_odb_file_name': self.odb_file_name,
                           'set_name': self.set_name, 'strain_field_id': self.stain_field_id, 'step_name': step_name}
         with open(parameter_pickle_file, 'wb') as pickle_file:
             pickle.dump({'parameter_dict': parameter_dict, 'boundary_conditions': boundary_conditions}, pickle_file,
                         protocol=2)
         os.chdir('abaqus_functions')
-        job = subprocess.Popen(abq.abq + ' python write_data_for_def_calculation.py ' + parameter_pickle_file + ' '
-                               + data_pickle_file, shell=True)
-        job.wait()
+        with instrumentation.stage('export_mesh'):
+            job = subprocess.Popen(abq.abq + ' python write_data_for_def_calculation.py ' + parameter_pickle_file
+                                   + ' ' + mesh_directory, shell=True)
+            job.wait()
         os.chdir('..')
-        with open(data_pickle_file, 'rb') as pickle_file:
-            data = pickle.load(pickle_file, encoding='latin1')
-        os.remove(data_pickle_file)
         os.remove(parameter_pickle_file)
+        # The arrays of the mesh are memory mapped from the files written by the export
+        mesh = read_mesh_bundle(mesh_directory)
+        number_of_elements = mesh['element_labels'].shape[0]
 
         print("Handling boundary conditions")
-        bc_dofs = data['bc_dofs']
-        bc_vals_dict = data['bc_vals_dict']
-        self.nodal_displacements = data['nodal_displacements']
-        elements = data['elements']
-        b_components = data['b_components']
-        strain_components = data['strain_components']
-        displacement_components = data['displacement_components']
-        self.bc_vals = 0.*bc_dofs
+        bc_dofs = np.array(mesh['bc_dofs'])
+        bc_vals_dict = dict(zip(mesh['bc_value_dofs'], mesh['bc_values']))
+        self.nodal_displacements = np.zeros(3*mesh['node_labels'].shape[0])
+        self.bc_vals = np.zeros(bc_dofs.shape[0])
         for i, dof in enumerate(bc_dofs):
             self.bc_vals[i] = bc_vals_dict.get(dof, 0.)
 
         self.nodal_displacements[bc_dofs] = self.bc_vals
-        row = np.zeros(b_components)
-        col = np.zeros(b_components)
-        values = np.zeros(b_components)
-        self.gauss_point_volumes = np.zeros(strain_components)
-        print("Assembling B-matrix")
-        job_list = []
-        for i, element in enumerate(elements):
-            job_list.append((calculate_element_data, [element, i], {}))
-        print("Starting multiprocessing of elements")
-        b_data = multi_processer(job_list, cpus=12, delay=0., timeout=1e5)
-        print("Assembling results")
-        for i, data in enumerate(b_data):
-            n = data[0].shape[0]
-            col[i*n:(i + 1)*n] = data[0]
-            row[i*n:(i + 1)*n] = data[1]
-            values[i*n:(i + 1)*n] = data[2]
-            gps = data[3].shape[0]//6
-            self.gauss_point_volumes[i*gps*6:(i+1)*gps*6] = data[3]
-        self.B_matrix = coo_matrix((values, (row, col)),
-                                   shape=(strain_components, displacement_components)).tocsc()
-        print("Shape of B-matrix:", self.B_matrix.shape)
+        fingerprint = None
+        if solver_cache:
+            fingerprint = mesh_fingerprint(mesh, set_name, boundary_conditions, self.bc_vals)
+            if self._load_from_cache(solver_cache, fingerprint, source_key):
+                shutil.rmtree(self.work_directory)
+                return
+        if matrix_free:
+            print("Computing the element data of the B-matrix")
+            with instrumentation.stage('assemble_b_operator', items=number_of_elements):
+                self.B_operator = StrainDisplacementOperator.from_mesh(mesh, element_batch_size)
+                self.gauss_point_volumes = self.B_operator.gauss_point_volumes()
+        else:
+            self._assemble_b_matrix(mesh, backend, element_batch_size)
         all_cols = np.arange(self.nodal_displacements.shape[0])
         self.bc_cols = np.where(np.in1d(all_cols, bc_dofs))[0]
         self.cols_to_keep = np.where(np.logical_not(np.in1d(all_cols, bc_dofs)))[0]
-        print("Computing scale factors")
-        scale_array = sp.diags([self.gauss_point_volumes], offsets=[0])
-        self.B_matrix = scale_array*self.B_matrix
-        self.B_red = self.B_matrix[:, self.cols_to_keep]
-
         print("Scaling B-matrix")
-        self.scale_factors = norm(self.B_red, axis=0)
-        scale_array = sp.diags([1./self.scale_factors], offsets=[0])
-        self.B_red *= scale_array
+        with instrumentation.stage('scale_b_matrix'):
+            if matrix_free:
+                self._scale_b_operator()
+            else:
+                scale_array = sp.diags([self.gauss_point_volumes], offsets=[0])
+                self.B_matrix = scale_array*self.B_matrix
+                self.B_red = self.B_matrix[:, self.cols_to_keep]
+                self.scale_factors = norm(self.B_red, axis=0)
+                scale_array = sp.diags([1./self.scale_factors], offsets=[0])
+                self.B_red *= scale_array
+        self._report_memory(number_of_elements)
+        # The B-matrix is saved before the solver is prepared so that an interrupted run resumes from it, only once,
+        # in the cache entry if a cache is used, which is then found from the source key, and in the checkpoint
+        # directory otherwise
+        save_directory = checkpoint_directory
+        if solver_cache:
+            save_directory = solver_cache.entry_directory(self._cache_entry_name(fingerprint))
+        if save_directory is not None:
+            self._save_b_matrix(save_directory)
+        if solver_cache:
+            solver_cache.add_source(source_key, fingerprint)
+        self._prepare_solver()
+        if save_directory is not None:
+            self._save_solver(save_directory)
+        if solver_cache:
+            solver_cache.evict()
         print("Init done")
-        os.removedirs(self.work_directory)
+        shutil.rmtree(self.work_directory)
+
+    def _set_options(self, abq, strain_odb_file_name, instance_name='', set_name='', strain_field_id='E',
+                     solver='lsqr', verify_solver=False, tolerance=1e-8, max_iterations=None, matrix_free=False):
+        self.abq = abq
+        self.odb_file_name = strain_odb_file_name
+        self.stain_field_id = strain_field_id
+        self.instance_name = instance_name
+        self.set_name = set_name
+        if solver not in ('lsqr', 'direct', 'pcg'):
+            raise ValueError("The solver must be either \"lsqr\", \"direct\" or \"pcg\"")
+        if matrix_free and solver == 'direct':
+            raise ValueError("The direct solver needs the assembled B-matrix and cannot be used with matrix_free")
+        self.solver = solver
+        self.verify_solver = verify_solver
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.factor = None
+        self.factorization = None
+        self.inverse_blocks = None
+        self.previous_solution = None
+        self.matrix_free = matrix_free
+        self.B_operator = None
+        self.normal_blocks = None
+
+    def _settings(self):
+        return {'strain_odb_file_name': self.odb_file_name, 'instance_name': self.instance_name,
+                'set_name': self.set_name, 'strain_field_id': self.stain_field_id, 'solver': self.solver,
+                'verify_solver': self.verify_solver, 'tolerance': self.tolerance,
+                'max_iterations': self.max_iterations, 'matrix_free': self.matrix_free}
+
+    def _cache_entry_name(self, fingerprint):
+        return fingerprint + ('_matrix_free' if self.matrix_free else '')
+
+    def _load_from_cache(self, solver_cache, fingerprint, source_key=None):
+        if fingerprint is None:
+            return False
+        entry_directory = solver_cache.get(self._cache_entry_name(fingerprint))
+        if entry_directory is None or not self._load(entry_directory):
+            return False
+        print("Loaded the B-matrix and the solver for the mesh from", entry_directory)
+        if self._prepare_solver():
+            self._save_solver(entry_directory)
+        if source_key is not None:
+            solver_cache.add_source(source_key, fingerprint)
+        return True
+
+    def _assemble_b_matrix(self, mesh, backend, element_batch_size):
+        number_of_elements = mesh['element_labels'].shape[0]
+        print("Assembling B-matrix")
+        with instrumentation.stage('assemble_b_matrix', items=number_of_elements):
+            first_rows, strain_components = strain_rows(mesh)
+            groups = element_groups(mesh)
+            b_components = sum(positions.shape[0]*element_class.strains_components*element_class.dofs
+                               for element_class, positions, _ in groups)
+            row = np.zeros(b_components, dtype=np.int64)
+            col = np.zeros(b_components, dtype=np.int64)
+            values = np.zeros(b_components)
+            self.gauss_point_volumes = np.zeros(strain_components)
+            # Only the node numbers and the coordinates of the elements in a batch are sent to the workers
+            job_list = []
+            for element_class, positions, connectivity in groups:
+                for i in range(0, positions.shape[0], element_batch_size):
+                    batch_connectivity = np.array(connectivity[i:i + element_batch_size])
+                    job_list.append((calculate_element_batch_data,
+                                     [element_class, batch_connectivity, mesh['coordinates'][batch_connectivity],
+                                      first_rows[positions[i:i + element_batch_size]]], {}))
+            if backend is None:
+                b_data = (function(*args, **kwargs) for function, args, kwargs in job_list)
+            else:
+                print("Submitting", len(job_list), "element batches")
+                b_data = backend.map(job_list)
+            entry = 0
+            for batch_row, batch_col, batch_values, batch_strain_rows, batch_volumes in b_data:
+                row[entry:entry + batch_row.shape[0]] = batch_row
+                col[entry:entry + batch_col.shape[0]] = batch_col
+                values[entry:entry + batch_values.shape[0]] = batch_values
+                self.gauss_point_volumes[batch_strain_rows] = batch_volumes
+                entry += batch_values.shape[0]
+            self.B_matrix = coo_matrix((values, (row, col)),
+                                       shape=(strain_components, self.nodal_displacements.shape[0])).tocsc()
+        print("Shape of B-matrix:", self.B_matrix.shape)
+
+    def _scale_b_operator(self):
+        # The rows are scaled with the Gauss point volumes and the columns by their norms as for the assembled matrix,
+        # the squared column norms are the diagonals of the nodal blocks of the normal matrix
+        if self.normal_blocks is None:
+            self.normal_blocks = self.B_operator.normal_blocks(self.gauss_point_volumes)
+        self.scale_factors = np.sqrt(self.normal_blocks[:, [0, 1, 2], [0, 1, 2]].ravel()[self.cols_to_keep])
+        self.B_matrix = aslinearoperator(sp.diags([self.gauss_point_volumes], offsets=[0]))*self.B_operator
+        kept_columns = self.cols_to_keep.shape[0]
+        column_scaling = sp.csr_matrix((1./self.scale_factors, (self.cols_to_keep, np.arange(kept_columns))),
+                                       shape=(self.B_operator.shape[1], kept_columns))
+        self.B_red = self.B_matrix*aslinearoperator(column_scaling)
 
-    def calculate_deformations(self, step_name, frame_number=-1):
-        strain = self.abq.read_data_from_odb(self.stain_field_id, self.odb_file_name, step_name=step_name,
-                                             frame_number=frame_number, set_name=self.set_name,
-                                             instance_name=self.instance_name)
-        strain = strain.flatten()*self.gauss_point_volumes
+    def _report_memory(self, number_of_elements):
+        if self.matrix_free:
+            stored_bytes = self.B_operator.nbytes + self.normal_blocks.nbytes
+        else:
+            stored_bytes = sum(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+                               for matrix in [self.B_matrix, self.B_red])
+        print("B-matrix storage: {b:.0f} bytes per element".format(b=stored_bytes/number_of_elements))
+        instrumentation.observe('b_matrix_bytes_per_element', stored_bytes/number_of_elements)
+        peak = instrumentation.peak_rss()
+        if peak is not None:
+            print("Peak memory: {b:.0f} bytes per element".format(b=peak/number_of_elements))
+            instrumentation.observe('peak_rss_bytes_per_element', peak/number_of_elements)
 
-        calc_displacements = lsqr(self.B_red, strain - self.B_matrix[:, self.bc_cols]*self.bc_vals,
-                                  show=True)[0]
+    def save(self, directory):
+        """
+        Saves the assembled and scaled B-matrix, the boundary conditions, the options and the factorization or the
+        preconditioner of the solver in directory, see load
+        """
+        self._save_b_matrix(directory)
+        self._save_solver(directory)
+
+    @classmethod
+    def load(cls, directory, abq=None, **options):
+        """
+        Loads a calculator saved with save without exporting the mesh from the odb
+        :param abq:         the Abaqus interface, only needed for reading the strains from an odb
+        :param options:     options of __init__ replacing the saved ones, for instance solver, the factorization or the
+                            preconditioner is computed if the saved calculator used another solver
+        """
+        data = load_arrays(os.path.join(directory, 'b_matrix_data.npz'))
+        if data is None:
+            raise IOError("No deformation calculator is saved in " + directory)
+        settings = json.loads(str(data['settings']))
+        settings.update(options)
+        calculator = cls.__new__(cls)
+        calculator._set_options(abq, **settings)
+        if not calculator._load(directory):
+            raise IOError("The deformation calculator saved in " + directory + " does not match the options " +
+                          repr(options))
+        calculator._prepare_solver()
+        return calculator
+
+    def _save_b_matrix(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self.matrix_free:
+            save_arrays(os.path.join(directory, 'b_operator.npz'), **self.B_operator.to_arrays())
+        else:
+            save_sparse_matrix(os.path.join(directory, 'b_matrix.npz'), self.B_matrix)
+        # The arrays are saved last and mark the B-matrix as complete
+        arrays = dict(gauss_point_volumes=self.gauss_point_volumes, nodal_displacements=self.nodal_displacements,
+                      bc_vals=self.bc_vals, bc_cols=self.bc_cols, cols_to_keep=self.cols_to_keep,
+                      scale_factors=self.scale_factors, settings=np.array(json.dumps(self._settings())))
+        if self.matrix_free:
+            arrays['normal_blocks'] = self.normal_blocks
+        save_arrays(os.path.join(directory, 'b_matrix_data.npz'), **arrays)
+
+    def _save_solver(self, directory):
+        if self.solver == 'direct':
+            factors = self.factor if isinstance(self.factor, dict) else factor_arrays(self.factor)
+            save_sparse_matrix(os.path.join(directory, 'factor_lower.npz'), factors['lower'])
+            if factors['upper'] is not None:
+                save_sparse_matrix(os.path.join(directory, 'factor_upper.npz'), factors['upper'])
+            arrays = dict(row_permutation=factors['row_permutation'],
+                          column_permutation=factors['column_permutation'], cholesky=factors['upper'] is None)
+        elif self.solver == 'pcg':
+            arrays = dict(inverse_blocks=self.inverse_blocks, block_index=self.block_index,
+                          block_components=self.block_components)
+        else:
+            return
+        save_arrays(os.path.join(directory, 'solver_' + self.solver + '.npz'), **arrays)
+
+    def _load(self, directory):
+        data = load_arrays(os.path.join(directory, 'b_matrix_data.npz'))
+        if data is None:
+            return False
+        if self.matrix_free:
+            operator_arrays = load_arrays(os.path.join(directory, 'b_operator.npz'))
+            if operator_arrays is None or 'normal_blocks' not in data:
+                return False
+            self.B_operator = StrainDisplacementOperator.from_arrays(operator_arrays)
+        else:
+            self.B_matrix = load_sparse_matrix(os.path.join(directory, 'b_matrix.npz'))
+            if self.B_matrix is None:
+                return False
+            self.B_matrix = self.B_matrix.tocsc()
+            data.pop('normal_blocks', None)
+        data.pop('settings', None)
+        for name, value in data.items():
+            setattr(self, name, value)
+        if self.matrix_free:
+            self._scale_b_operator()
+        else:
+            self.B_red = self.B_matrix[:, self.cols_to_keep]*sp.diags([1./self.scale_factors], offsets=[0])
+        self._load_solver(directory)
+        return True
+
+    def _load_solver(self, directory):
+        data = load_arrays(os.path.join(directory, 'solver_' + self.solver + '.npz'))
+        if data is None:
+            return
+        if self.solver == 'direct':
+            self.factor = {'lower': load_sparse_matrix(os.path.join(directory, 'factor_lower.npz')), 'upper': None,
+                           'row_permutation': data['row_permutation'],
+                           'column_permutation': data['column_permutation']}
+            if not data['cholesky']:
+                self.factor['upper'] = load_sparse_matrix(os.path.join(directory, 'factor_upper.npz'))
+            self.factorization = triangular_solver(**self.factor)
+        else:
+            for name, value in data.items():
+                setattr(self, name, value)
+
+    def _prepare_solver(self):
+        # Returns True if the factorization or the preconditioner is computed and False if it was loaded or is not
+        # needed
+        if self.solver == 'pcg' and self.inverse_blocks is None:
+            self._compute_block_preconditioner()
+            return True
+        if self.solver != 'direct' or self.factorization is not None:
+            return False
+        # The normal equations of the scaled problem, B_red^T B_red x = B_red^T r, have the same matrix for all steps
+        with instrumentation.stage('factorize_normal_equations'):
+            normal_matrix = (self.B_red.T*self.B_red).tocsc()
+            try:
+                if cholesky is not None:
+                    print("Computing Cholesky factorization of the normal equations")
+                    self.factor = cholesky(normal_matrix)
+                    self.factorization = self.factor
+                else:
+                    print("Computing LU factorization of the normal equations")
+                    self.factor = splu(normal_matrix, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.,
+                                       options={'SymmetricMode': True})
+                    self.factorization = self.factor.solve
+            except Exception as error:
+                raise ValueError("The factorization of the normal equations failed, the displacements are not "
+                                 "uniquely determined by the strains, check the boundary conditions or use the lsqr "
+                                 "solver: " + str(error))
+            self._check_factorization(normal_matrix)
+        return True
+
+    def _check_factorization(self, normal_matrix, tolerance=1e-6):
+        # A singular normal matrix, when the boundary conditions leave a rigid body motion free, does not always make
+        # the factorization fail but gives meaningless displacements. The pivots of the symmetric LU factorization of a
+        # positive definite matrix are at least its smallest eigenvalue, so a pivot ratio at the rounding level means a
+        # numerically singular matrix, and a solve with a random right hand side checks both factorizations
+        n = normal_matrix.shape[0]
+        pivot_ratio = 1.
+        if cholesky is None:
+            pivots = np.abs(self.factor.U.diagonal())
+            pivot_ratio = pivots.min()/max(pivots.max(), 1e-300)
+        rhs = np.random.RandomState(0).uniform(-1., 1., n)
+        solution = np.asarray(self.factorization(rhs)).ravel()
+        residual = np.linalg.norm(normal_matrix*solution - rhs)/np.linalg.norm(rhs)
+        instrumentation.observe('direct_solver_factorization_residual', residual)
+        if not np.all(np.isfinite(solution)) or residual > tolerance or pivot_ratio < n*np.finfo(float).eps:
+            raise ValueError("The normal equations are singular, relative residual " + str(residual) + " and pivot "
+                             "ratio " + str(pivot_ratio) + " of the factorization, the displacements are not uniquely "
+                             "determined by the strains, check the boundary conditions or use the lsqr solver")
+
+    def _compute_block_preconditioner(self):
+        # The diagonal blocks of the normal matrix B_red^T B_red coupling the three displacement components of each
+        # node, computed column pair by column pair without forming the normal matrix
+        with instrumentation.stage('block_preconditioner'):
+            nodes = self.cols_to_keep//3
+            self.block_components = self.cols_to_keep % 3
+            block_nodes, self.block_index = np.unique(nodes, return_inverse=True)
+            columns = -np.ones((block_nodes.shape[0], 3), dtype=int)
+            columns[self.block_index, self.block_components] = np.arange(self.cols_to_keep.shape[0])
+            kept = columns >= 0
+            if self.matrix_free:
+                # The blocks of the unscaled columns are computed from the element data, see _scale_b_operator
+                scale_factors = np.ones(columns.shape)
+                scale_factors[kept] = self.scale_factors[columns[kept]]
+                blocks = self.normal_blocks[block_nodes]/(scale_factors[:, :, np.newaxis]
+                                                          * scale_factors[:, np.newaxis, :])
+                blocks *= np.logical_and(kept[:, :, np.newaxis], kept[:, np.newaxis, :])
+            else:
+                blocks = np.zeros((block_nodes.shape[0], 3, 3))
+                for a in range(3):
+                    for b in range(a, 3):
+                        pairs = np.logical_and(kept[:, a], kept[:, b])
+                        values = np.asarray(self.B_red[:, columns[pairs, a]].multiply(
+                            self.B_red[:, columns[pairs, b]]).sum(axis=0)).ravel()
+                        blocks[pairs, a, b] = values
+                        blocks[pairs, b, a] = values
+            # Constrained components are decoupled with a unit diagonal
+            for a in range(3):
+                blocks[np.logical_not(kept[:, a]), a, a] = 1.
+            self.inverse_blocks = np.linalg.inv(blocks)
+
+    def _apply_preconditioner(self, r):
+        padded = np.zeros((self.inverse_blocks.shape[0], 3))
+        padded[self.block_index, self.block_components] = r
+        return np.einsum('nij,nj->ni', self.inverse_blocks, padded)[self.block_index, self.block_components]
+
+    def _pcg(self, rhs, x0=None):
+        # Conjugate gradients on the normal equations B_red^T B_red x = B_red^T rhs
+        b = self.B_red.T*rhs
+        x = np.zeros(b.shape[0]) if x0 is None else np.array(x0)
+        r = b - self.B_red.T*(self.B_red*x)
+        z = self._apply_preconditioner(r)
+        p = z.copy()
+        rz = np.dot(r, z)
+        b_norm = max(np.linalg.norm(b), 1e-300)
+        max_iterations = b.shape[0] if self.max_iterations is None else self.max_iterations
+        iterations = 0
+        while np.linalg.norm(r) > self.tolerance*b_norm and iterations < max_iterations:
+            q = self.B_red.T*(self.B_red*p)
+            alpha = rz/np.dot(p, q)
+            x += alpha*p
+            r -= alpha*q
+            z = self._apply_preconditioner(r)
+            rz_new = np.dot(r, z)
+            p = z + rz_new/rz*p
+            rz = rz_new
+            iterations += 1
+        return x, iterations, np.linalg.norm(r)/b_norm
+
+    def _lsqr(self, rhs):
+        with instrumentation.stage('lsqr'):
+            solution = lsqr(self.B_red, rhs, show=True)
+        instrumentation.observe('lsqr_iterations', solution[2])
+        instrumentation.observe('lsqr_residual_norm', solution[3])
+        instrumentation.observe('lsqr_relative_residual_norm', solution[3]/max(np.linalg.norm(rhs), 1e-300))
+        return solution[0]
+
+    def calculate_deformations(self, step_name=None, frame_number=-1, strain=None, odb_file_name=None):
+        # The strains can be given directly, n x 6, instead of being read from the odb. They can also be read from
+        # another odb with the same mesh, which allows reusing the calculator for several simulations. Strains for k
+        # steps, k x n x 6, are solved as one block and the displacements and errors are returned for each step
+        if strain is None:
+            odb_file_name = self.odb_file_name if odb_file_name is None else odb_file_name
+            strain = self.abq.read_data_from_odb(self.stain_field_id, odb_file_name, step_name=step_name,
+                                                 frame_number=frame_number, set_name=self.set_name,
+                                                 instance_name=self.instance_name)
+        steps = np.asarray(strain).ndim == 3
+        strain = np.asarray(strain).reshape((-1, self.gauss_point_volumes.shape[0]))*self.gauss_point_volumes
+        bc_displacements = np.zeros(self.nodal_displacements.shape[0])
+        bc_displacements[self.bc_cols] = self.bc_vals
+        rhs = strain - self.B_matrix*bc_displacements
+
+        if self.solver == 'direct':
+            with instrumentation.stage('direct_solve', items=rhs.shape[0]):
+                calc_displacements = np.asarray(self.factorization(self.B_red.T*rhs.T)).T
+            residual_norms = np.linalg.norm(self.B_red*calc_displacements.T - rhs.T, axis=0)
+            for residual_norm, rhs_norm in zip(residual_norms, np.linalg.norm(rhs, axis=1)):
+                instrumentation.observe('direct_solver_relative_residual_norm', residual_norm/max(rhs_norm, 1e-300))
+            if self.verify_solver:
+                lsqr_displacements = self._lsqr(rhs[0])
+                deviation = (np.linalg.norm(calc_displacements[0] - lsqr_displacements)
+                             / max(np.linalg.norm(lsqr_displacements), 1e-300))
+                lsqr_residual_norm = np.linalg.norm(self.B_red*lsqr_displacements - rhs[0])
+                print("Direct solver: relative deviation from lsqr", deviation, "residual norm", residual_norms[0],
+                      "lsqr residual norm", lsqr_residual_norm)
+                instrumentation.observe('direct_solver_lsqr_deviation', deviation)
+        elif self.solver == 'pcg':
+            calc_displacements = np.zeros((rhs.shape[0], self.cols_to_keep.shape[0]))
+            for i, step_rhs in enumerate(rhs):
+                with instrumentation.stage('pcg'):
+                    # Consecutive steps differ only slightly and each step starts from the solution of the previous
+                    calc_displacements[i], iterations, residual = self._pcg(step_rhs, self.previous_solution)
+                self.previous_solution = calc_displacements[i]
+                print("PCG converged in" if residual <= self.tolerance else "PCG did not converge in", iterations,
+                      "iterations, relative residual of the normal equations", residual)
+                instrumentation.observe('pcg_iterations', iterations)
+                instrumentation.observe('pcg_relative_residual_norm', residual)
+            if self.verify_solver:
+                lsqr_displacements = self._lsqr(rhs[0])
+                deviation = (np.linalg.norm(calc_displacements[0] - lsqr_displacements)
+                             / max(np.linalg.norm(lsqr_displacements), 1e-300))
+                print("PCG solver: relative deviation from lsqr", deviation)
+                instrumentation.observe('pcg_lsqr_deviation', deviation)
+        else:
+            calc_displacements = np.array([self._lsqr(step_rhs) for step_rhs in rhs])
         calc_displacements /= self.scale_factors
-        self.nodal_displacements[self.cols_to_keep] = calc_displacements
-        error = (strain - self.B_matrix*self.nodal_displacements)/self.gauss_point_volumes
-        nodal_displacements = self.nodal_displacements.reshape((self.nodal_displacements.shape[0]//3, 3))
-        error = error.reshape((error.shape[0]//6, 6))
-        return nodal_displacements, error
-
-
-def calculate_element_data(element, idx):
-    displacement_comp = np.zeros(element.dofs)
-    n = element.dofs*element.strains_components
-    dofs = element.dofs
-    col = np.zeros(n)
-    row = np.zeros(n)
-    values = np.zeros(n)
-    gp_volume = np.zeros(element.gauss_points.shape[0]*6)
-    strain_line = 0
-    for k, n in enumerate(element.node_labels):
-        displacement_comp[3*k] = 3*n
-        displacement_comp[3*k + 1] = 3*n + 1
-        displacement_comp[3*k + 2] = 3*n + 2
-    for j, gp in enumerate(element.gauss_points):
-        B = element.B(*gp)
-
-        for comp in range(6):
-            col[strain_line*dofs:strain_line*dofs + dofs] = displacement_comp
-            row[strain_line*dofs:strain_line*dofs + element.dofs] = strain_line + idx*element.strains_components
-            values[strain_line*dofs:strain_line*dofs + dofs] = B[comp, :]
-            strain_line += 1
-
-        gp_volume[6*j:6*j + 6] = element.gp_volume(j)
-    return col, row, values, gp_volume
+
+        displacements = np.tile(self.nodal_displacements, (rhs.shape[0], 1))
+        displacements[:, self.cols_to_keep] = calc_displacements
+        self.nodal_displacements[:] = displacements[-1]
+        error = (strain - (self.B_matrix*displacements.T).T)/self.gauss_point_volumes
+        nodal_displacements = displacements.reshape((rhs.shape[0], -1, 3))
+        error = error.reshape((rhs.shape[0], -1, 6))
+        if steps:
+            return nodal_displacements, error
+        return nodal_displacements[0], error[0]
+
+
+def factor_arrays(factor):
+    """
+    Returns the factors of P_r A P_c = L U for a SuperLU factorization or a Cholesky factorization from scikit-sparse,
+    where U = L^T and is not returned, as a dict of arrays, see triangular_solver
+    """
+    if hasattr(factor, 'perm_r'):
+        return {'lower': factor.L, 'upper': factor.U, 'row_permutation': factor.perm_r,
+                'column_permutation': factor.perm_c}
+    # The Cholesky factorization is L L^T = A[P, :][:, P]
+    permutation = np.argsort(factor.P())
+    return {'lower': factor.L(), 'upper': None, 'row_permutation': permutation, 'column_permutation': permutation}
+
+
+def triangular_solver(lower, upper, row_permutation, column_permutation):
+    """
+    Returns a function solving A x = b, for one or several right hand sides, with the factors of P_r A P_c = L U,
+    where P_r b is b permuted by row_permutation and P_c z is z permuted by column_permutation. L has a unit diagonal
+    as given by SuperLU unless upper is None, for a Cholesky factorization where U = L^T
+    """
+    unit_lower = upper is not None
+    lower = lower.tocsr()
+    upper = lower.T.tocsr() if upper is None else upper.tocsr()
+
+    def solve(rhs):
+        permuted_rhs = np.empty_like(rhs)
+        permuted_rhs[row_permutation] = rhs
+        z = spsolve_triangular(upper, spsolve_triangular(lower, permuted_rhs, lower=True, unit_diagonal=unit_lower),
+                               lower=False)
+        return z[column_permutation]
+    return solve
+
+
+def calculate_element_batch_data(element_class, connectivity, xe, first_rows):
+    """
+    Calculates the entries of the B-matrix for a batch of elements of the same type at once, see Element.batch_B
+    :param element_class:   the element type, for instance C3D8
+    :param connectivity:    n_elem x n_nodes array with the node numbers of the elements
+    :param xe:              n_elem x n_nodes x 3 array with the nodal coordinates of the elements
+    :param first_rows:      array with the first strain row of each element
+    :return:                arrays with the rows, columns and values of the entries, n_elem x 6 n_gp array with the
+                            strain rows of the elements and an array of the same shape with the Gauss point volume for
+                            each strain row
+    """
+    B, volumes = element_class.batch_B(xe)
+    n, gps = volumes.shape
+    # One row for each strain component at each Gauss point and one column for each degree of freedom
+    B = B.reshape(n, 6*gps, -1)
+    element_dofs = (3*np.asarray(connectivity, dtype=np.int64)[:, :, np.newaxis] + np.arange(3)).reshape(n, -1)
+    element_strain_rows = np.asarray(first_rows, dtype=np.int64)[:, np.newaxis] + np.arange(6*gps)
+    rows = np.broadcast_to(element_strain_rows[:, :, np.newaxis], B.shape).ravel()
+    cols = np.broadcast_to(element_dofs[:, np.newaxis, :], B.shape).ravel()
+    return rows, cols, B.ravel(), element_strain_rows, np.repeat(volumes, 6, axis=1)
 
 
 def main():
@@ -0,0 +1,260 @@
+from __future__ import print_function, division
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+
+def run_job(job):
+    function, args, kwargs = job
+    return function(*args, **kwargs)
+
+
+class LocalBackend:
+    """
+    Executes jobs, tuples (function, args, kwargs) as used by multiprocesser, in a pool of processes on this machine
+    """
+    def __init__(self, cpus=None):
+        self.cpus = multiprocessing.cpu_count() if cpus is None else cpus
+
+    def imap_unordered(self, job_list):
+        # Yields the results of the jobs in the order they complete
+        pool = multiprocessing.Pool(self.cpus)
+        try:
+            for result in pool.imap_unordered(run_job, job_list):
+                yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def map(self, job_list):
+        pool = multiprocessing.Pool(self.cpus)
+        try:
+            results = pool.map(run_job, job_list)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return results
+
+
+class FileQueueBackend:
+    """
+    Executes jobs through a job queue on a shared file system, processed by worker daemons on any number of machines,
+    see run_worker. A job is a pickle file moving from the directory pending to running, when claimed by a worker, and
+    the result is written to done. All moves are renames which are atomic on the same file system, so a job is only
+    claimed by one worker and a result file is never read before it is complete. A worker refreshes the modification
+    time of its running job as a heartbeat and a job whose heartbeat stops, as its worker died, is moved back to
+    pending after lease_time seconds and executed by another worker.
+    """
+    def __init__(self, queue_directory, poll_interval=0.5, timeout=3600., lease_time=60., max_attempts=3):
+        """
+        :param timeout:         seconds without any job completing after which the jobs are considered lost and an
+                                error is raised, for instance when no worker is running
+        :param lease_time:      seconds without a heartbeat after which a running job is reclaimed, the modification
+                                times are compared with the clock of this process only, so the clocks of the workers
+                                need not be synchronized. Must be well above the heartbeat interval of the workers
+        :param max_attempts:    number of times a job is started before an error is raised, a job killing its workers
+                                is not retried forever
+        """
+        self.queue_directory = queue_directory
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        for directory in queue_directories(queue_directory):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _submit(self, job_list):
+        pending_directory, _, _ = queue_directories(self.queue_directory)
+        batch = uuid.uuid4().hex
+        job_names = []
+        for i, job in enumerate(job_list):
+            # Zero padded so that the workers, taking the jobs in the sorted order of their names, start them in the
+            # submitted order, for instance the most expensive chunks first
+            job_name = '%s_%08d.pkl' % (batch, i)
+            temp_file_name = os.path.join(self.queue_directory, job_name + '.tmp')
+            with open(temp_file_name, 'wb') as job_file:
+                pickle.dump(job, job_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file_name, os.path.join(pending_directory, job_name))
+            job_names.append(job_name)
+        return job_names
+
+    def _collect(self, job_names):
+        # Yields the index and the result of the jobs as they complete
+        _, _, done_directory = queue_directories(self.queue_directory)
+        remaining = set(job_names)
+        indices = {job_name: i for i, job_name in enumerate(job_names)}
+        heartbeats = {}
+        attempts = {}
+        last_completion_time = time.time()
+        while remaining:
+            completed = remaining.intersection(os.listdir(done_directory))
+            for job_name in sorted(completed, key=indices.get):
+                result_file_name = os.path.join(done_directory, job_name)
+                with open(result_file_name, 'rb') as result_file:
+                    status, result = pickle.load(result_file)
+                os.remove(result_file_name)
+                remaining.remove(job_name)
+                if status == 'error':
+                    raise RuntimeError("Job " + job_name + " failed in a worker:\n" + result)
+                last_completion_time = time.time()
+                yield indices[job_name], result
+            if remaining:
+                if time.time() - last_completion_time > self.timeout:
+                    raise RuntimeError(str(len(remaining)) + " jobs in " + self.queue_directory
+                                       + " did not complete within the timeout")
+                self._reclaim(remaining, heartbeats, attempts)
+                time.sleep(self.poll_interval)
+
+    def _reclaim(self, remaining, heartbeats, attempts):
+        # Moves the running jobs whose heartbeat, the modification time of the running file, has not changed for
+        # lease_time seconds back to pending. heartbeats holds the last seen modification time of each running file
+        # and the time it was seen to change, attempts the number of times each reclaimed job was started
+        pending_directory, running_directory, _ = queue_directories(self.queue_directory)
+        now = time.time()
+        for running_name in os.listdir(running_directory):
+            # Running files are named <job name>.<worker name>
+            job_name = running_name[:running_name.find('.pkl') + 4]
+            if job_name not in remaining:
+                continue
+            running_file_name = os.path.join(running_directory, running_name)
+            try:
+                modification_time = os.stat(running_file_name).st_mtime
+            except OSError:
+                # Completed in the meantime
+                continue
+            if running_name not in heartbeats or heartbeats[running_name][0] != modification_time:
+                heartbeats[running_name] = (modification_time, now)
+                continue
+            if now - heartbeats[running_name][1] < self.lease_time:
+                continue
+            attempts[job_name] = attempts.get(job_name, 1) + 1
+            if attempts[job_name] > self.max_attempts:
+                raise RuntimeError("Job " + job_name + " was started " + str(self.max_attempts) + " times in "
+                                   + self.queue_directory + " and its workers died every time")
+            try:
+                os.rename(running_file_name, os.path.join(pending_directory, job_name))
+            except OSError:
+                continue
+            del heartbeats[running_name]
+            print("Reclaimed job", job_name, "from the worker", running_name[len(job_name) + 1:],
+                  "without a heartbeat for", self.lease_time, "s")
+
+    def imap_unordered(self, job_list):
+        for _, result in self._collect(self._submit(job_list)):
+            yield result
+
+    def map(self, job_list):
+        job_names = self._submit(job_list)
+        results = [None]*len(job_names)
+        for i, result in self._collect(job_names):
+            results[i] = result
+        return results
+
+
+def queue_directories(queue_directory):
+    return [os.path.join(queue_directory, name) for name in ('pending', 'running', 'done')]
+
+
+def heartbeat(file_name, interval, stop):
+    # Refreshes the modification time of a running job every interval seconds until stop is set, which tells
+    # FileQueueBackend that the worker is alive
+    while not stop.wait(interval):
+        try:
+            os.utime(file_name, None)
+        except OSError:
+            # Reclaimed by FileQueueBackend
+            return
+
+
+def run_worker(queue_directory, poll_interval=0.5, max_idle_time=None, heartbeat_interval=10.):
+    """
+    Worker daemon processing the jobs of a FileQueueBackend until it has been idle for max_idle_time seconds, forever
+    if not given. The modification time of the running job is refreshed every heartbeat_interval seconds, which must be
+    well below the lease time of the backend
+    """
+    pending_directory, running_directory, done_directory = queue_directories(queue_directory)
+    for directory in (pending_directory, running_directory, done_directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    worker_name = socket.gethostname() + '_' + str(os.getpid())
+    idle_since = time.time()
+    while max_idle_time is None or time.time() - idle_since < max_idle_time:
+        job_names = sorted(os.listdir(pending_directory))
+        if not job_names:
+            time.sleep(poll_interval)
+            continue
+        for job_name in job_names:
+            running_file_name = os.path.join(running_directory, job_name + '.' + worker_name)
+            try:
+                os.rename(os.path.join(pending_directory, job_name), running_file_name)
+            except OSError:
+                # Claimed by another worker
+                continue
+            stop = threading.Event()
+            heartbeat_thread = threading.Thread(target=heartbeat, args=(running_file_name, heartbeat_interval, stop))
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+            try:
+                with open(running_file_name, 'rb') as job_file:
+                    job = pickle.load(job_file)
+                try:
+                    result = ('ok', run_job(job))
+                except Exception:
+                    result = ('error', traceback.format_exc())
+            finally:
+                stop.set()
+                heartbeat_thread.join()
+            idle_since = time.time()
+            try:
+                os.remove(running_file_name)
+            except OSError:
+                # The job was reclaimed, after a heartbeat was missed, and its result comes from another worker
+                break
+            temp_file_name = os.path.join(queue_directory, job_name + '.' + worker_name + '.tmp')
+            with open(temp_file_name, 'wb') as result_file:
+                pickle.dump(result, result_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file_name, os.path.join(done_directory, job_name))
+            break
+
+
+def start_local_workers(queue_directory, workers, poll_interval=0.5, max_idle_time=None, heartbeat_interval=10.):
+    """
+    Starts worker daemons as processes on this machine, behaving as workers on separate machines sharing the queue
+    :return:    list with the worker processes
+    """
+    processes = []
+    for _ in range(workers):
+        process = multiprocessing.Process(target=run_worker, args=(queue_directory, poll_interval, max_idle_time,
+                                                                   heartbeat_interval))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker daemon for a file queue execution backend")
+    parser.add_argument('queue_directory')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--max-idle-time', type=float, default=None)
+    parser.add_argument('--heartbeat-interval', type=float, default=10.)
+    args = parser.parse_args()
+    run_worker(args.queue_directory, args.poll_interval, args.max_idle_time, args.heartbeat_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+from __future__ import print_function, division
+
+import os
+import socket
+import time
+
+import numpy as np
+
+from checkpoints import load_arrays, save_arrays
+from execution_backends import LocalBackend
+import instrumentation
+from material_model.material_model import MaterialModel, stress_invariants
+
+
+def estimate_cost(material_parameters, static_stresses, cyclic_stresses):
+    """
+    Estimates the relative cost of integrating the material model for each point from the ratio between the
+    frictional load q/g and the shakedown limit H1. Points below the limit approach a saturated state after a few
+    steps while points above the limit keep accumulating strain and need many integration steps
+    :param material_parameters:     the material parameters
+    :param static_stresses:         n x 6 array with the static stresses
+    :param cyclic_stresses:         n x 6 array with the cyclic stresses, or k x n x 6 for a load spectrum
+    :return:                        array with the estimated cost for each point
+    """
+    model = MaterialModel(material_parameters)
+    cyclic_stresses = np.asarray(cyclic_stresses)
+    if cyclic_stresses.ndim == 2:
+        cyclic_stresses = cyclic_stresses[np.newaxis, :, :]
+    load = np.zeros(static_stresses.shape[0])
+    for cyclic_stress in cyclic_stresses:
+        p0, _, q, _ = stress_invariants(cyclic_stress, np.asarray(static_stresses))
+        load = np.maximum(load, model.frictional_load(p0, q))
+    return load/max(model.H1, 1e-12)
+
+
+def evaluate_chunk(function, indices, args, kwargs):
+    start_time = time.time()
+    counters = dict(instrumentation.get_report().counters)
+    result = function(*args, **kwargs)
+    # The counters recorded in the worker, for instance by the material model, are returned to the calling process
+    counters = instrumentation.counter_difference(instrumentation.get_report().counters, counters)
+    return indices, result, socket.gethostname() + ':' + str(os.getpid()), time.time() - start_time, counters
+
+
+def evaluate_gauss_points(function, material_parameters, cycles, static_stresses, cyclic_stresses, permanent_strains,
+                          state, initial_state=None, cpus=None, chunk_size=100, backend=None,
+                          checkpoint_directory=None, point_kwargs=None, **kwargs):
+    """
+    Evaluates the permanent strains by dispatching small chunks of points to the workers of an execution backend as
+    workers become idle. The points are sorted by the estimated cost, see estimate_cost, and the most expensive chunks
+    are dispatched first so that the cheap chunks fill the gaps at the end of the run. Sorting also groups points with a
+    similar behaviour in the same chunk, which benefits the step size control of the stacked integration.
+    :param function:            function(material_parameters, cycles, static_stresses, cyclic_stresses, **kwargs)
+                                returning the permanent strains, len(cycles) x m x 6, and the state, r x m, for a
+                                chunk of m points, typically evaluate_permanent_strain_for_gp
+    :param material_parameters: the material parameters
+    :param cycles:              array with the cycle numbers
+    :param static_stresses:     n x 6 array with the static stresses
+    :param cyclic_stresses:     n x 6 array with the cyclic stresses, or k x n x 6 for a load spectrum
+    :param permanent_strains:   len(cycles) x n x 6 array where the permanent strains are stored
+    :param state:               r x n array where the material state is stored
+    :param initial_state:       r x n array with the initial material state, passed to function if given
+    :param cpus:                number of worker processes, the number of cores if not given, only used without a
+                                backend
+    :param chunk_size:          number of points in each chunk
+    :param backend:             execution backend, see execution_backends, a LocalBackend with cpus processes if not
+                                given
+    :param checkpoint_directory:    if given, each evaluated chunk is saved in this directory as it completes and the
+                                    chunks found in the directory are not evaluated again, which resumes an
+                                    interrupted evaluation. The directory must only hold chunks for the same inputs
+    :param point_kwargs:        dict with arrays having one value for each point along the last axis, or functions
+                                returning the values for an array of point indices, passed to function with the
+                                values of the points of each chunk. The functions are called in this process, so only
+                                the values of the chunk are sent to the workers
+    :param kwargs:              passed to function
+    :return:                    dict with the busy time in seconds for each worker process
+    """
+    if backend is None:
+        backend = LocalBackend(cpus)
+    n = static_stresses.shape[0]
+    order = np.argsort(-estimate_cost(material_parameters, static_stresses, cyclic_stresses), kind='stable')
+    completed_chunks = set()
+    if checkpoint_directory is not None:
+        # The position of the first point of a chunk in the evaluation order identifies the chunk
+        positions = np.empty(n, dtype=int)
+        positions[order] = np.arange(n)
+        if not os.path.isdir(checkpoint_directory):
+            os.makedirs(checkpoint_directory)
+        for i in range(0, n, chunk_size):
+            data = load_arrays(chunk_file_name(checkpoint_directory, i//chunk_size))
+            if data is not None and np.array_equal(data['indices'], order[i:i + chunk_size]):
+                permanent_strains[:, data['indices'], :] = data['strain']
+                state[:, data['indices']] = data['state']
+                completed_chunks.add(i//chunk_size)
+        if completed_chunks:
+            print("Loaded", len(completed_chunks), "evaluated chunks from", checkpoint_directory)
+
+    def jobs():
+        # The backends consume the generator eagerly, the task handler of the pool of LocalBackend as fast as it can
+        # and FileQueueBackend when submitting, so the stresses of all chunks are queued at once, while the results
+        # are stored as they arrive
+        for i in range(0, n, chunk_size):
+            if i//chunk_size in completed_chunks:
+                continue
+            indices = order[i:i + chunk_size]
+            chunk_kwargs = dict(kwargs)
+            if initial_state is not None:
+                chunk_kwargs['initial_state'] = initial_state[:, indices]
+            for name, values in (point_kwargs or {}).items():
+                chunk_kwargs[name] = values(indices) if callable(values) else values[..., indices]
+            yield (evaluate_chunk, [function, indices, [material_parameters, cycles, static_stresses[indices],
+                                                        cyclic_stresses[..., indices, :]], chunk_kwargs], {})
+
+    busy_time = {}
+    evaluated_points = sum(order[i:i + chunk_size].shape[0] for i in range(0, n, chunk_size)
+                           if i//chunk_size in completed_chunks)
+    start_time = time.time()
+    for indices, (strain, chunk_state), worker, wall_time, counters in backend.imap_unordered(jobs()):
+        permanent_strains[:, indices, :] = strain
+        state[:, indices] = chunk_state
+        if checkpoint_directory is not None:
+            save_arrays(chunk_file_name(checkpoint_directory, positions[indices[0]]//chunk_size), indices=indices,
+                        strain=strain, state=chunk_state)
+        busy_time[worker] = busy_time.get(worker, 0.) + wall_time
+        instrumentation.get_report().merge_counters(counters)
+        evaluated_points += indices.shape[0]
+        print("Evaluated {i} out of {n} points".format(i=evaluated_points, n=n))
+    workers = backend.cpus if isinstance(backend, LocalBackend) else len(busy_time)
+    wall_time = time.time() - start_time
+    instrumentation.observe('gauss_point_worker_utilization',
+                            sum(busy_time.values())/max(workers*wall_time, 1e-12))
+    print_utilization(busy_time, wall_time, workers)
+    return busy_time
+
+
+def chunk_file_name(checkpoint_directory, chunk_number):
+    return os.path.join(checkpoint_directory, 'chunk_' + str(chunk_number) + '.npz')
+
+
+def print_utilization(busy_time, wall_time, workers):
+    print("Gauss point evaluation took {t:.1f} s using {w} workers".format(t=wall_time, w=workers))
+    for worker, busy in sorted(busy_time.items()):
+        print("\tWorker {w}: busy {b:.1f} s, utilization {u:.1f} %".format(w=worker, b=busy,
+                                                                          u=100*busy/max(wall_time, 1e-12)))
+    print("\tTotal utilization {u:.1f} %".format(u=100*sum(busy_time.values())/max(workers*wall_time, 1e-12)))
@@ -0,0 +1,180 @@
+from __future__ import print_function, division
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows where the peak memory is not reported
+    resource = None
+
+metric_prefix = 'railway_ballast_'
+
+
+def cpu_time():
+    # CPU time of this process and of its child processes that have terminated, such as the workers of a finished pool
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def peak_rss():
+    # Peak resident set size in bytes of this process or of its largest terminated child process
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else 1024*peak
+
+
+class RunReport:
+    """
+    Records the wall time, CPU time and peak memory of the stages of a run together with counters, for instance the
+    number of integrated Gauss points, and observations, for instance the number of lsqr iterations for each solve.
+    The report is written as JSON, see write_json, and in the Prometheus text format, see write_prometheus, for
+    tracking the throughput between runs
+    """
+    def __init__(self, name=''):
+        self.name = name
+        self.start_time = time.time()
+        self.stages = []
+        self.counters = OrderedDict()
+        self.observations = OrderedDict()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """
+        Context manager timing the enclosed block as the stage name. If items is given, the throughput of the stage is
+        reported as items per second, for instance Gauss points per second. Stages can be nested
+        """
+        record = OrderedDict([('name', name), ('items', items)])
+        wall_start = time.time()
+        cpu_start = cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - wall_start
+            record['cpu_time'] = cpu_time() - cpu_start
+            record['peak_rss'] = peak_rss()
+            if items is not None:
+                record['items_per_second'] = items/max(record['wall_time'], 1e-12)
+            self.stages.append(record)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge_counters(self, counters):
+        # Adds counters recorded in another process, see counter_difference
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def observe(self, name, value):
+        self.observations.setdefault(name, []).append(float(value))
+
+    def to_dict(self):
+        return OrderedDict([('name', self.name), ('start_time', self.start_time),
+                            ('wall_time', time.time() - self.start_time), ('peak_rss', peak_rss()),
+                            ('stages', self.stages), ('counters', self.counters),
+                            ('observations', self.observations)])
+
+    def write_json(self, file_name):
+        with open(file_name, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+    def stage_totals(self):
+        """
+        Aggregates the records of stages run several times, for instance a solve for each step, by name: the wall and
+        CPU times are summed, the peak memory is the maximum and the throughput is the total number of items over the
+        total wall time
+        :return:    OrderedDict with a dict for each stage name in the order the stages first completed
+        """
+        totals = OrderedDict()
+        for record in self.stages:
+            total = totals.setdefault(record['name'], {'runs': 0, 'wall_time': 0., 'cpu_time': 0., 'peak_rss': None,
+                                                       'items': None, 'items_wall_time': 0.})
+            total['runs'] += 1
+            total['wall_time'] += record['wall_time']
+            total['cpu_time'] += record['cpu_time']
+            if record.get('peak_rss') is not None:
+                total['peak_rss'] = max(total['peak_rss'] or 0, record['peak_rss'])
+            if record.get('items') is not None:
+                total['items'] = (total['items'] or 0) + record['items']
+                total['items_wall_time'] += record['wall_time']
+        for total in totals.values():
+            total['items_per_second'] = None
+            if total['items'] is not None:
+                total['items_per_second'] = total['items']/max(total['items_wall_time'], 1e-12)
+        return totals
+
+    def prometheus_lines(self):
+        # A stage run several times is reported once, aggregated by stage_totals, as each series must be unique
+        lines = []
+        run_label = 'run="' + self.name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        stage_metrics = [('runs', 'stage_runs', 'Number of times the stage ran'),
+                         ('wall_time', 'stage_wall_seconds', 'Total wall time of the stage'),
+                         ('cpu_time', 'stage_cpu_seconds', 'Total CPU time of the stage'),
+                         ('peak_rss', 'stage_peak_rss_bytes', 'Peak resident set size at the end of the stage'),
+                         ('items_per_second', 'stage_items_per_second', 'Throughput of the stage')]
+        totals = self.stage_totals()
+        for key, metric, description in stage_metrics:
+            stages = [(name, total) for name, total in totals.items() if total[key] is not None]
+            if not stages:
+                continue
+            lines.append('# HELP ' + metric_prefix + metric + ' ' + description)
+            lines.append('# TYPE ' + metric_prefix + metric + ' gauge')
+            for name, total in stages:
+                lines.append(metric_prefix + metric + '{' + run_label + ',stage="' + name + '"} '
+                             + repr(float(total[key])))
+        for name, value in self.counters.items():
+            lines.append('# TYPE ' + metric_prefix + name + '_total counter')
+            lines.append(metric_prefix + name + '_total{' + run_label + '} ' + repr(float(value)))
+        for name, values in self.observations.items():
+            lines.append('# TYPE ' + metric_prefix + name + ' summary')
+            lines.append(metric_prefix + name + '_count{' + run_label + '} ' + repr(float(len(values))))
+            lines.append(metric_prefix + name + '_sum{' + run_label + '} ' + repr(float(sum(values))))
+            lines.append('# TYPE ' + metric_prefix + name + '_max gauge')
+            lines.append(metric_prefix + name + '_max{' + run_label + '} ' + repr(float(max(values))))
+        return lines
+
+    def write_prometheus(self, file_name):
+        # Written to a temporary file first as a metrics collector may read the file at any time
+        with open(file_name + '.tmp', 'w') as metrics_file:
+            metrics_file.write('\n'.join(self.prometheus_lines()) + '\n')
+        os.rename(file_name + '.tmp', file_name)
+
+
+# The report of the current run in this process, used by the instrumented functions
+current_report = RunReport()
+
+
+def start_report(name=''):
+    global current_report
+    current_report = RunReport(name)
+    return current_report
+
+
+def get_report():
+    return current_report
+
+
+def stage(name, items=None):
+    return current_report.stage(name, items)
+
+
+def count(name, value=1):
+    current_report.count(name, value)
+
+
+def observe(name, value):
+    current_report.observe(name, value)
+
+
+def counter_difference(counters, previous_counters):
+    # The counters added since previous_counters, used to return the counters of a job executed in a worker process
+    return OrderedDict((name, value - previous_counters.get(name, 0)) for name, value in counters.items()
+                       if value != previous_counters.get(name, 0))
@@ -3,7 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.style
 
-from scipy.optimize import fmin
+from scipy.optimize import least_squares
 
 from experimental_results import sun_et_al_16
 from material_model import MaterialModel
@@ -20,60 +20,94 @@ plt.rc('font', **{'family': 'serif', 'serif': ['Computer Modern Roman'],
                   'monospace': ['Computer Modern Typewriter']})
 
 
-def residual(fitting_parameters, par, parameters_to_fit, experiments, residual_func):
-    par[parameters_to_fit] = fitting_parameters
-    job_list = [(residual_func, [par, experiment], {})
-                for experiment in experiments]
-    simulations = multi_processer(job_list, delay=0.)
-    res = 0
-    static_stress = -30*np.array([1, 1, 1, 0, 0, 0])
-    cyclic_stress = -320*np.array([1, 0, 0, 0, 0, 0])
-    model = MaterialModel(material_parameters=par)
-    model.update(np.array([1, 1e5]), cyclic_stress, static_stress)
-    inst_e = -model.deviatoric_strain()[-1, 0]
-    for sim in simulations:
-        r, e_sim, e_exp, p, q, f = sim
-
-        res += r
-        print("\tf = " + str(f) + ",\t p = " + str(p) + " , q = " + str(q) + ": e_exp = " + str(e_exp) + "\t e_sim = "
-              + str(e_sim) + "\t r = " + str(r))
-    # if inst_e < 0.8:
-    #     print("Strain at problematic load", inst_e)
-    #     res += (0.8 - inst_e)**2*100
-    print(fitting_parameters)
-    print(res)
-
-    return res
-
-
-def calc_deviatoric_residual_for_data_experiment(par, experiment):
+def calc_deviatoric_residual_vector_for_data_experiment(par, experiment, parameters_to_fit):
+    """
+    Residual vector min(model_e, 0.3) - e_exp for the deviatoric axial strain of an experiment
+    :return:    the residual vector and its Jacobian with respect to the parameters in parameters_to_fit
+    """
     e0 = experiment.deviatoric_axial_strain()[0]
     e_exp = experiment.deviatoric_axial_strain() - e0
     static_stress = -experiment.p*np.array([1, 1, 1, 0, 0, 0])
     cyclic_stress = -experiment.q*np.array([1, 0, 0, 0, 0, 0])
     model = MaterialModel(material_parameters=par)
-    model.update(experiment.cycles, cyclic_stress, static_stress)
+    model.update(experiment.cycles, cyclic_stress, static_stress, sensitivities=True)
     model_e = -model.deviatoric_strain()[:, 0]
+    jacobian = -model.deviatoric_strain_sensitivities()[:, 0, parameters_to_fit]
     idx = np.logical_and(e_exp < 0.3, abs(e_exp) != 0)
     e_corr = 0 + model_e
+    jacobian[e_corr > 0.3, :] = 0
     e_corr[e_corr > 0.3] = 0.3
-    r = np.sqrt(np.sum((e_corr[idx] - e_exp[idx])**2))
-    return r, round(model_e[-1] + e0, 4), round(e_exp[-1] + e0, 4), experiment.p, experiment.q, experiment.f
+    return e_corr[idx] - e_exp[idx], jacobian[idx, :]
 
 
-def calc_volumetric_residual_for_data_experiment(par, experiment):
+def calc_volumetric_residual_vector_for_data_experiment(par, experiment, parameters_to_fit):
+    """
+    Residual vector for the volumetric strain of an experiment, scaled by 100/sqrt(n) for n measured values so that
+    its norm is the root mean square error in percent
+    :return:    the residual vector and its Jacobian with respect to the parameters in parameters_to_fit
+    """
     e0 = experiment.volumetric_strain[0]
     e_exp = experiment.volumetric_strain - e0
     static_stress = -experiment.p*np.array([1, 1, 1, 0, 0, 0])
     cyclic_stress = -experiment.q*np.array([1, 0, 0, 0, 0, 0])
     model = MaterialModel(material_parameters=par)
-    model.update(experiment.cycles, cyclic_stress, static_stress)
+    model.update(experiment.cycles, cyclic_stress, static_stress, sensitivities=True)
     model_e = -model.volumetric_strain()
+    jacobian = -model.volumetric_strain_sensitivities()[:, parameters_to_fit]
     idx = np.logical_and(e_exp < 0.3, abs(e_exp) > 1e-3)
-    r = np.sqrt(np.sum((model_e[idx] - e_exp[idx])**2/e_exp.shape[0]))*100
-    # if experiment.p == 10 and experiment.f == 10 and experiment.q == 230:
-    #     r = 0
-    return r, round(model_e[-1] + e0, 4), round(e_exp[-1] + e0, 4), experiment.p, experiment.q, experiment.f
+    scale = 100/np.sqrt(e_exp.shape[0])
+    return (model_e[idx] - e_exp[idx])*scale, jacobian[idx, :]*scale
+
+
+class LeastSquaresProblem:
+    """
+    Residual vector and analytic Jacobian for scipy.optimize.least_squares stacked over all experiments. The model is
+    evaluated once per parameter set and the result is shared between the residual and Jacobian calls.
+
+    The calibration minimizes the sum of the residual norms of the experiments, sum(|r_i|), which weights the
+    experiments differently than the sum of squares sum(|r_i|**2) minimized by least_squares. The residual vector of
+    each experiment is therefore divided by sqrt(|r_i|), making its sum of squares |r_i|, with the Jacobian
+    (J_i - r_i r_i^T J_i/(2 |r_i|**2))/sqrt(|r_i|)
+    """
+    def __init__(self, par, parameters_to_fit, experiments, residual_vector_func):
+        self.par = np.array(par, dtype=float)
+        self.parameters_to_fit = list(parameters_to_fit)
+        self.experiments = experiments
+        self.residual_vector_func = residual_vector_func
+        self._fitting_parameters = None
+        self._residuals = None
+        self._jacobian = None
+
+    def _evaluate(self, fitting_parameters):
+        if self._fitting_parameters is not None and np.array_equal(fitting_parameters, self._fitting_parameters):
+            return
+        par = np.array(self.par)
+        par[self.parameters_to_fit] = fitting_parameters
+        job_list = [(self.residual_vector_func, [par, experiment, self.parameters_to_fit], {})
+                    for experiment in self.experiments]
+        simulations = [self.norm_residual(r, jacobian) for r, jacobian in multi_processer(job_list, delay=0.)]
+        self._fitting_parameters = np.array(fitting_parameters)
+        self._residuals = np.concatenate([r for r, _ in simulations])
+        self._jacobian = np.vstack([jacobian for _, jacobian in simulations])
+        print(fitting_parameters)
+        print(np.sum(self._residuals**2))
+
+    @staticmethod
+    def norm_residual(r, jacobian):
+        # Residual vector with the sum of squares |r| and its Jacobian, the norm is not differentiable at r = 0 where
+        # the residual is left as it is
+        norm = np.linalg.norm(r)
+        if norm == 0:
+            return r, jacobian
+        return r/np.sqrt(norm), (jacobian - np.outer(r, np.dot(r, jacobian))/(2*norm**2))/np.sqrt(norm)
+
+    def residuals(self, fitting_parameters):
+        self._evaluate(fitting_parameters)
+        return self._residuals
+
+    def jacobian(self, fitting_parameters):
+        self._evaluate(fitting_parameters)
+        return self._jacobian
 
 
 def main():
@@ -84,15 +118,11 @@ def main():
     par = np.array(get_parameters(20, common=False))
 
     print(par)
-    for i in range(50):
-        old_par = par[parameters_to_fit]
-        par[parameters_to_fit] = fmin(residual, [old_par],
-                                      args=(par, parameters_to_fit, fitting_dataset,
-                                            calc_volumetric_residual_for_data_experiment), maxfun=1e6,
-                                      maxiter=1e6)
-        if np.sum((1 - par[parameters_to_fit]/old_par)**2) < 1e-3:
-            break
-        print(par[parameters_to_fit])
+    problem = LeastSquaresProblem(par, parameters_to_fit, fitting_dataset,
+                                  calc_volumetric_residual_vector_for_data_experiment)
+    solution = least_squares(problem.residuals, par[parameters_to_fit], jac=problem.jacobian, x_scale='jac')
+    par[parameters_to_fit] = solution.x
+    print(par[parameters_to_fit])
 
 
 if __name__ == '__main__':
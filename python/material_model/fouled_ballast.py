@@ -1,6 +1,6 @@
 import numpy as np
 
-from scipy.optimize import fmin
+from scipy.optimize import least_squares
 
 import matplotlib.pyplot as plt
 import matplotlib.style
@@ -54,6 +54,10 @@ def assign_volumetric_parameters(old_parameters, new_volumetric_parameters):
     return old_parameters
 
 
+axial_parameter_indices = [0, 1, 4, 5]
+volumetric_parameter_indices = [6, 7, 8, 9]
+
+
 def axial_residual(calibration_parameters, experiment):
     par = assign_axial_parameters(calibration_parameters)
     e0 = experiment.deviatoric_axial_strain()[0]
@@ -84,15 +88,65 @@ def volumetric_residual(calibration_parameters, old_parameters, experiment):
     return r
 
 
+def axial_residual_vector(calibration_parameters, experiment):
+    """
+    Residual vector with the sum of squares equal to the square of axial_residual
+    :return:    the residual vector and its Jacobian with respect to the calibration parameters
+    """
+    par = assign_axial_parameters(calibration_parameters)
+    e0 = experiment.deviatoric_axial_strain()[0]
+    e_exp = experiment.deviatoric_axial_strain() - e0
+    static_stress = -experiment.p*np.array([1, 1, 1, 0, 0, 0])
+    cyclic_stress = -experiment.q*np.array([1, 0, 0, 0, 0, 0])
+    model = MaterialModel(material_parameters=par)
+    model.update(experiment.cycles, cyclic_stress, static_stress, sensitivities=True)
+    model_e = -model.deviatoric_strain()[:, 0]
+    jacobian = -model.deviatoric_strain_sensitivities()[:, 0, axial_parameter_indices]
+    idx = np.logical_and(e_exp < 0.3, abs(e_exp) != 0)
+    weight = np.sqrt(np.log(experiment.cycles[idx]))/e_exp.shape[0]
+    return (1 - model_e[idx]/e_exp[idx])*weight, -jacobian[idx, :]*(weight/e_exp[idx])[:, np.newaxis]
+
+
+def volumetric_residual_vector(calibration_parameters, old_parameters, experiment):
+    """
+    Residual vector with the sum of squares equal to the square of volumetric_residual
+    :return:    the residual vector and its Jacobian with respect to the calibration parameters
+    """
+    par = assign_volumetric_parameters(old_parameters, calibration_parameters)
+    e0 = -experiment.volumetric_strain[0]
+    e_exp = -experiment.volumetric_strain - e0
+    static_stress = -experiment.p*np.array([1, 1, 1, 0, 0, 0])
+    cyclic_stress = -experiment.q*np.array([1, 0, 0, 0, 0, 0])
+    model = MaterialModel(material_parameters=par)
+    model.update(experiment.cycles, cyclic_stress, static_stress, sensitivities=True)
+    model_e = -model.volumetric_strain()
+    jacobian = -model.volumetric_strain_sensitivities()[:, volumetric_parameter_indices]
+    return model_e - e_exp, jacobian
+
+
+def least_squares_fit(residual_vector_func, start_guess, args):
+    # The residuals and the Jacobian are computed in the same model evaluation and reused by the Jacobian call
+    cache = {}
+
+    def evaluate(x):
+        if 'x' not in cache or not np.array_equal(cache['x'], x):
+            cache['x'] = np.array(x)
+            cache['r'], cache['jac'] = residual_vector_func(x, *args)
+        return cache['r'], cache['jac']
+
+    solution = least_squares(lambda x: evaluate(x)[0], start_guess, jac=lambda x: evaluate(x)[1], x_scale='jac')
+    return solution.x
+
+
 def determine_axial_parameters(experiment):
-    return fmin(axial_residual, [2.17731700e+00, 3.49473023e-08, 4.57799168e+00, 2.54551805e+02],
-                args=(experiment,), maxfun=1e6, maxiter=1e6)
+    return least_squares_fit(axial_residual_vector,
+                             [2.17731700e+00, 3.49473023e-08, 4.57799168e+00, 2.54551805e+02], (experiment,))
+
 
 def determine_volumetric_parameters(experiment, old_parameters, start_guess=None):
     if start_guess is None:
         start_guess = [1.98002052e-02,  1.58308480e+01, -3.50874250e+03, -1.22550803e+00]
-    return fmin(volumetric_residual, start_guess,
-                args=(old_parameters, experiment), maxfun=1e6, maxiter=1e6)
+    return least_squares_fit(volumetric_residual_vector, start_guess, (old_parameters, experiment))
 
 
 def main():
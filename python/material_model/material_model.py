@@ -1,5 +1,11 @@
 import numpy as np
 from scipy.integrate import solve_ivp
+from scipy.interpolate import RegularGridInterpolator
+from scipy.sparse import diags, issparse
+
+import instrumentation
+
+implicit_methods = ('Radau', 'BDF', 'LSODA')
 
 
 def invariant_1(tensor):
@@ -7,12 +13,298 @@ def invariant_1(tensor):
 
 
 def von_mises(tensor):
-    return np.sqrt(np.sum(tensor[0:3]**2) + 3*np.sum(tensor[3:6]**2) - tensor[0]*tensor[1]
+    return np.sqrt(np.sum(tensor[0:3]**2, axis=0) + 3*np.sum(tensor[3:6]**2, axis=0) - tensor[0]*tensor[1]
                    - tensor[0]*tensor[2] - tensor[1]*tensor[2])
 
 
+def integrate_log_cycles(rate, cycles, y0, rtol=1e-5, atol=1e-8, method='RK45', jacobian=None):
+    """
+    Integrates dy/dN = rate(y) in a single adaptive pass in the logarithmic cycle variable s = ln(1 + N) and
+    evaluates the solution at all requested cycle numbers using the dense output of the integrator
+    :param rate:        function rate(y) returning dy/dN
+    :param cycles:      increasing array with the cycle numbers where the solution is evaluated, the first value is
+                        the cycle number of the initial state y0
+    :param y0:          initial state
+    :param rtol:        relative tolerance of the integrator
+    :param atol:        absolute tolerance of the integrator
+    :param method:      integration method passed to solve_ivp, use an implicit method for stiff problems
+    :param jacobian:    function jacobian(y) returning d(rate)/dy, only used by the implicit methods
+    :return:            len(cycles) x len(y0) array with the solution
+    """
+    s = np.log1p(np.asarray(cycles, dtype=float))
+    y = np.zeros((s.shape[0], y0.shape[0]))
+    y[0, :] = y0
+    if s.shape[0] == 1 or s[-1] == s[0]:
+        y[1:, :] = y0
+        return y
+
+    # dy/ds = dy/dN*dN/ds = rate(y)*(1 + N) = rate(y)*exp(s)
+    def rhs(s_, y_):
+        return np.exp(s_)*rate(y_)
+
+    def jac(s_, y_):
+        d_rate = jacobian(y_)
+        # LSODA only accepts dense Jacobians while Radau and BDF also take sparse ones
+        if method == 'LSODA' and issparse(d_rate):
+            d_rate = d_rate.toarray()
+        return np.exp(s_)*d_rate
+
+    options = {}
+    if jacobian is not None and method in implicit_methods:
+        options['jac'] = jac
+    solution = solve_ivp(rhs, [s[0], s[-1]], y0, method=method, t_eval=s, rtol=rtol, atol=atol, **options)
+    instrumentation.count('material_model_integrations')
+    instrumentation.count('material_model_rhs_evaluations', solution.nfev)
+    if not solution.success:
+        raise ValueError("Integration of the material model failed: " + solution.message)
+    return solution.y.T
+
+
+def integrate_compaction(cycles, c, b2, b3, nb, ev0=0.):
+    """
+    Closed form solution of the compaction law dev/dN = b2*max(c - b3*ev, 0)**nb for an arbitrary number of points
+    :param cycles:  array with the cycle numbers where the solution is evaluated, the first value is the cycle number
+                    of the initial state ev0
+    :param c:       array with the driving term b4*p0 + pc for each point
+    :param b2:      rate parameter
+    :param b3:      saturation parameter
+    :param nb:      exponent
+    :param ev0:     initial compaction strain, scalar or one value per point
+    :return:        len(cycles) x len(c) array with the volumetric compaction strain
+    """
+    c = np.asarray(c, dtype=float)
+    dn = (np.asarray(cycles, dtype=float) - cycles[0])[:, np.newaxis]
+    ev0 = np.broadcast_to(np.asarray(ev0, dtype=float), c.shape)
+    u0 = np.maximum(c - b3*ev0, 0.)
+    if b3 == 0:
+        return ev0 + b2*u0**nb*dn
+
+    # With u = c - b3*ev the law becomes du/dN = -b2*b3*u**nb which is separable, u reaches zero in finite time
+    # when nb < 1 and saturates for the remaining cycles
+    u = np.zeros((dn.shape[0], c.shape[0]))
+    active = u0 > 0
+    if nb == 1:
+        u[:, active] = u0[active]*np.exp(-b2*b3*dn)
+    else:
+        w = u0[active]**(1 - nb) + (nb - 1)*b2*b3*dn
+        saturated = w <= 0
+        w[saturated] = 1.
+        u[:, active] = np.where(saturated, 0., w**(1/(1 - nb)))
+    return ev0 + (u0 - u)/b3
+
+
+def check_integrate_compaction(parameter_sets, cycles=(0, 1, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7), tolerance=1e-6):
+    """
+    Compares integrate_compaction with a solution of the compaction law by solve_ivp with tight tolerances for a grid
+    of static pressures p0 and cyclic pressures pc for each parameter set and for the special cases of the closed form,
+    nb = 1, nb < 1 and b3 = 0, raises an AssertionError if the solutions differ by more than the tolerance times the
+    largest strain. The law does not depend on the von Mises stress q
+    :param parameter_sets:  list of material parameter sets, see MaterialModel
+    :return:                the largest difference relative to the largest strain
+    """
+    p0, pc = [values.ravel() for values in np.meshgrid([0., 5., 20., 60.], [-20., 0., 30., 100., 300.])]
+    ev0 = np.linspace(0, 1e-3, p0.shape[0])
+    cases = []
+    for parameters in parameter_sets:
+        model = MaterialModel(parameters)
+        cases.append((model.b4*p0 + pc, model.b2, model.b3, model.nb))
+    cases += [(p0 + pc, 1e-3, 10., 1.), (p0 + pc, 1e-4, 10., 0.5), (p0 + pc, 1e-6, 0., 2.)]
+    cycles = np.asarray(cycles, dtype=float)
+    max_error = 0.
+    for c, b2, b3, nb in cases:
+        closed_form = integrate_compaction(cycles, c, b2, b3, nb, ev0)
+        reference = np.zeros(closed_form.shape)
+        for i in range(c.shape[0]):
+            def rate(_, ev, c_=c[i]):
+                return [b2*max(c_ - b3*ev[0], 0.)**nb]
+            reference[:, i] = solve_ivp(rate, [cycles[0], cycles[-1]], [ev0[i]], t_eval=cycles, method='LSODA',
+                                        rtol=1e-11, atol=1e-15).y[0]
+        error = np.max(abs(closed_form - reference))/max(np.max(abs(reference)), 1e-300)
+        if error > tolerance:
+            raise AssertionError("integrate_compaction differs from solve_ivp by " + str(error) + " of the largest "
+                                 "strain for b2 = " + str(b2) + ", b3 = " + str(b3) + ", nb = " + str(nb))
+        max_error = max(max_error, error)
+    return max_error
+
+
+def check_update_batch(parameter_sets, cycles=(0, 1, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7), tolerance=2e-3):
+    """
+    Compares MaterialModel.update_batch, integrating all points as one stacked system, with MaterialModel.update for
+    each point on its own for a grid of static pressures p0, cyclic pressures pc and von Mises stresses q for each
+    parameter set, raises an AssertionError if they differ by more than the tolerance times the largest strain of a
+    point. The stacked system shares the step size control of the integrator between the points, so the strains only
+    agree to the accuracy of the integrator, a few 1e-4 of the largest strain with the default tolerances
+    :param parameter_sets:  list of material parameter sets, see MaterialModel
+    :return:                the largest difference relative to the largest strain of the point
+    """
+    p0, pc, q = [values.ravel() for values in np.meshgrid([0., 5., 20., 60.], [0., 30., 100.],
+                                                          np.linspace(0., 400., 9))]
+    static_stresses = np.zeros((p0.shape[0], 6))
+    static_stresses[:, 0:3] = -p0[:, np.newaxis]
+    cyclic_stresses = np.zeros((p0.shape[0], 6))
+    cyclic_stresses[:, 0:3] = -pc[:, np.newaxis] + q[:, np.newaxis]/3*np.array([1., 1., -2.])
+    max_error = 0.
+    for parameters in parameter_sets:
+        batch_strain = MaterialModel(parameters).update_batch(cycles, cyclic_stresses, static_stresses)
+        strain = np.zeros(batch_strain.shape)
+        for i in range(p0.shape[0]):
+            strain[:, i, :] = MaterialModel(parameters).update(cycles, cyclic_stresses[i], static_stresses[i])
+        error = np.max(np.max(abs(batch_strain - strain), axis=(0, 2))
+                       / np.maximum(np.max(abs(strain), axis=(0, 2)), 1e-300))
+        if error > tolerance:
+            raise AssertionError("update_batch differs from update by " + str(error) + " of the largest strain of a "
+                                 "point for the parameters " + str(list(parameters)))
+        max_error = max(max_error, error)
+    return max_error
+
+
+def stress_invariants(cyclic_stresses, static_stresses):
+    """
+    Computes the stress measures entering the material model for n stress states
+    :param cyclic_stresses:     n x 6 array with the cyclic stresses
+    :param static_stresses:     n x 6 array with the static stresses
+    :return:                    The static pressure p0 limited to non-negative values, the cyclic pressure pc, the von
+                                Mises stress q of the cyclic stress and the 6 x n array nij with the flow directions
+    """
+    # Working with the transposed stresses, 6 x n, so that the tensor functions operate on all points at once
+    static_stresses = static_stresses.T
+    cyclic_stresses = cyclic_stresses.T
+    p0 = -invariant_1(static_stresses)/3
+    pc = -invariant_1(cyclic_stresses)/3
+    p0[p0 < 0] = 0
+
+    q = von_mises(cyclic_stresses)
+    nij = np.zeros(cyclic_stresses.shape)
+    loaded = q > 0
+    nij[:, loaded] = 1.5*(cyclic_stresses[:, loaded] - invariant_1(cyclic_stresses[:, loaded])/3
+                          * np.array([1, 1, 1, 0, 0, 0])[:, np.newaxis])/q[loaded]
+    return p0, pc, q, nij
+
+
+class FrictionTable:
+    """
+    Precomputed solution of the nondimensional frictional law dx/dtau = max(a - 1 + exp(-x), 0)**gf with x(0) = 0
+    where x = nf*e is the scaled effective frictional strain, a = q/(g*H1) the scaled load and tau the scaled cycle
+    number. The table only depends on gf and can be reused for all parameter sets sharing that value. The grid is
+    refined until the interpolation error of x is below the relative tolerance, see check_friction_table
+    """
+    def __init__(self, gf, a_min=1e-4, a_max=4., tau_max=1e12, a_points=400, tau_points=1000, tolerance=1e-4,
+                 max_refinements=8):
+        self.gf = gf
+        # The solution changes character at a = 1, saturating below and growing without bound above, and the grid is
+        # refined geometrically towards that value
+        refinement = np.logspace(-10, -1, 91)
+        a = np.concatenate([np.exp(np.linspace(np.log(a_min), np.log(a_max), a_points)), 1 - refinement,
+                            1 + refinement, [1.]])
+        log_a = np.log(np.unique(a))
+        log_tau = np.linspace(np.log(1e-16), np.log(tau_max), tau_points)
+
+        # Intervals of the grid where linear interpolation of log x at the midpoint is off by more than half the
+        # tolerance, in each direction, are split until none is left. The error of the bilinear interpolation in a
+        # cell is then at most about the tolerance
+        for _ in range(max_refinements):
+            mid_log_a = (log_a[:-1] + log_a[1:])/2
+            mid_log_tau = (log_tau[:-1] + log_tau[1:])/2
+            all_log_tau = np.sort(np.concatenate([log_tau, mid_log_tau]))
+            log_x = np.log(self._solve(np.exp(np.concatenate([log_a, mid_log_a])), np.exp(all_log_tau)))
+            on_tau_grid = np.isin(all_log_tau, log_tau)
+            grid = log_x[:log_a.shape[0], on_tau_grid]
+            a_error = abs(np.expm1((grid[:-1] + grid[1:])/2 - log_x[log_a.shape[0]:, on_tau_grid]))
+            tau_error = abs(np.expm1((grid[:, :-1] + grid[:, 1:])/2 - log_x[:log_a.shape[0], ~on_tau_grid]))
+            split_a = np.max(a_error, axis=1) > tolerance/2
+            split_tau = np.max(tau_error, axis=0) > tolerance/2
+            if not np.any(split_a) and not np.any(split_tau):
+                break
+            log_a = np.sort(np.concatenate([log_a, mid_log_a[split_a]]))
+            log_tau = np.sort(np.concatenate([log_tau, mid_log_tau[split_tau]]))
+        else:
+            raise ValueError("The friction table for gf = " + str(gf) + " did not reach the tolerance " +
+                             str(tolerance) + " in " + str(max_refinements) + " refinements")
+
+        self.a = np.exp(log_a)
+        self.log_tau = log_tau
+        # Interpolating in logarithmic coordinates as the strain grows as a power of a and tau for small strains and
+        # linearly in tau for large loads
+        self._interpolator = RegularGridInterpolator((log_a, log_tau), grid)
+
+    def _solve(self, a, tau):
+        def rate(x):
+            return np.maximum(a - 1 + np.exp(-x), 0.)**self.gf
+
+        def jacobian(x):
+            f = np.maximum(a - 1 + np.exp(-x), 0.)
+            d_rate = np.zeros(f.shape[0])
+            d_rate[f > 0] = -self.gf*f[f > 0]**(self.gf - 1)*np.exp(-x[f > 0])
+            return diags(d_rate, format='csc')
+
+        # The first row of the solution is the initial state at tau = 0
+        x = integrate_log_cycles(rate, np.concatenate([[0], tau]), np.zeros(a.shape[0]), rtol=1e-10, atol=1e-14,
+                                 method='LSODA', jacobian=jacobian)
+        return x[1:, :].T
+
+    def covers(self, a, tau):
+        return np.logical_and(np.logical_and(a >= self.a[0], a <= self.a[-1]), tau <= np.exp(self.log_tau[-1]))
+
+    def __call__(self, a, tau):
+        """
+        Interpolates the scaled frictional strain, only valid for the points where covers(a, tau) is True
+        :param a:       array with scaled loads
+        :param tau:     array with scaled cycle numbers, same shape as a
+        :return:        array with the scaled effective frictional strain x
+        """
+        a, tau = np.broadcast_arrays(a, tau)
+        x = np.zeros(a.shape)
+        # Below the first tabulated value the strain grows linearly with the initial rate
+        small = tau < np.exp(self.log_tau[0])
+        x[small] = a[small]**self.gf*tau[small]
+        points = np.logical_not(small)
+        log_a = np.log(np.clip(a[points], self.a[0], self.a[-1]))
+        x[points] = np.exp(self._interpolator(np.stack([log_a, np.log(tau[points])], axis=-1)))
+        return x
+
+
+def check_friction_table(parameter_sets, cycles=(0, 1, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7), tolerance=1e-3):
+    """
+    Compares the strains of MaterialModel using the friction table with those integrated with tight tolerances for a
+    grid of static pressures p0, cyclic pressures pc and von Mises stresses q for each parameter set, raises an
+    AssertionError if they differ by more than the tolerance times the largest strain
+    :param parameter_sets:  list of material parameter sets, see MaterialModel
+    :return:                the largest difference relative to the largest strain
+    """
+    p0, pc, q = [values.ravel() for values in np.meshgrid([0., 2., 5., 10., 20., 40., 60.], [0., 30., 100., 200.],
+                                                          np.linspace(0., 600., 61))]
+    # Triaxial compression with the axial stress along z and the pressures and q as given
+    static_stresses = np.zeros((p0.shape[0], 6))
+    static_stresses[:, 0:3] = -p0[:, np.newaxis]
+    cyclic_stresses = np.zeros((p0.shape[0], 6))
+    cyclic_stresses[:, 0:3] = -pc[:, np.newaxis] + q[:, np.newaxis]/3*np.array([1., 1., -2.])
+    max_error = 0.
+    for parameters in parameter_sets:
+        table = get_friction_table(abs(parameters[0]))
+        strain = MaterialModel(parameters, friction_table=table).update_batch(cycles, cyclic_stresses,
+                                                                              static_stresses)
+        reference = MaterialModel(parameters, rtol=1e-10, atol=1e-13, method='Radau').update_batch(
+            cycles, cyclic_stresses, static_stresses)
+        error = np.max(abs(strain - reference))/max(np.max(abs(reference)), 1e-300)
+        if error > tolerance:
+            raise AssertionError("The friction table differs from the integrated strains by " + str(error) + " of the "
+                                 "largest strain for gf = " + str(table.gf))
+        max_error = max(max_error, error)
+    return max_error
+
+
+friction_tables = {}
+
+
+def get_friction_table(gf):
+    if gf not in friction_tables:
+        friction_tables[gf] = FrictionTable(gf)
+    return friction_tables[gf]
+
+
 class MaterialModel:
-    def __init__(self, material_parameters):
+    def __init__(self, material_parameters, rtol=1e-5, atol=1e-8, method='RK45', friction_table=None,
+                 response_surface=None):
         self.gf = abs(material_parameters[0])
         self.A = abs(material_parameters[1])
         self.A1 = abs(material_parameters[2])
@@ -28,76 +320,408 @@ class MaterialModel:
         self.b5 = abs(material_parameters[11])
         self.b6 = material_parameters[12]
 
+        self.rtol = rtol
+        self.atol = atol
+        self.method = method
+        if friction_table is not None and friction_table.gf != self.gf:
+            raise ValueError("The friction table is computed for gf = " + str(friction_table.gf) + " but the material "
+                             "has gf = " + str(self.gf))
+        self.friction_table = friction_table
+        if response_surface is not None and not np.array_equal(response_surface.parameters, material_parameters):
+            raise ValueError("The response surface is computed for another parameter set")
+        self.response_surface = response_surface
+
         self.frictional_strain = None
         self.compaction_strain = None
+        self.state = None
+        self.unique_states = None
+        self.quantization_error = None
+        self.strain_sensitivities = None
         self.parameters = material_parameters
 
-    def update(self, cycles, cyclic_stress, static_stress):
-        self.frictional_strain = np.zeros((cycles.shape[0], 6))
-        self.compaction_strain = np.zeros((cycles.shape[0], 6))
-        p0 = -invariant_1(static_stress)/3
-        pc = -invariant_1(cyclic_stress)/3
-        if p0 < 0:
-            p0 = 0
+    def update(self, cycles, cyclic_stress, static_stress, sensitivities=False):
+        strain = self.update_batch(cycles, np.asarray(cyclic_stress)[np.newaxis, :],
+                                   np.asarray(static_stress)[np.newaxis, :], sensitivities=sensitivities)
+        self.frictional_strain = self.frictional_strain[:, 0, :]
+        self.compaction_strain = self.compaction_strain[:, 0, :]
+        if sensitivities:
+            self.strain_sensitivities = self.strain_sensitivities[:, 0, :, :]
+        return strain[:, 0, :]
 
-        q = von_mises(cyclic_stress)
-        nij = 1.5*(cyclic_stress - invariant_1(cyclic_stress)/3*np.array([1, 1, 1, 0, 0, 0]))/q
+    def update_batch(self, cycles, cyclic_stresses, static_stresses, resolution=None, initial_state=None,
+                     sensitivities=False, effective_frictional_strain=None):
+        """
+        Evaluates the permanent strains for n stress states at once by integrating all points as one stacked system
+        :param cycles:              array with the cycle numbers where the strains are evaluated
+        :param cyclic_stresses:     n x 6 array with the cyclic stresses
+        :param static_stresses:     n x 6 array with the static stresses
+        :param resolution:          if given, the frictional strain is only integrated for the unique loads q/g after
+                                    rounding them to the resolution, see quantized_effective_frictional_strain
+        :param initial_state:       2 x n array with the effective frictional strain and the volumetric compaction
+                                    strain at cycles[0], typically the attribute state from a previous evaluation,
+                                    zero if not given
+        :param sensitivities:       if True, the forward sensitivity equations are integrated together with the
+                                    frictional strain and the derivatives of the strains with respect to the 13
+                                    material parameters are stored in strain_sensitivities as a
+                                    len(cycles) x n x 6 x 13 array. Only possible for a virgin material without
+                                    quantization and the tabulated solutions are not used
+        :param effective_frictional_strain: len(cycles) x n array with the effective frictional strain if it is
+                                            already evaluated, for instance by quantized_frictional_states for a larger
+                                            set of points, only the compaction strain is then integrated
+        :return:                    len(cycles) x n x 6 array with the permanent strains
+        """
+        cycles = np.asarray(cycles, dtype=float)
+        n = static_stresses.shape[0]
+        self.frictional_strain = np.zeros((cycles.shape[0], n, 6))
+        self.compaction_strain = np.zeros((cycles.shape[0], n, 6))
+        self.strain_sensitivities = np.zeros((cycles.shape[0], n, 6, 13)) if sensitivities else None
+        self.state = np.zeros((2, n))
+        instrumentation.count('material_model_points', n)
+        if n == 0:
+            return self.frictional_strain - self.compaction_strain
+        if sensitivities and (resolution is not None or initial_state is not None):
+            raise ValueError("Sensitivities can only be computed for a virgin material without quantization")
+        e0, ev0 = (None, 0.) if initial_state is None else initial_state
 
-        def dkd_dn(_, ep):
-            arg = 1. + self.A1*p0 + self.A2*p0**2
-            hf = self._hf(von_mises(ep))
+        p0, pc, q, nij = stress_invariants(cyclic_stresses, static_stresses)
+        dilatation = self.b1 - self.b5*p0 - self.b6*p0**2
+        direction = nij + dilatation*np.array([1, 1, 1, 0, 0, 0])[:, np.newaxis]
+
+        # The flow direction is constant and the frictional strain is ep = e/1.5*direction where e is the effective,
+        # von Mises, frictional strain as the von Mises norm of nij is 1.5 and the dilatation part is hydrostatic
+        if sensitivities:
+            e, de = self._frictional_sensitivities(cycles, p0, q)
+        elif effective_frictional_strain is not None:
+            e = np.asarray(effective_frictional_strain, dtype=float)
+        elif resolution is None:
+            e = self.effective_frictional_strain(cycles, p0, q, e0)
+        elif initial_state is None:
+            e = self.quantized_effective_frictional_strain(cycles, p0, q, resolution)
+        else:
+            raise ValueError("Quantization of the stress states is not possible when starting from an initial state")
+        e_f = e[:, :, np.newaxis]*direction.T/1.5
+        e_c = integrate_compaction(cycles, self.b4*p0 + pc, self.b2, self.b3, self.nb, ev0)
+        self.state[0, :] = e[-1, :]
+        self.state[1, :] = e_c[-1, :]
+        norm = np.linalg.norm(e_f, axis=2)
+        if sensitivities:
+            self.strain_sensitivities[:, :, :, :] = self._strain_sensitivities(cycles, p0, pc, e, de, e_f, norm,
+                                                                               e_c, direction)
+        e_f[norm > 1., :] /= norm[norm > 1., np.newaxis]
+        e_c[abs(e_c) > 1] /= abs(e_c[abs(e_c) > 1])
+        self.frictional_strain[:, :, :] = e_f
+        self.compaction_strain[:, :, 0:3] = e_c[:, :, np.newaxis]/3
 
-            if arg < 1e-6:
-                arg = 1e-6
-            g = np.sqrt(arg)
-            f = (q/g - hf)
-            if f < 0.:
-                f = 0.
+        return self.frictional_strain - self.compaction_strain
 
-            ep_eff_dn = self.A*f**self.gf
+    def update_spectrum(self, cycles, cyclic_stresses, static_stresses, shares, initial_state=None):
+        """
+        Evaluates the permanent strains for n points subjected to a mixed traffic of k loads, interleaved on a scale
+        much finer than the cycle ranges of interest, by integrating the rate averaged over the loads with the shares
+        as weights. The flow directions differ between the loads and the frictional strain tensor is integrated
+        together with the compaction strain as one stacked system for all points
+        :param cycles:              array with the total number of cycles where the strains are evaluated
+        :param cyclic_stresses:     k x n x 6 array with the cyclic stresses of each load
+        :param static_stresses:     n x 6 array with the static stresses
+        :param shares:              array with the share of the cycles of each load, normalized to sum to one
+        :param initial_state:       7 x n array with the frictional strain tensor and the volumetric compaction strain
+                                    at cycles[0], typically the attribute state from a previous evaluation, zero if
+                                    not given
+        :return:                    len(cycles) x n x 6 array with the permanent strains
+        """
+        cycles = np.asarray(cycles, dtype=float)
+        cyclic_stresses = np.asarray(cyclic_stresses, dtype=float)
+        shares = np.asarray(shares, dtype=float)
+        if shares.shape[0] != cyclic_stresses.shape[0]:
+            raise ValueError("One share is needed for each cyclic stress field")
+        shares = shares/np.sum(shares)
+        n = static_stresses.shape[0]
+        self.frictional_strain = np.zeros((cycles.shape[0], n, 6))
+        self.compaction_strain = np.zeros((cycles.shape[0], n, 6))
+        self.state = np.zeros((7, n))
+        instrumentation.count('material_model_points', n)
+        if n == 0:
+            return self.frictional_strain - self.compaction_strain
+
+        loads = []
+        directions = []
+        driving_terms = []
+        for cyclic_stress in cyclic_stresses:
+            p0, pc, q, nij = stress_invariants(cyclic_stress, static_stresses)
             dilatation = self.b1 - self.b5*p0 - self.b6*p0**2
-            deij_dn = ep_eff_dn*(nij + dilatation*np.array([1, 1, 1, 0, 0, 0]))
-            return deij_dn
-
-        def dkv_dn(_, ev):
-
-            f = (self.b4*p0 + pc - self.b3*ev)
-            if f < 0:
-                f = 0
-            return self.b2*f**self.nb
-
-        for i in range(1, cycles.shape[0]):
-            e_fric = self.frictional_strain[i - 1, :]
-            e_comp = self.compaction_strain[i - 1, :]
-            n0 = cycles[i - 1]
-            solution_fric = solve_ivp(dkd_dn, [n0, cycles[i]], e_fric)
-            solution_comp = solve_ivp(dkv_dn, [n0, cycles[i]], [e_comp[0] + e_comp[1] + e_comp[2]])
-
-            e_f = solution_fric.y[:, -1]
-            e_c = solution_comp.y[:, -1]
-            if np.linalg.norm(e_f) > 1.:
-                e_f /= np.linalg.norm(e_f)
-            self.frictional_strain[i, :] = e_f
-            for j in range(3):
-                if abs(e_c) > 1:
-                    e_c /= abs(e_c)
-                self.compaction_strain[i, j] = e_c/3
+            loads.append(self.frictional_load(p0, q))
+            directions.append(nij + dilatation*np.array([1, 1, 1, 0, 0, 0])[:, np.newaxis])
+            driving_terms.append(self.b4*p0 + pc)
+
+        def rate(y):
+            ep = y[:6*n].reshape(6, n)
+            ev = y[6*n:]
+            # The hardening is governed by the von Mises norm of the accumulated frictional strain which is shared
+            # between the loads
+            hf = self._hf(von_mises(ep))
+            d_ep = np.zeros((6, n))
+            d_ev = np.zeros(n)
+            for share, load, direction, c in zip(shares, loads, directions, driving_terms):
+                d_ep += share*self.A*np.maximum(load - hf, 0.)**self.gf*direction
+                d_ev += share*self.b2*np.maximum(c - self.b3*ev, 0.)**self.nb
+            return np.concatenate([d_ep.ravel(), d_ev])
+
+        y0 = np.zeros(7*n) if initial_state is None else np.asarray(initial_state, dtype=float).ravel()
+        y = integrate_log_cycles(rate, cycles, y0, rtol=self.rtol, atol=self.atol, method=self.method)
+        e_f = np.transpose(y[:, :6*n].reshape(-1, 6, n), (0, 2, 1))
+        e_c = y[:, 6*n:]
+        self.state[:, :] = y[-1, :].reshape(7, n)
+        norm = np.linalg.norm(e_f, axis=2)
+        e_f[norm > 1., :] /= norm[norm > 1., np.newaxis]
+        e_c[abs(e_c) > 1] /= abs(e_c[abs(e_c) > 1])
+        self.frictional_strain[:, :, :] = e_f
+        self.compaction_strain[:, :, 0:3] = e_c[:, :, np.newaxis]/3
 
         return self.frictional_strain - self.compaction_strain
 
+    def _strain_sensitivities(self, cycles, p0, pc, e, de, e_f, norm, e_c, direction):
+        # Derivatives of the unlimited frictional strain ep = e/1.5*direction where only the dilatation part of the
+        # direction depends on the parameters b1, b5 and b6
+        d_dilatation = np.zeros((p0.shape[0], 13))
+        d_dilatation[:, 6] = 1.
+        d_dilatation[:, 11] = -p0
+        d_dilatation[:, 12] = -p0**2
+        d_dilatation *= self._parameter_chain_factors()
+        d_f = de[:, :, np.newaxis, :]*direction.T[np.newaxis, :, :, np.newaxis]/1.5
+        d_f[:, :, 0:3, :] += (e[:, :, np.newaxis]*d_dilatation[np.newaxis, :, :]/1.5)[:, :, np.newaxis, :]
+
+        # The limitation to unit norm is a projection, ep/|ep|, with the derivative (dep - ep*(ep.dep)/|ep|**2)/|ep|
+        limited = norm > 1.
+        e_l = e_f[limited]
+        d_l = d_f[limited]
+        d_f[limited] = (d_l - e_l[:, :, np.newaxis]*np.einsum('ij,ijk->ik', e_l, d_l)[:, np.newaxis, :]
+                        / norm[limited, np.newaxis, np.newaxis]**2)/norm[limited, np.newaxis, np.newaxis]
+
+        # The limited compaction strain is constant
+        d_c = self._compaction_sensitivities(cycles, p0, pc)
+        d_c[abs(e_c) > 1] = 0
+        d_f[:, :, 0:3, :] -= d_c[:, :, np.newaxis, :]/3
+        return d_f
+
+    def _frictional_sensitivities(self, cycles, p0, q):
+        """
+        Integrates the effective frictional strain e together with the forward sensitivities S = de/dtheta for the
+        parameters gf, A, A1, A2, nf and H1, governed by dS/dN = d(rate)/de*S + d(rate)/dtheta
+        :return:    len(cycles) x n array with e and len(cycles) x n x 13 array with the derivatives of e with
+                    respect to the material parameters
+        """
+        n = q.shape[0]
+        g2 = 1. + self.A1*p0 + self.A2*p0**2
+        load = self.frictional_load(p0, q)
+        # The derivatives of the load q/g with respect to A1 and A2 vanish where g is limited
+        d_load = np.zeros((2, n))
+        unlimited = g2 > 1e-6
+        d_load[0, unlimited] = -load[unlimited]/(2*g2[unlimited])*p0[unlimited]
+        d_load[1, unlimited] = -load[unlimited]/(2*g2[unlimited])*p0[unlimited]**2
+
+        def rate(y):
+            e_ = y[:n]
+            s = y[n:].reshape(6, n)
+            f = np.maximum(load - self._hf(e_), 0.)
+            active = f > 0
+            d_rate = np.zeros(n)
+            d_rate[active] = 1.5*self.A*self.gf*f[active]**(self.gf - 1)
+            log_f = np.zeros(n)
+            log_f[active] = np.log(f[active])
+            rate_e = 1.5*self.A*f**self.gf
+            d_theta = np.array([rate_e*log_f, 1.5*f**self.gf, d_rate*d_load[0], d_rate*d_load[1],
+                                -d_rate*self.H1*e_*np.exp(-self.nf*e_), -d_rate*(1 - np.exp(-self.nf*e_))])
+            return np.concatenate([rate_e, (-d_rate*self._dhf(e_)*s + d_theta).ravel()])
+
+        y = integrate_log_cycles(rate, cycles, np.zeros(7*n), rtol=self.rtol, atol=self.atol, method=self.method)
+        de = np.zeros((cycles.shape[0], n, 13))
+        de[:, :, 0:6] = np.transpose(y[:, n:].reshape(-1, 6, n), (0, 2, 1))
+        return y[:, :n], de*self._parameter_chain_factors()
+
+    def _compaction_sensitivities(self, cycles, p0, pc):
+        """
+        Derivatives of the closed form compaction strain for a virgin material, see integrate_compaction, with
+        respect to the parameters b2, b3, nb and b4
+        :return:    len(cycles) x n x 13 array with the derivatives of the volumetric compaction strain
+        """
+        c = self.b4*p0 + pc
+        dn = (cycles - cycles[0])[:, np.newaxis]
+        u0 = np.maximum(c, 0.)
+        active = u0 > 0
+        u0 = u0[active]
+        b2, b3, nb = self.b2, self.b3, self.nb
+        d_ev = np.zeros((cycles.shape[0], c.shape[0], 13))
+        if b3 == 0:
+            d_ev[:, active, 7] = u0**nb*dn
+            d_ev[:, active, 9] = b2*u0**nb*np.log(u0)*dn
+            d_ev[:, active, 10] = b2*nb*u0**(nb - 1)*p0[active]*dn
+            return d_ev*self._parameter_chain_factors()
+
+        if nb == 1:
+            k = b2*b3*dn
+            u = u0*np.exp(-k)
+            du_db2 = -b3*dn*u
+            du_db3 = -b2*dn*u
+            du_du0 = np.exp(-k)*np.ones(u.shape)
+            du_dnb = u*k*(k/2 - np.log(u0))
+        else:
+            w = u0**(1 - nb) + (nb - 1)*b2*b3*dn
+            saturated = w <= 0
+            w[saturated] = 1.
+            u = np.where(saturated, 0., w**(1/(1 - nb)))
+            # u = w**(1/(1 - nb)) and the derivatives follow from du = u/((1 - nb)*w)*dw
+            ratio = u/w
+            du_db2 = -ratio*b3*dn
+            du_db3 = -ratio*b2*dn
+            du_du0 = ratio*u0**(-nb)
+            du_dnb = u*(np.log(w)/(1 - nb)**2 + (-np.log(u0)*u0**(1 - nb) + b2*b3*dn)/((1 - nb)*w))
+        # ev = (u0 - u)/b3
+        d_ev[:, active, 7] = -du_db2/b3
+        d_ev[:, active, 8] = -(u0 - u)/b3**2 - du_db3/b3
+        d_ev[:, active, 9] = -du_dnb/b3
+        d_ev[:, active, 10] = (1 - du_du0)*p0[active]/b3
+        return d_ev*self._parameter_chain_factors()
+
+    def _parameter_chain_factors(self):
+        # Derivatives of the material parameters with respect to the raw parameters, all parameters except A2 and b6
+        # are absolute values and b2 = exp(-|theta_7|)
+        theta = np.asarray(self.parameters, dtype=float)
+        factors = np.sign(theta)
+        factors[3] = 1.
+        factors[12] = 1.
+        factors[7] = -self.b2*np.sign(theta[7])
+        return factors
+
+    def effective_frictional_strain(self, cycles, p0, q, e0=None):
+        """
+        Evaluates the effective frictional strain e, governed by de/dN = 1.5*A*max(q/g - hf(e), 0)**gf
+        :param cycles:  array with the cycle numbers where the strain is evaluated
+        :param p0:      array with the static pressure for each point
+        :param q:       array with the von Mises stress of the cyclic stress for each point
+        :param e0:      array with the effective frictional strain at cycles[0], zero if not given
+        :return:        len(cycles) x len(q) array with the effective frictional strain
+        """
+        return self._effective_frictional_strain(np.asarray(cycles, dtype=float), self.frictional_load(p0, q), e0)
+
+    def quantized_effective_frictional_strain(self, cycles, p0, q, resolution):
+        """
+        Evaluates the effective frictional strain for the representative loads q/g obtained by rounding the loads to
+        the resolution and assigns the result to all points sharing a representative, see quantized_frictional_states
+        :param cycles:      array with the cycle numbers where the strain is evaluated
+        :param p0:          array with the static pressure for each point
+        :param q:           array with the von Mises stress of the cyclic stress for each point
+        :param resolution:  the resolution of the load q/g
+        :return:            len(cycles) x len(q) array with the effective frictional strain
+        """
+        e, inverse = self.quantized_frictional_states(cycles, self.frictional_load(p0, q), resolution)
+        return e[:, inverse]
+
+    def quantized_frictional_states(self, cycles, load, resolution):
+        """
+        Evaluates the effective frictional strain for the representative loads obtained by rounding the loads q/g to
+        the resolution. The number of representatives is stored in unique_states. As the strain increases
+        monotonically with the load, the largest error for a representative is found at its smallest or largest load
+        and the maximum error of the effective frictional strain, found by evaluating these loads, is stored in
+        quantization_error. The error is relative for strains larger than one.
+        :param cycles:      array with the cycle numbers where the strain is evaluated
+        :param load:        array with the load q/g for each point, see frictional_load
+        :param resolution:  the resolution of the load q/g
+        :return:            len(cycles) x m array with the effective frictional strain of the m representatives and
+                            an array with the index of the representative of each point
+        """
+        bins, inverse = np.unique(np.round(load/resolution), return_inverse=True)
+        n = bins.shape[0]
+        lower = np.full(n, np.inf)
+        upper = np.full(n, -np.inf)
+        np.minimum.at(lower, inverse, load)
+        np.maximum.at(upper, inverse, load)
+        e = self._effective_frictional_strain(np.asarray(cycles, dtype=float),
+                                              np.concatenate([bins*resolution, lower, upper]))
+        self.unique_states = n
+        scale = np.maximum(abs(e[:, :n]), 1.)
+        self.quantization_error = max(np.max(abs(e[:, n:2*n] - e[:, :n])/scale),
+                                      np.max(abs(e[:, 2*n:] - e[:, :n])/scale))
+        return e[:, :n], inverse
+
+    def _effective_frictional_strain(self, cycles, load, e0=None):
+        e = np.zeros((cycles.shape[0], load.shape[0]))
+        integrate = np.ones(load.shape[0], dtype=bool)
+        # The tabulated solutions all start from a virgin state
+        if e0 is not None:
+            e0 = np.asarray(e0, dtype=float)
+        elif self.response_surface is not None and self.response_surface.applies(cycles):
+            surface = self.response_surface.covers(load)
+            e[:, surface] = self.response_surface(load[surface])
+            integrate = np.logical_not(surface)
+        if e0 is None and self.friction_table is not None:
+            a = load/self.H1
+            tau = self.nf*1.5*self.A*self.H1**self.gf*(cycles - cycles[0])
+            table = np.logical_and(integrate, self.friction_table.covers(a, tau[-1]))
+            e[:, table] = self.friction_table(a[table], tau[:, np.newaxis])/self.nf
+            integrate = np.logical_and(integrate, np.logical_not(table))
+
+        load = load[integrate]
+        e0 = np.zeros(load.shape[0]) if e0 is None else e0[integrate]
+
+        def rate(e_):
+            return 1.5*self.A*np.maximum(load - self._hf(e_), 0.)**self.gf
+
+        def jacobian(e_):
+            f = np.maximum(load - self._hf(e_), 0.)
+            d_rate = np.zeros(f.shape[0])
+            d_rate[f > 0] = -1.5*self.A*self.gf*f[f > 0]**(self.gf - 1)*self._dhf(e_[f > 0])
+            return diags(d_rate, format='csc')
+
+        if load.shape[0]:
+            e[:, integrate] = integrate_log_cycles(rate, cycles, e0, rtol=self.rtol, atol=self.atol, method=self.method,
+                                                   jacobian=jacobian)
+        return e
+
+    def frictional_load(self, p0, q):
+        # The frictional law only depends on the stress state through q/g
+        return q/np.sqrt(np.maximum(1. + self.A1*p0 + self.A2*p0**2, 1e-6))
+
     def _hf(self, ep):
         return self.H1*(1 - np.exp(-self.nf*ep))
 
+    def _dhf(self, ep):
+        return self.H1*self.nf*np.exp(-self.nf*ep)
+
     def strain(self):
         return self.frictional_strain - self.compaction_strain
 
     def volumetric_strain(self):
         e = self.strain()
-        return e[:, 0] + e[:, 1] + e[:, 2]
+        return e[..., 0] + e[..., 1] + e[..., 2]
 
     def deviatoric_strain(self):
         e_dev = np.array(self.strain())
         e_vol = self.volumetric_strain()
         for i in range(3):
-            e_dev[:, i] -= e_vol/3
+            e_dev[..., i] -= e_vol/3
         return e_dev
+
+    def volumetric_strain_sensitivities(self):
+        d_e = self.strain_sensitivities
+        return d_e[..., 0, :] + d_e[..., 1, :] + d_e[..., 2, :]
+
+    def deviatoric_strain_sensitivities(self):
+        d_dev = np.array(self.strain_sensitivities)
+        d_vol = self.volumetric_strain_sensitivities()
+        for i in range(3):
+            d_dev[..., i, :] -= d_vol/3
+        return d_dev
+
+
+def main():
+    from model_parameters import frequency_levels, get_parameters
+    parameter_sets = [get_parameters(frequency) for frequency in frequency_levels]
+    print("integrate_compaction agrees with solve_ivp to", check_integrate_compaction(parameter_sets),
+          "of the largest strain")
+    print("The friction table agrees with the integrated strains to", check_friction_table(parameter_sets),
+          "of the largest strain")
+    print("update_batch agrees with update to", check_update_batch(parameter_sets), "of the largest strain of a point")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+from __future__ import print_function, division
+
+import hashlib
+import os
+
+import numpy as np
+
+from material_model.material_model import MaterialModel
+
+
+def parameter_hash(material_parameters, cycles):
+    key = np.asarray(material_parameters, dtype=float).tobytes() + np.asarray(cycles, dtype=float).tobytes()
+    return hashlib.sha1(key).hexdigest()
+
+
+class ResponseSurface:
+    """
+    Tabulated effective frictional strain for a parameter set and a list of cycle numbers. The frictional strain only
+    depends on the stress state through the load q/g, see MaterialModel.frictional_load, as the compaction strain is
+    evaluated in closed form and the direction of the frictional strain is given by the cyclic stress. The table is
+    therefore one-dimensional in the load and refined until linear interpolation between the sampled loads is within
+    the tolerance, absolute for strains below one and relative above.
+    """
+    def __init__(self, material_parameters, cycles, loads, strains, tolerance, error):
+        self.parameters = np.asarray(material_parameters, dtype=float)
+        self.cycles = np.asarray(cycles, dtype=float)
+        self.loads = loads
+        self.strains = strains
+        self.tolerance = tolerance
+        self.error = error
+
+    @classmethod
+    def build(cls, material_parameters, cycles, max_load, tolerance=1e-5, initial_points=33, max_points=100000):
+        # The table is computed with tight integration tolerances to not be limited by the integration error
+        model = MaterialModel(material_parameters, rtol=1e-10, atol=1e-12)
+        cycles = np.asarray(cycles, dtype=float)
+
+        def evaluate(loads):
+            return model.effective_frictional_strain(cycles, np.zeros(loads.shape[0]), loads)
+
+        loads = np.linspace(0, max_load, initial_points)
+        strains = evaluate(loads)
+        error = np.inf
+        while loads.shape[0] < max_points:
+            # Comparing the interpolated and computed strains at the midpoints and splitting the intervals where the
+            # interpolation error is too large
+            midpoints = 0.5*(loads[1:] + loads[:-1])
+            midpoint_strains = evaluate(midpoints)
+            # The error is relative for strains larger than one
+            interval_error = np.max(abs(midpoint_strains - 0.5*(strains[:, 1:] + strains[:, :-1]))
+                                    / np.maximum(abs(midpoint_strains), 1.), axis=0)
+            error = np.max(interval_error)
+            refine = interval_error > tolerance
+            if not np.any(refine):
+                break
+            loads = np.concatenate([loads, midpoints[refine]])
+            strains = np.concatenate([strains, midpoint_strains[:, refine]], axis=1)
+            order = np.argsort(loads)
+            loads = loads[order]
+            strains = strains[:, order]
+        return cls(material_parameters, cycles, loads, strains, tolerance, error)
+
+    @classmethod
+    def load(cls, file_name):
+        data = np.load(file_name)
+        return cls(data['parameters'], data['cycles'], data['loads'], data['strains'], float(data['tolerance']),
+                   float(data['error']))
+
+    def save(self, file_name):
+        # Writing to a temporary file first so that an interrupted write never leaves a corrupt table behind
+        temp_file_name = file_name + '.tmp.npz'
+        np.savez(temp_file_name, parameters=self.parameters, cycles=self.cycles, loads=self.loads,
+                 strains=self.strains, tolerance=self.tolerance, error=self.error)
+        os.rename(temp_file_name, file_name)
+
+    def applies(self, cycles):
+        return np.array_equal(np.asarray(cycles, dtype=float), self.cycles)
+
+    def covers(self, loads):
+        return loads <= self.loads[-1]
+
+    def __call__(self, loads):
+        """
+        Interpolates the effective frictional strain
+        :param loads:   array with the loads q/g
+        :return:        len(cycles) x len(loads) array with the effective frictional strain
+        """
+        return np.array([np.interp(loads, self.loads, strain) for strain in self.strains])
+
+
+def get_response_surface(material_parameters, cycles, max_load, tolerance, directory):
+    """
+    Returns the response surface for the parameter set and cycle numbers, reading it from directory if a table
+    covering max_load within the tolerance has been computed before, otherwise the table is computed and stored.
+    None is returned if the table cannot be refined to the tolerance.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    file_name = os.path.join(directory, 'response_surface_' + parameter_hash(material_parameters, cycles) + '.npz')
+    if os.path.isfile(file_name):
+        surface = ResponseSurface.load(file_name)
+        if surface.covers(max_load) and surface.error <= tolerance:
+            print("Using the response surface", file_name)
+            return surface
+        max_load = max(max_load, surface.loads[-1])
+    print("Computing the response surface", file_name)
+    surface = ResponseSurface.build(material_parameters, cycles, max_load, tolerance)
+    print("Response surface with {n} points and a maximum interpolation error of {e}".format(
+        n=surface.loads.shape[0], e=surface.error))
+    surface.save(file_name)
+    if surface.error > tolerance:
+        print("The response surface does not reach the tolerance", tolerance)
+        return None
+    return surface
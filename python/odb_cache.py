@@ -0,0 +1,111 @@
+from __future__ import print_function, division
+
+import hashlib
+import os
+
+import numpy as np
+
+default_cache_directory = os.path.expanduser('~/railway_ballast/odb_cache')
+
+
+class OdbFieldCache:
+    """
+    Persistent cache of field arrays read from odbs, stored as .npy files that are returned memory mapped. An entry is
+    identified by the path, size and modification time of the odb together with the field, step, frame, set and
+    position of the read, so a modified odb never returns stale data. The least recently used entries are removed
+    when the total size of the cache exceeds max_size bytes.
+    """
+    def __init__(self, directory=default_cache_directory, max_size=10*1024**3):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(odb_file_name, **identifiers):
+        odb_file_name = os.path.abspath(odb_file_name)
+        stat = os.stat(odb_file_name)
+        key = repr((odb_file_name, stat.st_size, stat.st_mtime, sorted(identifiers.items())))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        file_name = self._file_name(key)
+        if not os.path.isfile(file_name):
+            return None
+        # The modification time of the file is used as the time of the last use
+        os.utime(file_name, None)
+        return np.load(file_name, mmap_mode='r')
+
+    def put(self, key, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        file_name = self._file_name(key)
+        # Writing to a temporary file first so that an interrupted write never leaves a corrupt entry behind
+        temp_file_name = file_name + '.tmp.npy'
+        np.save(temp_file_name, data)
+        os.rename(temp_file_name, file_name)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry_name in os.listdir(self.directory):
+            if entry_name.endswith('.npy') and not entry_name.endswith('.tmp.npy'):
+                stat = os.stat(os.path.join(self.directory, entry_name))
+                entries.append((stat.st_mtime, stat.st_size, entry_name))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_name in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, entry_name))
+            size -= entry_size
+
+
+class CachedABQInterface:
+    """
+    Wrapper around an ABQInterface serving read_data_from_odb from an OdbFieldCache, all other attributes are taken
+    from the wrapped interface
+    """
+    def __init__(self, abq, cache=None):
+        self.abq_interface = abq
+        self.cache = OdbFieldCache() if cache is None else cache
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper
+        if name == 'abq_interface':
+            raise AttributeError(name)
+        return getattr(self.abq_interface, name)
+
+    def read_data_from_odb(self, field_id, odb_file_name, **kwargs):
+        key = self.cache.key(odb_file_name, field_id=field_id, **kwargs)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.abq_interface.read_data_from_odb(field_id, odb_file_name, **kwargs)
+            self.cache.put(key, data)
+        return data
+
+
+class CachedOdbBackend:
+    """
+    Wrapper around a backend for odb_transaction.OdbTransaction serving the reads of read-only transactions from an
+    OdbFieldCache, only the reads missing in the cache are executed by the wrapped backend. Transactions with writes
+    are passed on unchanged as the writes modify the odb.
+    """
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = OdbFieldCache() if cache is None else cache
+
+    def execute(self, odb_file_name, operations):
+        if any(operation['type'] == 'write' for operation in operations):
+            return self.backend.execute(odb_file_name, operations)
+        keys = [self.cache.key(odb_file_name, **{name: value for name, value in operation.items() if name != 'type'})
+                for operation in operations]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, data in enumerate(results) if data is None]
+        if missing:
+            for i, data in zip(missing, self.backend.execute(odb_file_name, [operations[i] for i in missing])):
+                self.cache.put(keys[i], data)
+                # Returning the cached copy, memory mapped, so that large fields need not stay in memory
+                cached_data = self.cache.get(keys[i])
+                results[i] = data if cached_data is None else cached_data
+        return results
@@ -0,0 +1,282 @@
+from __future__ import print_function, division
+
+import mmap
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+from common import create_temp_dir_name
+
+abaqus_functions_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'abaqus_functions')
+
+
+def file_region(array):
+    """
+    Returns the file name and the offset of the data of a memory mapped array if the data is one contiguous region of
+    the file, for instance a slice along the first axis of a C-ordered .npy file opened with mmap_mode, and None
+    otherwise
+    """
+    if not isinstance(array, np.memmap) or not array.flags.c_contiguous or not array.filename:
+        return None
+    # The memory map created for the file holds the data from its offset on, and views of it refer to it as their base
+    root = array
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    if not isinstance(root.base, mmap.mmap):
+        return None
+    return array.filename, root.offset + array.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+
+
+class FieldRead:
+    """
+    Handle for a queued field read, the data is available after the transaction is committed
+    """
+    def __init__(self):
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            raise ValueError("The transaction holding the read is not committed")
+        return self._data
+
+
+class OdbTransaction:
+    """
+    Queues any number of field reads and writes for one odb and executes them in a single session, one Abaqus Python
+    process opening and saving the odb once, instead of one process per field as ABQInterface.read_data_from_odb and
+    ABQInterface.write_data_to_odb. The operations are executed in the order they are queued. Used as a context manager
+    the transaction is committed when the block exits without an exception
+
+        with OdbTransaction(odb_file_name, AbaqusOdbBackend(abq)) as transaction:
+            static_stresses = transaction.read('S', 'gravity', set_name=set_name)
+        print(static_stresses.data)
+    """
+    def __init__(self, odb_file_name, backend):
+        self.odb_file_name = odb_file_name
+        self.backend = backend
+        self.operations = []
+        self._reads = []
+
+    def read(self, field_id, step_name, frame_number=-1, set_name='', instance_name='', position='INTEGRATION_POINT'):
+        self.operations.append({'type': 'read', 'field_id': field_id, 'step_name': step_name,
+                                'frame_number': frame_number, 'set_name': set_name, 'instance_name': instance_name,
+                                'position': position})
+        field_read = FieldRead()
+        self._reads.append(field_read)
+        return field_read
+
+    def write(self, field_data, field_id, step_name, frame_number=0, set_name='', instance_name='',
+              position='INTEGRATION_POINT'):
+        # The data is copied as the caller may reuse the array before the transaction is committed. Memory mapped
+        # arrays, typically the steps of an on-disk store, are queued by reference so that queueing many large fields
+        # does not bring them into memory, and they must not be modified before the transaction is committed
+        if not isinstance(field_data, np.memmap) or field_data.dtype != np.float64:
+            field_data = np.array(field_data, dtype=float)
+        self.operations.append({'type': 'write', 'field_id': field_id, 'step_name': step_name,
+                                'frame_number': frame_number, 'set_name': set_name, 'instance_name': instance_name,
+                                'position': position, 'data': field_data})
+
+    def commit(self):
+        if self.operations:
+            results = self.backend.execute(self.odb_file_name, self.operations)
+            for field_read, data in zip(self._reads, results):
+                field_read._data = data
+        self.operations = []
+        self._reads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+
+class AbaqusOdbBackend:
+    """
+    Executes the operations of a transaction in one Abaqus Python process, see
+    abaqus_functions/execute_odb_transaction.py. The field data is passed as .npy files to be independent of the numpy
+    versions on the two sides. Data memory mapped from a file is read by Abaqus directly from that file, see
+    file_region, instead of being copied
+    """
+    def __init__(self, abq):
+        self.abq = abq
+
+    def execute(self, odb_file_name, operations):
+        print("Executing", len(operations), "odb operations on", odb_file_name)
+        work_directory = os.path.abspath(create_temp_dir_name(odb_file_name))
+        os.makedirs(work_directory)
+        try:
+            abaqus_operations = []
+            for i, operation in enumerate(operations):
+                abaqus_operation = {key: value for key, value in operation.items() if key != 'data'}
+                region = file_region(operation['data']) if operation['type'] == 'write' else None
+                if region is not None:
+                    operation['data'].flush()
+                    abaqus_operation['data_file'], abaqus_operation['offset'] = region
+                    abaqus_operation['shape'] = operation['data'].shape
+                    abaqus_operation['dtype'] = operation['data'].dtype.str
+                elif operation['type'] == 'write':
+                    abaqus_operation['data_file'] = os.path.join(work_directory, 'write_' + str(i) + '.npy')
+                    np.save(abaqus_operation['data_file'], operation['data'])
+                else:
+                    abaqus_operation['data_file'] = os.path.join(work_directory, 'read_' + str(i) + '.npy')
+                abaqus_operations.append(abaqus_operation)
+            operation_pickle_file = os.path.join(work_directory, 'operations.pkl')
+            with open(operation_pickle_file, 'wb') as pickle_file:
+                pickle.dump({'odb_file_name': os.path.abspath(odb_file_name), 'operations': abaqus_operations},
+                            pickle_file, protocol=2)
+            job = subprocess.Popen(self.abq.abq + ' python execute_odb_transaction.py ' + operation_pickle_file,
+                                   shell=True, cwd=abaqus_functions_directory)
+            if job.wait() != 0:
+                raise RuntimeError("The odb transaction on " + odb_file_name + " failed")
+            return [np.load(operation['data_file']) for operation in abaqus_operations if operation['type'] == 'read']
+        finally:
+            shutil.rmtree(work_directory)
+
+
+class LocalOdbBackend:
+    """
+    Stand-in for Abaqus emulating an odb as an npz archive with one array per field output, for testing the
+    transaction logic without an Abaqus installation. Each field is identified by the step, frame, instance, set and
+    position it is written to, and frame -1 refers to the last frame of a step. The number of sessions, each loading
+    and saving the archive once, is counted in sessions.
+    """
+    def __init__(self):
+        self.sessions = 0
+
+    @staticmethod
+    def _key(operation, frame_number):
+        return '/'.join([operation['step_name'], str(frame_number), operation['instance_name'], operation['set_name'],
+                         operation['position'], operation['field_id']])
+
+    @staticmethod
+    def _frames(fields, step_name):
+        return sorted(set(int(key.split('/')[1]) for key in fields if key.split('/')[0] == step_name))
+
+    def execute(self, odb_file_name, operations):
+        print("Executing", len(operations), "odb operations on", odb_file_name)
+        self.sessions += 1
+        fields = {}
+        if os.path.isfile(odb_file_name):
+            with np.load(odb_file_name) as odb:
+                fields = {key: odb[key] for key in odb.files}
+        results = []
+        modified = False
+        for operation in operations:
+            frames = self._frames(fields, operation['step_name'])
+            frame_number = operation['frame_number']
+            if frame_number < 0:
+                if operation['type'] == 'read' and not frames:
+                    raise KeyError("The step " + operation['step_name'] + " does not exist in " + odb_file_name)
+                frame_number = frames[frame_number] if len(frames) >= -frame_number else 0
+            key = self._key(operation, frame_number)
+            if operation['type'] == 'read':
+                if key not in fields:
+                    raise KeyError("The field " + key + " does not exist in " + odb_file_name)
+                results.append(np.array(fields[key]))
+            else:
+                fields[key] = operation['data']
+                modified = True
+        if modified:
+            with open(odb_file_name, 'wb') as odb:
+                np.savez(odb, **fields)
+        return results
+
+
+def main():
+    # Checks the transaction logic with LocalOdbBackend: one session for each transaction, the operations executed in
+    # the order they are queued, the data round tripped, memory mapped data written by reference and the reads of
+    # read-only transactions served by the odb cache without a session
+    from odb_cache import CachedOdbBackend, OdbFieldCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        odb_file_name = os.path.join(directory, 'check.odb')
+        backend = LocalOdbBackend()
+        random = np.random.RandomState(0)
+        stresses = [random.uniform(-1., 1., (20, 6)) for _ in range(3)]
+        displacements = random.uniform(-1., 1., (8, 3))
+        with OdbTransaction(odb_file_name, backend) as transaction:
+            for frame_number, frame_stresses in enumerate(stresses):
+                transaction.write(frame_stresses, 'S', 'loading', frame_number=frame_number, set_name='BALLAST')
+            transaction.write(displacements, 'U', 'loading', frame_number=2, position='NODAL')
+            # The data is copied when queued and modifying the array afterwards does not change the written field
+            expected_displacements = displacements.copy()
+            displacements[:] = 0.
+            written_displacements = random.uniform(-1., 1., (8, 3))
+            transaction.write(written_displacements, 'U', 'gravity', position='NODAL')
+        assert backend.sessions == 1
+
+        with OdbTransaction(odb_file_name, backend) as transaction:
+            reads = [transaction.read('S', 'loading', frame_number=frame_number, set_name='BALLAST')
+                     for frame_number in range(3)]
+            last_frame = transaction.read('S', 'loading', set_name='BALLAST')
+            nodal_displacements = transaction.read('U', 'loading', frame_number=2, position='NODAL')
+            try:
+                reads[0].data
+                raise AssertionError("The data of a read should not be available before the commit")
+            except ValueError:
+                pass
+        assert backend.sessions == 2
+        for field_read, frame_stresses in zip(reads, stresses):
+            assert np.array_equal(field_read.data, frame_stresses)
+        assert np.array_equal(last_frame.data, stresses[-1])
+        assert np.array_equal(nodal_displacements.data, expected_displacements)
+
+        # A read queued before a write of the same field returns the old data and a read queued after it the new data
+        with OdbTransaction(odb_file_name, backend) as transaction:
+            old_displacements = transaction.read('U', 'gravity', position='NODAL')
+            transaction.write(2*written_displacements, 'U', 'gravity', position='NODAL')
+            new_displacements = transaction.read('U', 'gravity', position='NODAL')
+        assert backend.sessions == 3
+        assert np.array_equal(old_displacements.data, written_displacements)
+        assert np.array_equal(new_displacements.data, 2*written_displacements)
+
+        # A block exiting with an exception does not commit the transaction
+        try:
+            with OdbTransaction(odb_file_name, backend) as transaction:
+                transaction.write(written_displacements, 'U', 'gravity', position='NODAL')
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        assert backend.sessions == 3
+
+        # Memory mapped data is queued by reference and the file region holds the written step
+        store = np.lib.format.open_memmap(os.path.join(directory, 'store.npy'), mode='w+', dtype=float,
+                                          shape=(3, 20, 6))
+        store[:] = np.array(stresses)
+        store.flush()
+        store = np.load(os.path.join(directory, 'store.npy'), mmap_mode='r')
+        with OdbTransaction(odb_file_name, backend) as transaction:
+            transaction.write(store[1], 'EP', 'cycles_1', set_name='BALLAST')
+            assert isinstance(transaction.operations[0]['data'], np.memmap)
+            assert np.shares_memory(transaction.operations[0]['data'], store)
+            file_name, offset = file_region(transaction.operations[0]['data'])
+            region = np.memmap(file_name, dtype=float, mode='r', offset=offset, shape=(20, 6))
+            assert np.array_equal(region, stresses[1])
+            del region
+        assert backend.sessions == 4
+
+        cached_backend = CachedOdbBackend(backend, OdbFieldCache(os.path.join(directory, 'cache')))
+        for sessions in [5, 5]:
+            with OdbTransaction(odb_file_name, cached_backend) as transaction:
+                strains = transaction.read('EP', 'cycles_1', set_name='BALLAST')
+                last_frame = transaction.read('S', 'loading', set_name='BALLAST')
+            assert backend.sessions == sessions
+            assert np.array_equal(strains.data, stresses[1])
+            assert np.array_equal(last_frame.data, stresses[-1])
+        del store, strains, last_frame
+    finally:
+        shutil.rmtree(directory)
+    print("The odb transactions execute in one session each and round trip the data")
+
+
+if __name__ == '__main__':
+    main()
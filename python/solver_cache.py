@@ -0,0 +1,107 @@
+from __future__ import print_function, division
+
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from FEM_functions.mesh_bundle import element_groups
+
+default_cache_directory = os.path.expanduser('~/railway_ballast/solver_cache')
+
+
+def boundary_condition_definition(boundary_conditions):
+    # A description of the boundary conditions that does not depend on the identity of the objects
+    return repr([(bc.set_name, bc.type, bc.component, None if bc.values is None else sorted(bc.values.items()))
+                 for bc in boundary_conditions])
+
+
+def mesh_fingerprint(mesh, set_name, boundary_conditions, bc_vals):
+    """
+    Hash of the mesh exported for a deformation calculator, see FEM_functions.mesh_bundle, the node coordinates and
+    the connectivity of the elements, together with the element set and the boundary conditions. Calculators for
+    meshes with the same fingerprint have the same B-matrix and solver
+    """
+    key = hashlib.sha1()
+    key.update(repr((set_name, boundary_condition_definition(boundary_conditions))).encode())
+    for name in ['node_labels', 'coordinates', 'element_labels', 'element_types', 'bc_dofs']:
+        key.update(np.ascontiguousarray(mesh[name]).tobytes())
+    key.update(np.asarray(bc_vals, dtype=float).tobytes())
+    for element_class, _, connectivity in element_groups(mesh):
+        key.update(element_class.__name__.encode())
+        key.update(np.ascontiguousarray(connectivity).tobytes())
+    return key.hexdigest()
+
+
+class SolverCache:
+    """
+    Persistent cache of assembled deformation calculators, see DeformationCalculator.save, identified by the
+    fingerprint of the mesh, see mesh_fingerprint. The fingerprint is only known after the mesh is exported from the
+    odb, so the fingerprint found for an odb is also stored under a key made of the path, size and modification time
+    of the odb and the arguments of the export, which lets a calculator for an unchanged odb be loaded without
+    exporting the mesh. The least recently used entries are removed when the total size of the cache exceeds
+    max_size bytes.
+    """
+    def __init__(self, directory=default_cache_directory, max_size=20*1024**3):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def source_key(odb_file_name, boundary_conditions, **identifiers):
+        odb_file_name = os.path.abspath(odb_file_name)
+        stat = os.stat(odb_file_name)
+        key = repr((odb_file_name, stat.st_size, stat.st_mtime, sorted(identifiers.items()),
+                    boundary_condition_definition(boundary_conditions)))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _source_file_name(self, source_key):
+        return os.path.join(self.directory, 'sources', source_key)
+
+    def entry_directory(self, fingerprint):
+        return os.path.join(self.directory, fingerprint)
+
+    def fingerprint(self, source_key):
+        # The fingerprint of the mesh last exported for the source key or None
+        file_name = self._source_file_name(source_key)
+        if not os.path.isfile(file_name):
+            return None
+        with open(file_name) as source_file:
+            return source_file.read().strip()
+
+    def get(self, fingerprint):
+        # The directory of the entry or None if the mesh is not cached
+        entry_directory = self.entry_directory(fingerprint)
+        if not os.path.isdir(entry_directory):
+            return None
+        # The modification time of the directory is used as the time of the last use
+        os.utime(entry_directory, None)
+        return entry_directory
+
+    def put(self, fingerprint, calculator):
+        calculator.save(self.entry_directory(fingerprint))
+        self.evict()
+
+    def add_source(self, source_key, fingerprint):
+        file_name = self._source_file_name(source_key)
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        with open(file_name + '.tmp', 'w') as source_file:
+            source_file.write(fingerprint)
+        os.rename(file_name + '.tmp', file_name)
+
+    def evict(self):
+        entries = []
+        for entry_name in os.listdir(self.directory):
+            entry_directory = os.path.join(self.directory, entry_name)
+            if entry_name == 'sources' or not os.path.isdir(entry_directory):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_directory, file_name))
+                       for file_name in os.listdir(entry_directory))
+            entries.append((os.stat(entry_directory).st_mtime, size, entry_directory))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_directory in sorted(entries):
+            if size <= self.max_size:
+                break
+            shutil.rmtree(entry_directory)
+            size -= entry_size